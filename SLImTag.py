@@ -17,7 +17,6 @@ Giulio Del Corso, Oscar Papini, Federico Volpini
 import os
 import time
 import shutil
-import io
 import warnings
 import math
 
@@ -36,7 +35,6 @@ from PIL import Image, ImageDraw, ImageTk
 from PIL import PngImagePlugin
 
 import json
-import tarfile # volume masks
 
 # Configuration file management
 import tomlkit
@@ -47,11 +45,17 @@ from slimtag_utils import MultiButtonDialog, MaskEditDialog
 from slimtag_utils import PreprocessingAdjustments, adjust_image
 from slimtag_utils import Tooltip
 from slimtag_color_utils import rgb_to_hex, hex_to_rgb
-from slimtag_bayesian import OptimizerDialog
+from slimtag_bayesian_gui import OptimizerDialog
 import slimtag_wand as wand
+from slimtag_sam import SamWorker, SamModelPool
+from slimtag_volume import (VolumeDisplay, SlicePrefetcher, WINDOW_PRESETS, VOLUME_PLANES,
+                            SparseVolumeMask, plane_shape, plane_position, plane_point,
+                            write_mask_tar, read_mask_tar)
 
 # Asynchronous threading import
 import threading
+import importlib.util # check optional libraries without importing them
+from concurrent.futures import CancelledError
 
 #%% Global parameters
 
@@ -107,32 +111,36 @@ class SegmentationApp(ctk.CTk):
         #%% Optional imports
         
         self._load_medical_volume = None
+        self._save_labelmap = {}
+        self._list_series_DICOM = None
+        self._dicom_index = None
         self._torch = None
         self._segment_anything = None
         
         if self.slimtag_config["modules"]["biomedical"]: # Custom biomedical utils
             try:
-                from slimtag_biomedical import load_medical_volume
+                from slimtag_biomedical import load_medical_volume, save_labelmap_NRRD, save_labelmap_NIFTI
+                from slimtag_biomedical import list_series_DICOM, DicomIndex
                 self._load_medical_volume = load_medical_volume
+                self._save_labelmap = {".nrrd": save_labelmap_NRRD, ".nii": save_labelmap_NIFTI, ".nii.gz": save_labelmap_NIFTI}
+                self._list_series_DICOM = list_series_DICOM
+                if self.slimtag_config["biomedical"]["dicom_index"]:
+                    try:
+                        self._dicom_index = DicomIndex(self.slimtag_config["biomedical"]["dicom_index"])
+                    except Exception as e:
+                        warnings.warn(f"DICOM index not available ({e}), DICOM folders will be scanned each time")
             except ModuleNotFoundError:
                 warnings.warn("libraries for 'biomedical' not found, 'biomedical = True' will be ignored")
                 self.slimtag_config["modules"]["biomedical"] = False
         
         if self.slimtag_config["modules"]["sam"]: # SAM segmentation models
-            # Torch and SAM (Segment anything model)
-            try:
-                import torch
-                self._torch = torch
-                import segment_anything
-                self._segment_anything = segment_anything
-                # Suppress specific PyTorch warnings
-                warnings.filterwarnings(
-                    "ignore",
-                    message="You are using `torch.load` with `weights_only=False`"
-                )
-            except ModuleNotFoundError:
+            # Torch and SAM (Segment anything model) take seconds to import:
+            # here only check that they are installed, and import them lazily
+            # (see import_sam_modules and warm_up_sam)
+            if any(importlib.util.find_spec(lib) is None for lib in ["torch", "segment_anything"]):
                 warnings.warn("libraries for 'sam' not found, 'sam = True' will be ignored")
                 self.slimtag_config["modules"]["sam"] = False
+        self._sam_import_lock = threading.Lock()
 
         #%% Attributes
         
@@ -157,9 +165,11 @@ class SegmentationApp(ctk.CTk):
         self.tk_ov = None
         self.sam_preview_pil = None
         self.tk_sam_preview = None
-        self.volume_disp = None # volume display casted as uint8 array
-        self.volume_mask = None # 3D numpy array for volume masks
-        self.volume_preview = None # resized volume for fast slider preview
+        self.volume_display = None # VolumeDisplay object (uint8 slices of the volume, intensity window)
+        self.volume_prefetcher = None # SlicePrefetcher of RGB slices and magic wand preprocessing
+        self.volume_axis = 2 # axis orthogonal to the slices shown (see VOLUME_PLANES): 2 axial, 0 coronal, 1 sagittal
+        self.volume_mask = None # volume mask, (X, Y, Z) (see SparseVolumeMask)
+        self.volume_mask_plane = None # (axis, index) of the slice of volume_mask being edited in mask_orig
         self.volume_zslider = None
         self.zslider_preview = None # TopLevel object that contains slider preview
         self.zslider_preview_img = None # preview image, to prevent it from being garbage collected
@@ -279,16 +289,28 @@ class SegmentationApp(ctk.CTk):
         # SAM management
         self.sam = None
         self.last_sam_model = None # prevent model reload if the same model is chosen
-        self.sam_device = None
+        self.sam_device = None # chosen lazily (by the SAM worker, or when torch is imported)
+        self.sam_worker = None # SamWorker object if SAM runs in a separate process
+        self.sam_pool = None # SamModelPool object if SAM runs in this process (created lazily)
+        self.sam_requested_model = None # last model chosen in wand_model_menu
+        self.sam_switch_thread = None # thread switching SAM model in background
+        self.sam_switch_lock = threading.Lock() # hands sam_requested_model over to sam_switch_thread
         self.available_sam_models = []
         if self.slimtag_config["modules"]["sam"]:
-            self.sam_device = "cuda" if torch.cuda.is_available() else "cpu"
             for sam_model in SAM_MODELS:
                 if os.path.exists(SAM_MODELS[sam_model]["path"]):
                     self.available_sam_models.append(sam_model)
+            if self.slimtag_config["sam"]["out_of_process"]:
+                self.sam_worker = SamWorker(device=self.sam_device, tiling=self.sam_tiling_options(),
+                                            pool_options=self.sam_pool_options())
         self.sam_points = []
         self.sam_pt_labels = []
         self.sam_preview = None # boolean matrix for multipoint SAM preview
+        # box magic wand: drag state, and decoder throttling
+        self.sam_box = None # [x0, y0, x1, y1] in image coordinates while dragging
+        self.sam_box_add = True # add or remove the box mask at release
+        self.sam_box_decode_id = None # ID of the scheduled box decode (preview, or final one waiting for the embedding)
+        self.sam_box_decode_time = 0.0 # duration of the last decode (seconds)
         # to store IDs of <Return> and <Escape> events for multipoint SAM tool
         self.sam_bind_enter = None
         self.sam_bind_esc = None
@@ -313,6 +335,9 @@ class SegmentationApp(ctk.CTk):
         # asynchronous mechanism to speed up image loading
         self.switch_computed_magic_wand = False     # True if SAM is loaded
         self.thread = None                          # Threading variable
+        self.wand_inputs_version = 0                # incremented when the image or the wand adjustments change
+        self.wand_loaded_version = 0                # wand_inputs_version of the current magic wand preprocessing
+        self.image_preprocessing = None             # region growing preprocessing of image_orig, if already computed
         self.lock = threading.Lock()              # To protect shared varaibles
 
         splash.step(10)
@@ -395,6 +420,9 @@ class SegmentationApp(ctk.CTk):
         wand_menu = tk.Menu(self.menu_bar, tearoff=0)
         wand_menu.add_command(label="Load configuration", command=None, state="disabled")
         wand_menu.add_command(label="Save configuration", command=None, state="disabled")
+        if self.sam_worker is not None:
+            wand_menu.add_separator()
+            wand_menu.add_command(label="Restart SAM worker", command=self.restart_sam_worker)
         self.topmenu_items["wand"] = wand_menu
         self.menu_bar.add_cascade(label="Magic wand", menu=wand_menu)
         
@@ -410,6 +438,7 @@ class SegmentationApp(ctk.CTk):
         if self.slimtag_config["modules"]["biomedical"]:
             biomedical_menu = tk.Menu(self.menu_bar, tearoff=0)
             biomedical_menu.add_command(label="Import NRRD/NIFTI/DICOM", command=self.biomedical_load)
+            biomedical_menu.add_command(label="Import DICOM folder", command=lambda: self.biomedical_load(folder=True))
             self.topmenu_items["biomedical"] = biomedical_menu
             self.menu_bar.add_cascade(label="Biomedical tools", menu=biomedical_menu, foreground=HIGHLIGHT_COLOR)
             
@@ -490,7 +519,7 @@ class SegmentationApp(ctk.CTk):
         self.create_tool_button("wand", 2, 0, 0, help_text="Magic wand [M]")
         self.create_tool_button("wand_all", 2, 0, 1)
         self.create_tool_button("wand_multi", 2, 1, 0, last_row=True, help_text="Multipoint magic wand")
-        self.create_tool_button("wand_box", 2, 1, 1, None, last_row=True)
+        self.create_tool_button("wand_box", 2, 1, 1, last_row=True, help_text="Box magic wand")
         self.create_tool_button("ruler", 3, 0, 0, None, last_row=True)
         self.create_tool_button("area", 3, 0, 1, None,last_row=True)
         self.create_tool_button("custom_1", 4, 0, 0, None)
@@ -526,6 +555,14 @@ class SegmentationApp(ctk.CTk):
         volume_canvas_frame.slider.bind("<ButtonRelease-1>", self.end_zslider_preview)
         volume_canvas_frame.zlabel = ctk.CTkLabel(slider_frame, textvariable=self.zlabel_var, anchor="w", width=40)
         volume_canvas_frame.zlabel.grid(row=0, column=1, sticky="e", padx=(0, 10))
+        volume_canvas_frame.window_menu = ctk.CTkOptionMenu(slider_frame, values=["Auto"] + list(WINDOW_PRESETS),
+                                                            command=self.set_volume_window_preset, width=130)
+        volume_canvas_frame.window_menu.grid(row=0, column=3, sticky="e", padx=(0, 10))
+        Tooltip(volume_canvas_frame.window_menu, text="Intensity window")
+        volume_canvas_frame.plane_menu = ctk.CTkOptionMenu(slider_frame, values=list(VOLUME_PLANES), width=100,
+                                                           command=lambda name: self.set_volume_plane(VOLUME_PLANES[name]))
+        volume_canvas_frame.plane_menu.grid(row=0, column=2, sticky="e", padx=(0, 10))
+        Tooltip(volume_canvas_frame.plane_menu, text="Slice plane")
         self.canvas_frames["volume"] = volume_canvas_frame
         
         # default view
@@ -731,12 +768,19 @@ class SegmentationApp(ctk.CTk):
         image_only_frame.grid_columnconfigure(0, weight=1)
         self.sub_canvas_frames["image"] = image_only_frame
         
+        # volumes: minimap of the current slice, and the two orthogonal planes
+        # through the center of the view (click on one to annotate along it)
         ortho_views_frame = ctk.CTkFrame(self.navigation_frame)#, fg_color="transparent")
-        ortho_views_frame.view1 = ctk.CTkCanvas(ortho_views_frame, bg="black", highlightthickness=0, width=preview_dim, height=preview_dim)
-        ortho_views_frame.view1.grid(row=0, column=0, sticky="sew", padx=5, pady=5)
-        ortho_views_frame.view2 = ctk.CTkCanvas(ortho_views_frame, bg="black", highlightthickness=0, width=preview_dim, height=preview_dim)
-        ortho_views_frame.view2.grid(row=1, column=0, sticky="sew", padx=5, pady=5)
-        ortho_views_frame.grid_columnconfigure(0, weight=1)
+        ortho_views_frame.canvas = ctk.CTkCanvas(ortho_views_frame, bg="black", highlightthickness=0, width=preview_dim, height=preview_dim)
+        ortho_views_frame.canvas.grid(row=0, column=0, columnspan=2, sticky="s", padx=5, pady=5)
+        ortho_views_frame.view1 = ctk.CTkCanvas(ortho_views_frame, bg="black", highlightthickness=0, width=preview_dim//2, height=preview_dim//2)
+        ortho_views_frame.view1.grid(row=1, column=0, sticky="n", padx=5, pady=5)
+        ortho_views_frame.view2 = ctk.CTkCanvas(ortho_views_frame, bg="black", highlightthickness=0, width=preview_dim//2, height=preview_dim//2)
+        ortho_views_frame.view2.grid(row=1, column=1, sticky="n", padx=5, pady=5)
+        for view in (ortho_views_frame.view1, ortho_views_frame.view2):
+            view.axis = None
+            view.bind("<Button-1>", lambda e, view=view: self.set_volume_plane(view.axis) if view.axis is not None else None)
+        ortho_views_frame.grid_columnconfigure([0, 1], weight=1)
         self.sub_canvas_frames["ortho"] = ortho_views_frame
         
         # TODO bind mouse click on minimap to pan?
@@ -789,6 +833,10 @@ class SegmentationApp(ctk.CTk):
         self.bind("<Left>", lambda e: self.pan_view(-20, 0))
         self.bind("<Right>", lambda e: self.pan_view(20, 0))
         
+        # Volume slices (Page Up / Page Down)
+        self.bind("<Prior>", lambda e: self.step_volume_slice(-1))
+        self.bind("<Next>", lambda e: self.step_volume_slice(1))
+        
         # Bind "close window" to quit_program
         self.protocol("WM_DELETE_WINDOW", self.quit_program)
         
@@ -853,6 +901,9 @@ class SegmentationApp(ctk.CTk):
         splash.withdraw()
         self.update()
         self.deiconify()
+        
+        # import SAM libraries in background, once the window is visible
+        self.after(500, self.warm_up_sam)
 
 
         #%% TODO old code to be repurposed, DO NOT REMOVE UNTIL IMPLEMENTED BACK
@@ -875,11 +926,24 @@ class SegmentationApp(ctk.CTk):
 
     #%% AUX methods
     # Async method for efficient SAM loading
+    def start_async_loader(self):
+        '''
+        Compute the magic wand preprocessing of the current image (with the
+        current adjustments) in background.
+        '''
+        self.wand_inputs_version += 1
+        # a running loader catches up with the new inputs; otherwise, this
+        # thread does (see async_loader)
+        self.thread = threading.Thread(target=self.async_loader, daemon=True)
+        self.thread.start()
+
     def async_loader(self): # TODO rethink async_loader
-        #print("Loading SAM model")
-        self.status_sam_label.configure(text="(Loading image into SAM...)")
         #  Thread-safe upload of shared variable
         with self.lock:
+            if self.wand_loaded_version == self.wand_inputs_version: # already done by a previous loader
+                return
+            #print("Loading SAM model")
+            self.status_sam_label.configure(text="(Loading image into SAM...)")
             self.switch_computed_magic_wand = False
             
             if len(self.mask_labels) == 0 or self.active_mask_id is None: # disable all buttons if there are no masks
@@ -887,16 +951,29 @@ class SegmentationApp(ctk.CTk):
             else:
                 self.set_controls_state(True)
             
-            # apply adjustments to magic wand pre-computation
-            image = adjust_image(np.array(self.image_orig), self.wand_brightness, self.wand_contrast, self.wand_gamma)
-            
-            # compute preprocessing for region growing
-            self.region_growing_preprocess = wand.region_growing_preprocessing(image)
-            
-            # SAM computation
-            if self.slimtag_config["modules"]["sam"]:
-                if self.sam is not None:
-                    wand.sam_preprocessing(image, self.sam)
+            # the image may change meanwhile (e.g. stepping through the slices
+            # of a volume): compute again until up to date
+            while self.wand_loaded_version != self.wand_inputs_version:
+                version = self.wand_inputs_version
+                image_orig, prepared = self.image_orig, self.image_preprocessing
+                
+                # apply adjustments to magic wand pre-computation
+                image = adjust_image(np.array(image_orig), self.wand_brightness, self.wand_contrast, self.wand_gamma)
+                
+                # compute preprocessing for region growing (unless prepared in advance, see prepare_volume_slice)
+                self.region_growing_preprocess = prepared if prepared is not None else wand.region_growing_preprocessing(image)
+                
+                # SAM computation
+                if self.slimtag_config["modules"]["sam"]:
+                    if self.sam is not None:
+                        try:
+                            wand.sam_preprocessing(image, self.sam)
+                        except CancelledError: # superseded by a newer image, which will be embedded instead
+                            pass
+                        except RuntimeError: # SAM worker crashed: keep the session alive
+                            self.after(0, lambda: self.set_status("error", "SAM worker stopped (Magic wand > Restart SAM worker)"))
+                
+                self.wand_loaded_version = version
             
             # Turn on switch
             self.switch_computed_magic_wand = True
@@ -921,12 +998,187 @@ class SegmentationApp(ctk.CTk):
         Load a SAM model.
         
         Here model_type is one of the keys of SAM_MODELS.
+        
+        Runs in background (see sam_switch): the interface is updated
+        through self.after.
+        """
+        self.after(0, lambda: self.set_status("loading", "Loading SAM model..."))
+        if self.sam_worker is not None:
+            try:
+                self.sam_worker.load_model(SAM_MODELS[model_type]["type"], SAM_MODELS[model_type]["path"])
+            except RuntimeError:
+                self.sam = None
+                self.after(0, lambda: self.set_status("error", "SAM worker stopped (Magic wand > Restart SAM worker)"))
+                return
+            self.sam = self.sam_worker
+            self.sam_device = self.sam_worker.device
+        else:
+            if not self.import_sam_modules():
+                self.sam = None
+                self.after(0, lambda: self.set_status("error", "Cannot import SAM libraries"))
+                return
+            self.sam_pool_create()
+            try:
+                self.sam_pool.select(SAM_MODELS[model_type]["type"], SAM_MODELS[model_type]["path"])
+            except Exception as e: # e.g. corrupted checkpoint, out of memory
+                self.sam = None
+                warnings.warn(f"cannot load SAM model '{model_type}' ({e})")
+                self.after(0, lambda: self.set_status("error", f"Cannot load {model_type}"))
+                return
+            self.sam = self.sam_pool
+        self.after(0, lambda: self.set_status("ready", "Ready"))
+    
+    def import_sam_modules(self):
+        """
+        Import torch and segment_anything (if not already imported), and
+        choose the device for in-process SAM.
+        
+        Thread-safe: a call during the background warm-up waits for it.
+        Return True if the libraries are available.
+        """
+        with self._sam_import_lock:
+            if self._segment_anything is None:
+                try:
+                    import torch
+                    import segment_anything
+                except ImportError:
+                    warnings.warn("libraries for 'sam' cannot be imported")
+                    return False
+                # Suppress specific PyTorch warnings
+                warnings.filterwarnings(
+                    "ignore",
+                    message="You are using `torch.load` with `weights_only=False`"
+                )
+                self._torch = torch
+                self._segment_anything = segment_anything
+                self.sam_device = "cuda" if torch.cuda.is_available() else "cpu"
+        return True
+    
+    def warm_up_sam(self):
+        """
+        Prepare SAM in background after the main window appears, so that
+        selecting a SAM model does not wait for the torch import.
+        
+        The SAM worker imports torch in its own process (the GUI never needs
+        it); otherwise the libraries are imported in a daemon thread.
+        """
+        if not self.slimtag_config["modules"]["sam"] or not self.available_sam_models:
+            return
+        if self.sam_worker is not None:
+            try:
+                self.sam_worker.start()
+            except OSError: # cannot spawn now, load_model will try again
+                pass
+            for model_type in self.slimtag_config["sam"]["preload"]:
+                self.sam_prefetch(model_type)
+        else:
+            def warm_up():
+                for model_type in self.slimtag_config["sam"]["preload"]:
+                    self.sam_prefetch(model_type)
+                self.import_sam_modules() # in case nothing has to be preloaded
+            threading.Thread(target=warm_up, daemon=True).start()
+    
+    def sam_pool_create(self):
+        """
+        Create the in-process SamModelPool, if not already created.
+        """
+        if self.sam_pool is None:
+            self.sam_pool = SamModelPool(device=self.sam_device, tiling=self.sam_tiling_options(),
+                                         **self.sam_pool_options())
+    
+    def sam_pool_options(self):
+        """
+        Keyword arguments for SamModelPool from the config file.
+        """
+        cfg = self.slimtag_config["sam"]
+        return {"memory_budget": cfg["memory_budget"], "mmap": cfg["mmap_checkpoints"],
+                "embedding_cache": cfg["embedding_cache"]}
+    
+    def sam_prefetch(self, model_type):
+        """
+        Load a SAM model in background, without selecting it.
+        """
+        if model_type not in self.available_sam_models:
+            return
+        if self.sam_worker is not None:
+            try:
+                self.sam_worker.prefetch_model(SAM_MODELS[model_type]["type"], SAM_MODELS[model_type]["path"])
+            except (RuntimeError, OSError): # the model will be loaded when selected
+                pass
+        elif self.import_sam_modules():
+            self.sam_pool_create()
+            self.sam_pool.prefetch(SAM_MODELS[model_type]["type"], SAM_MODELS[model_type]["path"])
+    
+    def sam_switch(self):
+        """
+        Switch to the SAM model in self.sam_requested_model, then embed the
+        current image. Runs in background (see wand_model_select); if the
+        model is changed again meanwhile, the last choice wins.
+        """
+        with self.lock:
+            self.switch_computed_magic_wand = False
+        self.after(0, lambda: self.set_controls_state(len(self.mask_labels) > 0 and self.active_mask_id is not None))
+        loaded = None
+        while True:
+            # the model may be changed while loading or embedding: check again
+            # after both, and leave (under the lock) only if up to date, so
+            # that a later choice starts a new thread
+            with self.sam_switch_lock:
+                if self.sam_requested_model == loaded:
+                    self.sam_switch_thread = None
+                    return
+                model_type = self.sam_requested_model
+            try:
+                self.sam_loader(model_type)
+                if self.image_orig is not None:
+                    self.wand_inputs_version += 1 # embed the image with the new model
+                    self.async_loader()
+            except BaseException:
+                with self.sam_switch_lock:
+                    self.sam_switch_thread = None
+                raise
+            loaded = model_type
+    
+    def wand_model_id(self):
+        """
+        Identifier of the magic wand model selected in wand_model_menu, as
+        used by the Bayesian optimization history (and its command line).
         """
-        self.set_status("loading", "Loading SAM model...")
-        sam = self._segment_anything.sam_model_registry[SAM_MODELS[model_type]["type"]](checkpoint=SAM_MODELS[model_type]["path"])
-        sam.to(self.sam_device).eval()
-        self.sam = self._segment_anything.SamPredictor(sam)
+        name = self.wand_model_menu.get()
+        if name in SAM_MODELS:
+            return f"{SAM_MODELS[name]['type']}:{os.path.basename(SAM_MODELS[name]['path'])}"
+        return "region_growing"
+    
+    def sam_tiling_options(self):
+        """
+        Keyword arguments for TiledSamPredictor from the config file, or None
+        if tiled SAM is disabled.
+        """
+        cfg = self.slimtag_config["sam"]
+        if not cfg["tiled"]:
+            return None
+        return {"tile_size": cfg["tile_size"],
+                "overlap": cfg["tile_overlap"],
+                "min_size": cfg["tiled_min_size"],
+                "max_cached_tiles": cfg["tile_cache"]}
+    
+    def restart_sam_worker(self):
+        """
+        Restart the SAM worker process (e.g. after a crash) and embed the
+        current image again.
+        """
+        if self.sam_worker is None or self.last_sam_model is None:
+            return
+        self.set_status("loading", "Restarting SAM worker...")
+        try:
+            self.sam_worker.restart()
+        except RuntimeError:
+            self.set_status("error", "SAM worker stopped (Magic wand > Restart SAM worker)")
+            return
+        self.sam = self.sam_worker
         self.set_status("ready", "Ready")
+        if self.image_orig is not None:
+            self.start_async_loader()
     
     def wand_model_select(self, model_type):
         """
@@ -949,8 +1201,13 @@ class SegmentationApp(ctk.CTk):
             #                                 image=self.icons_dict["AutoUpdate"]["disabled"])
             if model_type != self.last_sam_model:
                 self.last_sam_model = model_type
-                self.sam_loader(model_type)
-                self.async_loader()
+                # load model and embedding in background (fast if the model
+                # is still resident in the pool)
+                with self.sam_switch_lock:
+                    self.sam_requested_model = model_type
+                    if self.sam_switch_thread is None: # otherwise, the running thread switches to it
+                        self.sam_switch_thread = threading.Thread(target=self.sam_switch, daemon=True)
+                        self.sam_switch_thread.start()
         self.wand_threshold_slider.set(self.wand_threshold)
         self.wand_threshold_lbl.configure(text=f"{self.wand_threshold:.2f}")
     
@@ -1014,16 +1271,54 @@ class SegmentationApp(ctk.CTk):
                 "sam": Field(bool, required=True),
                 "biomedical": Field(bool, required=True)
             },
+            "sam": {
+                "out_of_process": Field(bool, default=True),
+                "tiled": Field(bool, default=True),
+                "tile_size": Field(int, default=1024),
+                "tile_overlap": Field(int, default=256),
+                "tiled_min_size": Field(int, default=4096),
+                "tile_cache": Field(int, default=16),
+                "memory_budget": Field(int, default=4096),
+                "mmap_checkpoints": Field(bool, default=True),
+                "preload": Field(list, default=[]),
+                "embedding_cache": Field(int, default=1024),
+                "prefetch_volume_embeddings": Field(bool, default=False)
+            },
+            "bayesian_optimization": {
+                "initial_points": Field(int, default=10),
+                "max_iterations": Field(int, default=50),
+                "n_points": Field(int, default=20),
+                "n_workers": Field(int, default=0),
+                "batch_size": Field(int, default=4),
+                "cache_size": Field(int, default=2048),
+                "split_search": Field(bool, default=False),
+                "dataset_cache": Field(int, default=1024),
+                "decoded_cache_folder": Field(str, default=""),
+                "max_images": Field(int, default=0),
+                "halving_eta": Field(int, default=0),
+                "halving_rungs": Field(int, default=2),
+                "early_stop_patience": Field(int, default=0),
+                "early_stop_tol": Field(float, default=0.001),
+                "history_file": Field(str, default="~/.cache/slimtag/bayesian_history.jsonl"),
+                "sam_embedding_cache": Field(int, default=4096)
+            },
+            "biomedical": {
+                "dicom_index": Field(str, default="~/.cache/slimtag/dicom_index.sqlite")
+            },
             "view": {
                 "zoom": {
                     "max_pixel": Field(int, default=32),
                     "min_pixel": Field(int, default=6144)
                 },
                 "refresh_rate_brush": Field(float, default=0.05),
-                "preview_dim": Field(int, default=250)
+                "preview_dim": Field(int, default=250),
+                "volume_slice_cache": Field(int, default=256),
+                "volume_prefetch_depth": Field(int, default=4),
+                "volume_prefetch_cache": Field(int, default=512)
             },
             "mask": {
                 "max_masks": Field(int, default=20),
+                "labelmap_compression": Field(int, default=6),
                 "default_mask_colors": Field(list, required=True)
             }
         }
@@ -1068,6 +1363,11 @@ class SegmentationApp(ctk.CTk):
             self.quit()
             self.destroy()
     
+    def destroy(self):
+        if self.sam_worker is not None:
+            self.sam_worker.shutdown()
+        super().destroy()
+    
     #%% STATUS METHODS
     # update window title
     def update_title(self):
@@ -1130,15 +1430,15 @@ class SegmentationApp(ctk.CTk):
     def show_preview_frame(self, preview):
         for nav in self.sub_canvas_frames:
             self.sub_canvas_frames[nav].grid_forget()
-        # TODO implement for ortho
-        # if hasattr(self.sub_canvas_frames[preview], "view1") ...
+        canvas = self.sub_canvas_frames[preview].canvas
         if self.image_orig is not None:
             scale = max(self.orig_w, self.orig_h) / self.slimtag_config["view"]["preview_dim"]
             self.preview_scale = scale
-            self.sub_canvas_frames["image"].canvas.configure(width=int(self.orig_w / scale), height=int(self.orig_h / scale))
+            canvas.configure(width=int(self.orig_w / scale), height=int(self.orig_h / scale))
             self.sub_canvas_image = ImageTk.PhotoImage(self.image_orig.resize((int(self.orig_w / scale), int(self.orig_h / scale)), Image.Resampling.LANCZOS))
-            self.sub_canvas_frames["image"].canvas.create_image(0, 0, anchor="nw", image=self.sub_canvas_image, tag="image")
-        self.current_preview_canvas = self.sub_canvas_frames["image"].canvas
+            canvas.delete("image")
+            canvas.create_image(0, 0, anchor="nw", image=self.sub_canvas_image, tag="image")
+        self.current_preview_canvas = canvas
         self.sub_canvas_frames[preview].grid(row=0, column=0, sticky="nsew", padx=0, pady=0)
         self.sub_canvas_frames[preview].tkraise()
     
@@ -1149,6 +1449,36 @@ class SegmentationApp(ctk.CTk):
         w = int(self.view_w / self.preview_scale)
         h = int(self.view_h / self.preview_scale)
         self.current_preview_canvas.create_rectangle(x, y, x+w, y+h, outline=HIGHLIGHT_COLOR, width=2, tag="rectangle")
+        if self.is_volume_loaded:
+            self.update_ortho_views()
+
+    def update_ortho_views(self):
+        '''
+        Draw the two planes orthogonal to the current slice, through the
+        center of the view, in the navigation panel (from the preview volume,
+        so that the full volume is never read here).
+        '''
+        frame = self.sub_canvas_frames["ortho"]
+        shape = self.volume_display.shape
+        center = self.volume_view_center()
+        dim = self.slimtag_config["view"]["preview_dim"] // 2
+        frame.images = [] # keep references to the PhotoImage objects
+        for view, axis in zip((frame.view1, frame.view2), [a for a in (2, 0, 1) if a != self.volume_axis]):
+            img = Image.fromarray(self.volume_display.preview_slice(center[axis], axis))
+            img_h, img_w = img.height, img.width
+            img = img.resize((max(1, round(img_w * min(dim / img_w, dim / img_h))), max(1, round(img_h * min(dim / img_w, dim / img_h)))), Image.NEAREST)
+            frame.images.append(ImageTk.PhotoImage(img))
+            view.axis = axis
+            view.configure(width=img.width, height=img.height)
+            view.delete("all")
+            view.create_image(0, 0, anchor="nw", image=frame.images[-1])
+            # cross through the center of the view
+            row, col = plane_position(shape, axis, center)
+            n_rows, n_cols = plane_shape(shape, axis)
+            y = (row + 0.5) * img.height / n_rows
+            x = (col + 0.5) * img.width / n_cols
+            view.create_line(0, y, img.width, y, fill=HIGHLIGHT_COLOR)
+            view.create_line(x, 0, x, img.height, fill=HIGHLIGHT_COLOR)
     
     #%% UPDATE DISPLAY
     def update_display(self, update_image=True, update_blended=True):
@@ -1226,7 +1556,7 @@ class SegmentationApp(ctk.CTk):
             self.update_blended()
 
         # if SAM is active, create also multipoint preview
-        if any(self.tool_active[tool] for tool in ["wand", "wand_multi"]):
+        if any(self.tool_active[tool] for tool in ["wand", "wand_multi", "wand_box"]):
             # create new mask view and populate
             cut_mask_preview = np.full((self.view_h, self.view_w), False)
             try:
@@ -1246,8 +1576,9 @@ class SegmentationApp(ctk.CTk):
             self.tk_sam_preview = ImageTk.PhotoImage(resized_prev)
             self.canvas.create_image(0, 0, anchor="nw", image=self.tk_sam_preview, tag="mask")
 
-            # raise back SAM multipoints if any
+            # raise back SAM multipoints and box if any
             self.display_wand_multipoints()
+            self.display_wand_box()
         
         # if brush or eraser is active, draw preview
         # there are some inconsistencies due to interactions with Shift and Ctrl, but whatever
@@ -1325,6 +1656,21 @@ class SegmentationApp(ctk.CTk):
                 self.canvas.create_oval(x-3, y-3, x+3, y+3, fill=pt_fill, outline=pt_out, width=1, tag="sam_pt")
         self.canvas.tag_raise("sam_pt")
     
+    def display_wand_box(self):
+        self.canvas.delete("sam_box")
+        if self.sam_box is None:
+            return
+        cw = self.canvas.winfo_width()
+        ch = self.canvas.winfo_height()
+        x0, y0, x1, y1 = self.sam_box
+        x0 = int(((x0 - self.view_x) / self.view_w) * cw)
+        y0 = int(((y0 - self.view_y) / self.view_h) * ch)
+        x1 = int(((x1 - self.view_x) / self.view_w) * cw)
+        y1 = int(((y1 - self.view_y) / self.view_h) * ch)
+        # dashed rectangle, black and white to be visible on any image
+        self.canvas.create_rectangle(x0, y0, x1, y1, outline="black", width=1, tag="sam_box")
+        self.canvas.create_rectangle(x0, y0, x1, y1, outline="white", width=1, dash=(4, 4), tag="sam_box")
+    
     #%% UI CANVAS METHODS
     def show_canvas_frame(self, frametype):
         # unbind events to currently visible canvas
@@ -1368,8 +1714,113 @@ class SegmentationApp(ctk.CTk):
         if not self.is_volume_loaded:
             return
         
-        img = Image.fromarray(self.volume_disp[..., z]).convert("RGB")
-        self.load_image(img, mask=self.volume_mask[..., z], reset_view=False) # don't change canvas, don't reset view
+        # RGB image and region growing preprocessing are usually ready (see prepare_volume_slice)
+        data = self.volume_prefetcher.get(z)
+        self.load_image(data["image"], mask=self.volume_slice_mask(self.volume_axis, z), reset_view=False, # don't change canvas, don't reset view
+                        preprocessing=data["region_growing"])
+
+    def volume_slice_mask(self, axis, z):
+        '''
+        Dense copy of slice z of volume_mask along axis, to be edited as
+        mask_orig; the slice edited so far is stored back first.
+        '''
+        self.store_volume_slice()
+        self.volume_mask_plane = (axis, z)
+        return self.volume_mask.plane(axis, z)
+
+    def store_volume_slice(self):
+        '''
+        Write mask_orig back to volume_mask: edits in any plane are shared.
+        '''
+        if self.is_volume_loaded and self.volume_mask_plane is not None and self.mask_orig is not None:
+            self.volume_mask.set_plane(*self.volume_mask_plane, self.mask_orig)
+
+    def prepare_volume_slice(self, z, axis=2):
+        '''
+        What is needed to show slice z along axis: RGB image and region
+        growing preprocessing; if enabled in the config file, the SAM
+        embedding is computed in advance too.
+        
+        Called by self.volume_prefetcher, also from its background thread.
+        '''
+        img = Image.fromarray(self.volume_display.slice(z, axis)).convert("RGB")
+        image = adjust_image(np.array(img), self.wand_brightness, self.wand_contrast, self.wand_gamma)
+        data = {"image": img, "region_growing": wand.region_growing_preprocessing(image)}
+        if self.slimtag_config["sam"]["prefetch_volume_embeddings"] and self.sam is not None:
+            try:
+                self.sam.precompute(image)
+            except (CancelledError, RuntimeError): # slice shown meanwhile, or no model: embedded when shown
+                pass
+        return data
+
+    def new_volume_prefetcher(self):
+        '''
+        (Re)start self.volume_prefetcher for the slices along self.volume_axis.
+        '''
+        if self.volume_prefetcher is not None:
+            self.volume_prefetcher.close()
+        axis = self.volume_axis
+        self.volume_prefetcher = SlicePrefetcher(lambda z: self.prepare_volume_slice(z, axis), self.volume_display.shape[axis],
+                                                 depth=self.slimtag_config["view"]["volume_prefetch_depth"] if self.is_volume_loaded else 0,
+                                                 cache_size=self.slimtag_config["view"]["volume_prefetch_cache"])
+
+    def set_volume_slider(self, z):
+        '''
+        Move the slice slider (and its label) to z, without loading the slice.
+        '''
+        self.volume_zslider.set(z)
+        self.zlabel_var.set(f"{'xyz'[self.volume_axis]}: {z}")
+
+    def step_volume_slice(self, dz):
+        '''
+        Move dz slices up or down in the volume.
+        '''
+        if not self.is_volume_loaded:
+            return
+        z = min(max(round(self.volume_zslider.get()) + dz, 0), self.volume_display.shape[self.volume_axis]-1)
+        self.set_volume_slider(z)
+        self.set_volume_slice(z)
+
+    def volume_view_center(self):
+        '''
+        Voxel (x, y, z) of the volume at the center of the view.
+        '''
+        row = min(max(int(self.view_y + self.view_h / 2), 0), self.orig_h - 1)
+        col = min(max(int(self.view_x + self.view_w / 2), 0), self.orig_w - 1)
+        return plane_point(self.volume_display.shape, self.volume_axis, round(self.volume_zslider.get()), row, col)
+
+    def set_volume_plane(self, axis, z=None):
+        '''
+        Show the slices of the volume along axis (see VOLUME_PLANES), from
+        slice z (default: the one through the center of the view).
+        '''
+        if not self.is_volume_loaded:
+            return
+        if z is None:
+            z = self.volume_view_center()[axis]
+        reset_view = axis != self.volume_axis
+        self.volume_axis = axis
+        self.canvas_frames["volume"].plane_menu.set([name for name, a in VOLUME_PLANES.items() if a == axis][0])
+        if reset_view:
+            self.volume_display.set_axis(axis)
+            self.new_volume_prefetcher()
+            self.volume_zslider.configure(to=self.volume_display.shape[axis]-1)
+        self.set_volume_slider(z)
+        data = self.volume_prefetcher.get(z)
+        self.load_image(data["image"], mask=self.volume_slice_mask(axis, z), reset_view=reset_view,
+                        preprocessing=data["region_growing"])
+
+    def set_volume_window_preset(self, name):
+        '''
+        Change the intensity window (see slimtag_volume.WINDOW_PRESETS): only
+        the visible slice is converted again.
+        '''
+        if self.volume_display is None:
+            return
+        self.volume_display.set_preset(name)
+        self.volume_prefetcher.invalidate()
+        self.update_ortho_views()
+        self.set_volume_slice(round(self.volume_zslider.get()))
 
     def on_zslider_move(self, z):
         '''
@@ -1379,7 +1830,7 @@ class SegmentationApp(ctk.CTk):
         
         z is already cast to int.
         '''
-        self.zlabel_var.set(f"z: {z}")
+        self.zlabel_var.set(f"{'xyz'[self.volume_axis]}: {z}")
         if self.zslider_preview is not None:
             self.update_zslider_preview(z)
 
@@ -1389,8 +1840,9 @@ class SegmentationApp(ctk.CTk):
         
         z is the slider value, already cast to int.
         '''
-        arr = self.volume_preview[:, :, z]
+        arr = self.volume_display.preview_slice(z, self.volume_axis)
         self.zslider_preview_img = ImageTk.PhotoImage(Image.fromarray(arr))
+        self.zslider_preview.canvas.configure(width=arr.shape[1], height=arr.shape[0])
         self.zslider_preview.canvas.delete("all")
         self.zslider_preview.canvas.create_image(0, 0, anchor="nw", image=self.zslider_preview_img)
 
@@ -1431,8 +1883,7 @@ class SegmentationApp(ctk.CTk):
             self.zslider_preview = ctk.CTkToplevel(self)
             self.zslider_preview.overrideredirect(True) # remove window decorations
             self.zslider_preview.attributes("-topmost", True) # shadow-like appearance
-            self.zslider_preview.canvas = ctk.CTkCanvas(self.zslider_preview, highlightthickness=0,
-                                                        width=self.volume_preview.shape[1], height=self.volume_preview.shape[0])
+            self.zslider_preview.canvas = ctk.CTkCanvas(self.zslider_preview, highlightthickness=0) # sized by update_zslider_preview
             self.zslider_preview.canvas.grid(row=0, column=0, padx=4, pady=4)
             self.zslider_preview.grid_rowconfigure(0, weight=1)
             self.zslider_preview.grid_columnconfigure(0, weight=1)
@@ -1502,7 +1953,7 @@ class SegmentationApp(ctk.CTk):
             always_disabled = [
                 "polygon", "bbox", "bucket",
                 "denoise", "interpolate",
-                "wand_all", "wand_box",
+                "wand_all",
                 "ruler", "area",
                 "custom_1", "custom_2", "custom_3", "custom_4"
             ]
@@ -1598,7 +2049,9 @@ class SegmentationApp(ctk.CTk):
         Saves a copy of the current mask (mask_orig) into the undo_stack.
         '''
         if self.mask_orig is not None:
-            self.undo_stack.append(self.mask_orig.copy())
+            # volume plane and slice the mask belongs to (None for 2D images)
+            z = (self.volume_axis, round(self.volume_zslider.get())) if self.is_volume_loaded else None
+            self.undo_stack.append((z, self.mask_orig.copy()))
             if len(self.undo_stack) > self.slimtag_config["main"]["undo_depth"]:
                 self.undo_stack.pop(0)
 
@@ -1617,7 +2070,13 @@ class SegmentationApp(ctk.CTk):
             return
         
         if self.undo_stack:
-            self.mask_orig = self.undo_stack.pop()
+            z, mask = self.undo_stack.pop()
+            if z is not None and z != (self.volume_axis, round(self.volume_zslider.get())):
+                self.set_volume_plane(*z) # go back to the slice that was changed
+            if mask.shape == self.mask_orig.shape:
+                self.mask_orig[...] = mask
+            else:
+                self.mask_orig = mask
             self.update_lock()
             self.update_display(update_image=False)
     
@@ -1868,7 +2327,7 @@ class SegmentationApp(ctk.CTk):
                 self.mask_locked[self.mask_orig==mid] = True
 
     #%% LOAD & SAVE METHODS
-    def load_image(self, pil_image, mask=None, change_canvas=None, reset_view=True):
+    def load_image(self, pil_image, mask=None, change_canvas=None, reset_view=True, preprocessing=None):
         '''
         Load the current image in memory as self.image_orig and display it.
         
@@ -1880,9 +2339,14 @@ class SegmentationApp(ctk.CTk):
         different volume slices.
         
         If change_canvas is not None, it is a string among keys of self.canvas_frames
+        
+        preprocessing is the region growing preprocessing of the image with
+        the current magic wand adjustments, if already available (e.g. from
+        self.volume_prefetcher); otherwise it is computed in background.
         '''
         self.orig_w, self.orig_h = pil_image.size
         self.image_orig = pil_image
+        self.image_preprocessing = preprocessing
         if mask is None:
             self.mask_orig = np.zeros((self.orig_h, self.orig_w), np.uint8)
             self.mask_locked = np.full(self.mask_orig.shape, False)
@@ -1895,9 +2359,7 @@ class SegmentationApp(ctk.CTk):
 
 
         # Async load of the SAM model to avoid freezed interface
-        if self.thread is None or not self.thread.is_alive():
-            self.thread = threading.Thread(target=self.async_loader, daemon=True)
-            self.thread.start()
+        self.start_async_loader()
 
 
 
@@ -1919,7 +2381,7 @@ class SegmentationApp(ctk.CTk):
         
         self.update_display(update_image=True)
         
-        self.show_preview_frame("image")
+        self.show_preview_frame("ortho" if self.is_volume_loaded else "image")
         self.update_preview_frame()
     
     def open_image(self, path=None, add_mask=True):
@@ -1965,6 +2427,7 @@ class SegmentationApp(ctk.CTk):
         
         # reset masks
         self.clear_all_masks()
+        self.is_volume_loaded = False # a 2D image replaces the volume, if any
         
         img = Image.open(p).convert("RGBA").convert("RGB") # explicit conversion to normalize RGBA images
         
@@ -2101,28 +2564,18 @@ class SegmentationApp(ctk.CTk):
         
         
         if self.is_volume_loaded:
-            with tarfile.open(p, mode="r") as tf:
-                # recover metadata
-                metajson = json.load(tf.extractfile(tf.getmember("meta.json")))
-                labels = sorted([k for k in metajson["labels"].keys() if int(k) <= self.slimtag_config["mask"]["max_masks"]], key=int)
-                for l in labels:
-                    self.mask_labels[int(l)] = metajson["labels"][l]["name"]
-                    self.mask_colors[int(l)] = hex_to_rgb(metajson["labels"][l]["color"])
-                    self.mask_widgets[int(l)] = self.create_mask_widget(int(l))
-                    self.mask_widgets[int(l)].pack(fill="x", expand=True)
-                if len(labels) > 0:
-                    self.change_mask(target_id=int(labels[0]))
-                self.volume_mask = np.zeros(tuple(metajson["shape"]), dtype=np.uint8)
-                for member in tf:
-                    if member.isfile() and member.name.endswith(".png"):
-                        f = tf.extractfile(member)
-                        if f is None:
-                            continue
-                        img = Image.open(io.BytesIO(f.read()))
-                        idx = int(member.name.split(".")[0])
-                        self.volume_mask[..., idx] = np.array(img, dtype=np.uint8)
-            z = round(self.volume_zslider.get())
-            self.mask_orig = self.volume_mask[..., z]
+            metajson, self.volume_mask = read_mask_tar(p)
+            # recover metadata
+            labels = sorted([k for k in metajson["labels"].keys() if int(k) <= self.slimtag_config["mask"]["max_masks"]], key=int)
+            for l in labels:
+                self.mask_labels[int(l)] = metajson["labels"][l]["name"]
+                self.mask_colors[int(l)] = hex_to_rgb(metajson["labels"][l]["color"])
+                self.mask_widgets[int(l)] = self.create_mask_widget(int(l))
+                self.mask_widgets[int(l)].pack(fill="x", expand=True)
+            if len(labels) > 0:
+                self.change_mask(target_id=int(labels[0]))
+            self.volume_mask_plane = None # the slice shown belongs to the previous mask
+            self.mask_orig = self.volume_slice_mask(self.volume_axis, round(self.volume_zslider.get()))
 
         else:
             
@@ -2215,7 +2668,9 @@ class SegmentationApp(ctk.CTk):
             # Save as()
             if self.is_volume_loaded:
                 def_ext = ".tar"
-                ftypes = [("TAR archive of indexed PNGs", ".tar")]
+                ftypes = [("TAR archive of indexed PNGs", ".tar"),
+                          ("NRRD labelmap", "*.nrrd"),
+                          ("NIfTI labelmap", ("*.nii.gz", "*.nii"))]
             else:
                 def_ext = ".png"
                 ftypes = [("PNG (indexed)", "*.png")]
@@ -2243,28 +2698,26 @@ class SegmentationApp(ctk.CTk):
         metadata.add_text("labels", json.dumps(labels))
         
         if self.is_volume_loaded:
-            n_slices = self.volume_mask.shape[2]
-            nd = len(str(n_slices)) # max number of digits, for zero padding in namefiles
-            with tarfile.open(p, mode="w") as tf:
-                metajson = {"shape": list(self.volume_mask.shape),
-                            "labels": {i: {"name": self.mask_labels[i],
-                                           "color": rgb_to_hex(self.mask_colors[i])
-                                           } for i in self.mask_labels.keys()}
-                            }
-                metafile = io.BytesIO(json.dumps(metajson, indent=2).encode("utf-8"))
-                tinfo = tarfile.TarInfo(name="meta.json")
-                tinfo.size = len(metafile.getbuffer())
-                tf.addfile(tarinfo=tinfo, fileobj=metafile)
-                for z in range(n_slices):
-                    if self.volume_mask[..., z].any():
-                        mem_buffer = io.BytesIO()
-                        png_file = Image.fromarray(self.volume_mask[..., z], mode="P")
-                        png_file.putpalette(palette)
-                        png_file.save(mem_buffer, format="PNG", pnginfo=metadata)
-                        mem_buffer.seek(0) # rewind buffer
-                        tinfo = tarfile.TarInfo(name=f"{z:0{nd}d}.png")
-                        tinfo.size = len(mem_buffer.getbuffer())
-                        tf.addfile(tarinfo=tinfo, fileobj=mem_buffer)
+            self.store_volume_slice()
+        
+        # matched on the full extension (e.g. mask.tar.gz is not a NIfTI file)
+        save_labelmap = next((f for ext, f in self._save_labelmap.items() if p.lower().endswith(ext)), None)
+        
+        if self.is_volume_loaded and save_labelmap is not None:
+            # Labelmap with the geometry of the volume, readable by 3D Slicer, ITK-SNAP, nibabel...
+            affine = self.biomedical_data["metadata"].get("affine")
+            if affine is None:
+                affine = np.diag(list(self.biomedical_data["spacing"])[:3] + [1.0])
+            save_labelmap(p, self.volume_mask, affine,
+                          {i: (self.mask_labels[i], self.mask_colors[i]) for i in self.mask_labels.keys()},
+                          level=self.slimtag_config["mask"]["labelmap_compression"])
+        elif self.is_volume_loaded:
+            metajson = {"shape": list(self.volume_mask.shape),
+                        "labels": {i: {"name": self.mask_labels[i],
+                                       "color": rgb_to_hex(self.mask_colors[i])
+                                       } for i in self.mask_labels.keys()}
+                        }
+            write_mask_tar(p, self.volume_mask, metajson, palette, metadata)
         else:
             mask_to_save = Image.fromarray(self.mask_orig, mode="P")
             #mask_to_save = mask_to_save.resize((self.orig_w, self.orig_h), Image.NEAREST) # resize to original (probably not necessary?)
@@ -2276,9 +2729,39 @@ class SegmentationApp(ctk.CTk):
 
 #%% BIOMEDICAL LOAD
 
-    def biomedical_load(self, path=None, add_mask=True):
+    def choose_series_DICOM(self, path):
+        '''
+        Headers of the series to load from the DICOM folder path (see
+        list_series_DICOM): the only one, or the one chosen by the user
+        (None if canceled, or if the folder has no DICOM images).
+        '''
+        self.set_status("loading", "Reading DICOM folder...")
+        series = self._list_series_DICOM(path, index=self._dicom_index)
+        self.set_status("ready", "Ready")
+        
+        if len(series) == 0:
+            MultiButtonDialog(self, message="No DICOM images found in the folder.", buttons=[("OK", None)])
+            return None
+        if len(series) == 1:
+            return next(iter(series.values()))
+        
+        buttons = []
+        for uid, headers in series.items():
+            ds = headers[0]
+            name = str(ds.get("SeriesDescription", "")) or f"Series {ds.get('SeriesNumber', '')}".strip()
+            buttons.append((f"{name} ({ds.get('Modality', '')}, {len(headers)} files)", uid))
+        
+        dialog = MultiButtonDialog(self, message="The folder contains several series. Which one do you want to open?",
+                                   buttons=buttons + [("Cancel", None)])
+        return series.get(dialog.return_value)
+
+    def biomedical_load(self, path=None, add_mask=True, folder=False, series_uid=None):
         '''
         Load a DICOM/NIFTI/NRRD image and define an empty mask on it.
+        
+        With folder=True, a DICOM folder is chosen instead of a file; if it
+        holds more than a series, the user chooses one (otherwise, series_uid
+        selects it, default the largest one).
         '''
     
         if self.modified:
@@ -2297,16 +2780,26 @@ class SegmentationApp(ctk.CTk):
         self.deactivate_tools()
         self.set_controls_state(False)
         
+        series_headers = None # headers of the DICOM series chosen
+        
         # Dialog
         if path is None:
             # Reset path
             self.list_images = None
             self.list_index = 0
             
-            p = filedialog.askopenfilename(filetypes=[("Biomedical data files", ("*.dcm", "*.nrrd", "*.nii"))])
+            if folder:
+                p = filedialog.askdirectory()
+            else:
+                p = filedialog.askopenfilename(filetypes=[("Biomedical data files", ("*.dcm", "*.nrrd", "*.nii"))])
             if not p:
                 return
             
+            if folder:
+                series_headers = self.choose_series_DICOM(p)
+                if series_headers is None:
+                    return
+            
         else:
             p = path
     
@@ -2315,7 +2808,8 @@ class SegmentationApp(ctk.CTk):
         # reset masks
         self.clear_all_masks()
         
-        metadata, spacing, volume = self._load_medical_volume(p)
+        metadata, spacing, volume = self._load_medical_volume(p, series_uid=series_uid, dicom_index=self._dicom_index,
+                                                            headers=series_headers)
         self.biomedical_data["metadata"] = metadata
         self.biomedical_data["spacing"] = spacing
         self.biomedical_data["volume"] = volume
@@ -2333,6 +2827,8 @@ class SegmentationApp(ctk.CTk):
         # print("\nData type:")
         # print(volume.dtype)
         
+        self.volume_axis = 2 # start from axial slices
+        self.canvas_frames["volume"].plane_menu.set("Axial")
         if volume.shape[2] == 1:
             canvas_frame = "default"
             initial_slice = 0
@@ -2345,28 +2841,22 @@ class SegmentationApp(ctk.CTk):
             self.canvas_frames["volume"].slider.configure(to=volume.shape[2]-1)
             self.canvas_frames["volume"].slider.set(initial_slice)
             self.zlabel_var.set(f"z: {initial_slice}")
-            self.volume_mask = np.zeros(volume.shape, dtype=np.uint8)
-            slice_mask = self.volume_mask[..., initial_slice]
-        
-        # normalize, cut intensity peaks
-        # do this also when volume is already uint8
-        arr = volume.astype(np.float32)
-        v_min, v_max = np.percentile(arr, (1, 99))
-        # small check if there are not enough different values (e.g. volumes already representing masks)
-        # to avoid division by zero
-        # done with np.isclose just for additional safety (v_min==v_max should be sufficient)
-        if np.isclose(v_min, v_max):
-            v_min, v_max = 0, 1 # do not change array
-        self.volume_disp = (255 * np.clip((arr - v_min) / (v_max - v_min), 0, 1)).astype(np.uint8)
+            self.volume_mask = SparseVolumeMask(volume.shape)
+            self.volume_mask_plane = None
+            slice_mask = self.volume_slice_mask(2, initial_slice)
         
-        if self.is_volume_loaded:
-            scale = max(self.volume_disp.shape[0], self.volume_disp.shape[1]) / self.slimtag_config["view"]["preview_dim"]
-            new_x = np.linspace(0, self.volume_disp.shape[0]-1, int(self.volume_disp.shape[0] / scale)).astype(np.int32)
-            new_y = np.linspace(0, self.volume_disp.shape[1]-1, int(self.volume_disp.shape[1] / scale)).astype(np.int32)
-            self.volume_preview = self.volume_disp[np.ix_(new_x, new_y)]
+        # normalize, cut intensity peaks (window from the 1st-99th percentiles)
+        # the volume may be memory-mapped (or read lazily) in its native dtype:
+        # it is converted for display one slice at a time
+        self.volume_display = VolumeDisplay(volume,
+                                            cache_size=self.slimtag_config["view"]["volume_slice_cache"],
+                                            preview_dim=self.slimtag_config["view"]["preview_dim"] if self.is_volume_loaded else None,
+                                            rescale=(metadata.get("RescaleSlope", 1.0), metadata.get("RescaleIntercept", 0.0)))
+        self.canvas_frames["volume"].window_menu.set("Auto")
+        self.new_volume_prefetcher()
 
-        img = Image.fromarray(self.volume_disp[..., initial_slice]).convert("RGB")
-        self.load_image(img, mask=slice_mask, change_canvas=canvas_frame)
+        data = self.volume_prefetcher.get(initial_slice)
+        self.load_image(data["image"], mask=slice_mask, change_canvas=canvas_frame, preprocessing=data["region_growing"])
         
         
         self.path_original_image = p
@@ -2382,7 +2872,7 @@ class SegmentationApp(ctk.CTk):
         
         self.update_display(update_image=True)
         
-        self.show_preview_frame("image")
+        self.show_preview_frame("ortho" if self.is_volume_loaded else "image")
         self.update_preview_frame()
         
         if self.list_images is None:
@@ -2454,6 +2944,16 @@ class SegmentationApp(ctk.CTk):
                 return
             return
         
+        if self.tool_active["wand_box"] and check_inside_image:
+            if self.wand_model_menu.get() == "Region growing":
+                MultiButtonDialog(self, message="Box magic wand currently implemented for SAM models only", buttons=[("OK", None)])
+                return
+            elif self.wand_model_menu.get() in self.available_sam_models:
+                self.sam_box_start(e, add=not shift_pressed)
+            else:
+                return
+            return
+        
         if (self.tool_active["brush"] or self.tool_active["eraser"]) and check_inside_image:
             x = int((e.x)*(self.view_w/self.canvas.winfo_width())) + self.view_x
             y = int((e.y)*(self.view_h/self.canvas.winfo_height())) + self.view_y
@@ -2475,6 +2975,8 @@ class SegmentationApp(ctk.CTk):
         self.draw_brush_preview(e)
 
     def on_canvas_left_release(self, e):
+        if self.sam_box is not None:
+            self.sam_box_release(e)
         self.last_brush_pos = None
         self._pan_start = None
         self._drag_counter = 0
@@ -2515,7 +3017,11 @@ class SegmentationApp(ctk.CTk):
                 self.update_preview_frame()
             return
         
-        # Check if the brush is not active (only draggable tool)
+        if self.tool_active["wand_box"]:
+            self.sam_box_drag(e)
+            return
+        
+        # Check if the brush is not active (only draggable tools are brush and box wand)
         # TODO implement other tools
         if not (self.tool_active["brush"] or self.tool_active["eraser"]):
             return
@@ -2957,12 +3463,18 @@ class SegmentationApp(ctk.CTk):
         self.set_status("loading", "SAM computing...")
         
         # image = None, since preprocessing embedded image in model
-        mask = wand.sam_inference(None,
-                                  point=np.array(self.sam_points),
-                                  pt_labels=np.array(self.sam_pt_labels),
-                                  parameters={"threshold": self.wand_threshold},
-                                  model=self.sam,
-                                  multipoint=multipoint)
+        try:
+            mask = wand.sam_inference(None,
+                                      point=np.array(self.sam_points),
+                                      pt_labels=np.array(self.sam_pt_labels),
+                                      parameters={"threshold": self.wand_threshold},
+                                      model=self.sam,
+                                      multipoint=multipoint)
+        except RuntimeError: # SAM worker crashed: drop the points, keep the session alive
+            self.sam_points = []
+            self.sam_pt_labels = []
+            self.set_status("error", "SAM worker stopped (Magic wand > Restart SAM worker)")
+            return
         self.sam_preview[mask & (~self.mask_locked)] = True
         
         if multipoint: # to show preview
@@ -2994,6 +3506,116 @@ class SegmentationApp(ctk.CTk):
         self.mask_locked[self.mask_orig==0] = False
         self.update_display(update_image=False)
 
+    def sam_box_start(self, e, add=True):
+        """
+        Start a box prompt at the clicked point. The box is updated by
+        sam_box_drag and applied by sam_box_release.
+        """
+        if self.image_orig is None or self.active_mask_id is None:
+            return
+        if self.sam_box_decode_id is not None: # a new box replaces a pending one
+            self.after_cancel(self.sam_box_decode_id)
+            self.sam_box_decode_id = None
+        x = int((e.x)*(self.view_w/self.canvas.winfo_width())) + self.view_x
+        y = int((e.y)*(self.view_h/self.canvas.winfo_height())) + self.view_y
+        # as the end point (see sam_box_drag), the box stays within the image
+        x = min(max(x, 0), self.orig_w - 1)
+        y = min(max(y, 0), self.orig_h - 1)
+        self.sam_box = [x, y, x, y]
+        self.sam_box_add = add
+
+    def sam_box_drag(self, e):
+        """
+        Update the box while dragging, and schedule a decode of the preview.
+        
+        The image embedding is already computed, so each decode only runs the
+        SAM mask decoder. Decodes are throttled to the decoder speed: at most
+        one decode is pending, it waits as long as the previous one took (so
+        that the GUI keeps responding), and it always uses the latest box.
+        """
+        if self.sam_box is None:
+            return
+        x = int((e.x)*(self.view_w/self.canvas.winfo_width())) + self.view_x
+        y = int((e.y)*(self.view_h/self.canvas.winfo_height())) + self.view_y
+        self.sam_box[2] = min(max(x, 0), self.orig_w - 1)
+        self.sam_box[3] = min(max(y, 0), self.orig_h - 1)
+        self.display_wand_box()
+        if self.sam_box_decode_id is None:
+            delay = max(1, int(1000 * self.sam_box_decode_time))
+            self.sam_box_decode_id = self.after(delay, self.sam_box_preview)
+
+    def sam_box_preview(self):
+        """
+        Decode the preview of the current box (scheduled by sam_box_drag),
+        or try again later if the image is being embedded.
+        """
+        if self.sam_box_compute() is None:
+            self.sam_box_decode_id = self.after(100, self.sam_box_preview)
+
+    def sam_box_compute(self):
+        """
+        Compute the mask for the current box, and store it in the preview
+        matrix (replacing the previous one).
+        
+        Return True if a mask has been computed, None if the embedding of the
+        image is being computed (see async_loader): the decoder must not run
+        meanwhile.
+        """
+        self.sam_box_decode_id = None
+        if self.sam_box is None or self.sam is None:
+            return False
+        x0, y0, x1, y1 = self.sam_box
+        if abs(x1 - x0) < 2 or abs(y1 - y0) < 2: # degenerate box, nothing to decode
+            return False
+        box = [min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)]
+        # self.lock is held by async_loader while embedding: never wait for it
+        # here (the loader thread may be waiting for the Tk thread)
+        if not self.lock.acquire(blocking=False):
+            return None
+        try:
+            start = time.monotonic()
+            # image = None, since preprocessing embedded image in model
+            mask = wand.sam_inference(None,
+                                      point=None,
+                                      box=box,
+                                      parameters={"threshold": self.wand_threshold},
+                                      model=self.sam)
+        except RuntimeError: # SAM worker crashed: drop the box, keep the session alive
+            self.sam_box = None
+            self.canvas.delete("sam_box")
+            self.set_status("error", "SAM worker stopped (Magic wand > Restart SAM worker)")
+            return False
+        finally:
+            self.lock.release()
+        self.sam_box_decode_time = time.monotonic() - start
+        self.sam_preview = mask & (~self.mask_locked)
+        self.update_display(update_image=False, update_blended=False)
+        return True
+
+    def sam_box_release(self, e):
+        """
+        Decode the final box and apply it (add, or remove with right click or
+        Shift).
+        """
+        if self.sam_box_decode_id is not None:
+            self.after_cancel(self.sam_box_decode_id)
+            self.sam_box_decode_id = None
+        self.set_status("loading", "SAM computing...")
+        computed = self.sam_box_compute()
+        if computed is None: # image being embedded: apply the box when done
+            self.sam_box_decode_id = self.after(100, lambda: self.sam_box_release(e))
+            return
+        failed = self.sam_box is None # sam_box_compute drops the box on SAM errors
+        self.sam_box = None
+        self.canvas.delete("sam_box")
+        if not computed: # click without drag, or SAM error
+            self.sam_apply(cancel=True)
+            if not failed:
+                self.set_status("ready", "Ready")
+            return
+        self.sam_apply(add=self.sam_box_add)
+        self.set_status("ready", "Ready")
+
     def sam_apply_release(self):
         """
         Event bound to the release of the "Multipoint" key
@@ -3013,9 +3635,18 @@ class SegmentationApp(ctk.CTk):
             # reload SAM image
             # deactivate tools
             self.deactivate_tools()
-            if self.thread is None or not self.thread.is_alive():
-                self.thread = threading.Thread(target=self.async_loader, daemon=True)
-                self.thread.start()
+            self.wand_adjustments_changed()
+
+    def wand_adjustments_changed(self):
+        '''
+        Recompute the magic wand preprocessing after a change of brightness,
+        contrast or shadows (prepared volume slices are dropped too).
+        '''
+        self.image_preprocessing = None
+        if self.volume_prefetcher is not None:
+            self.volume_prefetcher.invalidate()
+        if self.image_orig is not None:
+            self.start_async_loader()
              
     # NON-NEURAL METHODS
     # SCIPY REGION GROWING
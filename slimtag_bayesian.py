@@ -7,65 +7,243 @@ Created on Thu Jun  4 08:58:50 2026
 
 #### Libraries
 import os
+import copy
+import pickle
+import collections
 import numpy as np
+from scipy import ndimage
 from PIL import Image, ImageDraw
 import threading
+import hashlib
+import shutil
+import tempfile
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
 
-from slimtag_utils import adjust_image, MultiButtonDialog
+from slimtag_image_utils import adjust_image
 import slimtag_wand as wand
 
-import tkinter as tk
-from tkinter import filedialog, font
-import customtkinter as ctk
-
 import json
+import time
+import argparse
+import sys
 
-from skopt import gp_minimize
+from skopt import Optimizer
 from skopt.space import Real
+from skopt.utils import cook_estimator, normalize_dimensions
 
-#### Main class - Bayesian optimizer
-class BayesianOptimization():
+#### Evaluation of a single image
+
+def _nbytes(obj):
+    """
+    Memory used by the numpy arrays in obj (possibly nested in dicts, lists
+    and tuples).
+    """
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, dict):
+        return sum(_nbytes(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(_nbytes(v) for v in obj)
+    return 0
+
+class PreprocessingCache():
+    """
+    LRU cache of adjusted images and their preprocessing, keyed by
+    (image index, brightness, contrast, gamma), holding at most max_size MB.
     
-    def __init__(self, image_folder, model_inference, model_preprocessing, mask_folder=None,
-                 parent=None, progress_callback=None):
+    Across Bayesian iterations the same adjustments come back often (always,
+    in split search), and then neither adjust_image nor the model
+    preprocessing (Sobel planes, SAM embedding) have to be computed again.
+    """
+    def __init__(self, max_size=2048):
+        self.max_bytes = max_size * 2**20
+        self._data = collections.OrderedDict()
+        self._size = 0
+    
+    def get(self, key):
+        if key not in self._data:
+            return None
+        self._data.move_to_end(key)
+        return self._data[key][0]
+    
+    def put(self, key, value):
+        size = _nbytes(value)
+        if key in self._data or size > self.max_bytes:
+            return
+        self._data[key] = (value, size)
+        self._size += size
+        while self._size > self.max_bytes:
+            _, (_, old_size) = self._data.popitem(last=False)
+            self._size -= old_size
+
+def preprocess_image(image, idx, param_dict, model_preprocessing, cache=None):
+    """
+    Adjust the idx-th image with the parameters in param_dict and compute its
+    preprocessing, reusing cached results if possible.
+    
+    Return the pair (adjusted image, preprocessing).
+    """
+    key = (idx, param_dict["brightness"], param_dict["contrast"], param_dict["gamma"])
+    if cache is not None:
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+    img = adjust_image(image,
+                       brightness=param_dict["brightness"],
+                       contrast=param_dict["contrast"],
+                       shadows=param_dict["gamma"])
+    preprocess_info = model_preprocessing(img)
+    # None means that there is nothing to reuse (e.g. a SAM model without
+    # embedding keys): the preprocessing must run again next time
+    if cache is not None and preprocess_info is not None:
+        cache.put(key, (img, preprocess_info))
+    return img, preprocess_info
+
+class GroundTruth():
+    """
+    Ground truth of a label in an image, computed once from the indexed mask
+    and reused by all the evaluations: the boolean mask cropped to its
+    bounding box (crop, bbox = (y0, y1, x0, x1)) and its area.
+    """
+    def __init__(self, mask, mask_id):
+        rows = np.flatnonzero(np.any(mask == mask_id, axis=1))
+        if len(rows) == 0:
+            raise ValueError("Provided mask does not contain the label")
+        y0, y1 = rows[0], rows[-1] + 1
+        band = mask[y0:y1] == mask_id
+        cols = np.flatnonzero(np.any(band, axis=0))
+        x0, x1 = cols[0], cols[-1] + 1
+        self.bbox = (y0, y1, x0, x1)
+        self.crop = np.ascontiguousarray(band[:, x0:x1])
+        self.area = np.count_nonzero(self.crop)
+        self._seeds = (None, np.zeros((0, 2), dtype=int)) # (seed, coordinates)
+    
+    def seeds(self, n_points, seed=0, n_strata=4):
+        """
+        n_points (x, y) coordinates inside the mask (or all of them, if the
+        mask is smaller), deterministic for a given seed.
+        
+        The mask pixels are split by distance from the boundary in n_strata
+        bands of equal size, and points are drawn from the bands in turn,
+        starting from the innermost one: the seeds cover both the interior
+        and the border of the region, and any prefix of them (as used with
+        fewer points) is stratified too.
+        """
+        n_points = min(n_points, self.area)
+        if self._seeds[0] != seed or len(self._seeds[1]) < n_points:
+            # distance from the background (the bounding box is padded, so
+            # that the region also has a border where it touches the box)
+            dist = ndimage.distance_transform_edt(np.pad(self.crop, 1))[1:-1, 1:-1]
+            ys, xs = np.nonzero(self.crop)
+            bands = np.array_split(np.argsort(dist[ys, xs], kind="stable"), n_strata)
+            rng = np.random.RandomState(seed)
+            bands = [rng.permutation(band) for band in bands[::-1] if len(band) > 0]
+            picked = []
+            for k in range(max(len(band) for band in bands)):
+                picked += [band[k] for band in bands if k < len(band)][:n_points - len(picked)]
+                if len(picked) == n_points:
+                    break
+            y0, _, x0, _ = self.bbox
+            self._seeds = (seed, np.stack([xs[picked] + x0, ys[picked] + y0], axis=1))
+        return self._seeds[1][:n_points]
+    
+    def iou(self, predictions):
+        """
+        IoU of each predicted boolean mask (or None) with the ground truth.
+        
+        The intersection is computed only inside the bounding box of the
+        ground truth, for all the predictions at once, and the union from the
+        areas: |A u B| = |A| + |B| - |A n B|.
+        """
+        y0, y1, x0, x1 = self.bbox
+        valid = [k for k, pred in enumerate(predictions) if pred is not None]
+        ious = np.zeros(len(predictions))
+        if not valid:
+            return ious
+        crops = np.stack([predictions[k][y0:y1, x0:x1] for k in valid])
+        intersection = np.count_nonzero(crops & self.crop, axis=(1, 2))
+        areas = np.array([np.count_nonzero(predictions[k]) for k in valid])
+        ious[valid] = intersection / (self.area + areas - intersection) # area > 0
+        return ious
+
+def evaluate_image(image, idx, gt, points, param_dict, model_inference, model_preprocessing, cache=None):
+    """
+    Adjust the idx-th image with the parameters in param_dict, then compute
+    the IoU between the ground truth gt (a GroundTruth) and the mask predicted
+    from each of the points. Return the list of IoUs.
+    """
+    img, preprocess_info = preprocess_image(image, idx, param_dict, model_preprocessing, cache=cache)
+    # compute inference on each point, then score them together
+    predictions = [model_inference(img, point, param_dict, preprocessing=preprocess_info)
+                   for point in points]
+    return gt.iou(predictions).tolist()
+
+#### Reference dataset
+
+class ReferenceDataset():
+    """
+    Image/mask pairs of a folder of reference annotations, decoded lazily.
+    
+    Pairs are matched by name (<name>.png|jpg|jpeg and <name>_mask.png), and
+    only the mask headers are read at creation, to get the label names
+    (label_list). Images and masks are decoded on first access and kept in a
+    LRU cache of at most cache_size MB.
+    
+    If mmap_folder is given, decoded arrays are also saved there as .npy files
+    and then memory-mapped: later accesses (from any process, or in a later
+    session) skip the decoding, and the OS page cache keeps them in memory
+    only as long as there is room.
+    
+    If max_images is given, a subset of at most max_images pairs is kept,
+    stratified by the set of labels present in each mask, so that rare label
+    combinations are still represented.
+    """
+    valid_ext = {".jpg", ".jpeg", ".png"}
+    
+    def __init__(self, image_folder, mask_folder=None, cache_size=1024, mmap_folder=None,
+                 max_images=None, seed=0):
         self.image_folder = image_folder
         self.mask_folder = mask_folder if mask_folder is not None else image_folder
-        
-        self.model_inference = model_inference
-        self.model_preprocessing = model_preprocessing
-        
-        self.parent = parent # when BayesianOptimization is called from a tk window, to allow communication
-        if self.parent is not None:
-            self.parent.opt_interface = {} # to store variables for parent (and reset if already present)
-            self.parent.opt_interface["tot_calls"] = 0
-            self.parent.opt_interface["current"] = 0
-            
-        self.progress_callback = progress_callback
-        
-        # Load images and masks
-        self.image_list, self.mask_list, self.label_list = self.load_folder()
-        
-        
-        
-    def load_folder(self):
-        list_image_names = os.listdir(self.image_folder)
-        list_mask_names = os.listdir(self.mask_folder)
-        
-        # Selection
-        valid_ext = {".jpg", ".jpeg", ".png"}
-        
+        self.cache_size = cache_size
+        self.mmap_folder = mmap_folder
+        self.image_paths, self.mask_paths, self.label_list = self._index()
+        if max_images is not None and 0 < max_images < len(self.image_paths):
+            keep = self.stratified_indices(max_images, seed=seed)
+            self.image_paths = [self.image_paths[i] for i in keep]
+            self.mask_paths = [self.mask_paths[i] for i in keep]
+            self.label_list = [self.label_list[i] for i in keep]
+        self._init_cache()
+    
+    def _init_cache(self):
+        self._lock = threading.Lock()
+        self._cache = collections.OrderedDict() # (kind, idx) -> array, LRU order
+        self._cache_bytes = 0
+    
+    def __getstate__(self): # for process pool workers: do not copy the cache
+        state = self.__dict__.copy()
+        for key in ["_lock", "_cache", "_cache_bytes"]:
+            del state[key]
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_cache()
+    
+    def __len__(self):
+        return len(self.image_paths)
+    
+    def _index(self):
         images = {}
         masks = {}
-        
-        for fname in list_image_names:
+        for fname in os.listdir(self.image_folder):
             stem, ext = os.path.splitext(fname)
-            if ext.lower() not in valid_ext:
+            if ext.lower() not in self.valid_ext:
                 continue
             images[stem] = fname
-
-        for fname in list_mask_names:
+        for fname in os.listdir(self.mask_folder):
             stem, ext = os.path.splitext(fname)
-            if ext.lower() not in valid_ext:
+            if ext.lower() not in self.valid_ext:
                 continue
             if ext == ".png" and stem.endswith("_mask"):
                 base_name = stem[:-5]
@@ -76,37 +254,297 @@ class BayesianOptimization():
         if len(common_names) == 0:
             raise RuntimeError("empty list of images/masks pairs in folder")
         
-        image_list = []
-        mask_list = []
+        image_paths = []
+        mask_paths = []
         label_list = []
-        
         for name in common_names:
-            image_path = os.path.join(self.image_folder, images[name])
-            mask_path = os.path.join(self.mask_folder, masks[name])
-            image_list.append(np.array(Image.open(image_path).convert("RGB")))
-            mask = Image.open(mask_path)
-            mask_list.append(np.array(mask.convert("P")))
+            image_paths.append(os.path.join(self.image_folder, images[name]))
+            mask_paths.append(os.path.join(self.mask_folder, masks[name]))
+            with Image.open(mask_paths[-1]) as mask:
+                # SLImTAG writes labels before the pixel data: info has them
+                # without decoding the image (text would decode it)
+                labels = mask.info.get("labels")
+                if labels is None:
+                    labels = mask.text.get("labels")
             try:
-                names_json = json.loads(mask.text["labels"])
+                names_json = json.loads(labels)
                 names = {int(l): names_json[l] for l in names_json.keys()}
-            except KeyError:
+            except (TypeError, ValueError):
                 names = {}
             label_list.append(names)
-        return image_list, mask_list, label_list
+        return image_paths, mask_paths, label_list
+    
+    def fingerprint(self):
+        """
+        Digest identifying the dataset: names and sizes of the image/mask
+        files (not their folders, so that a copied dataset is still the same).
+        """
+        h = hashlib.blake2b(digest_size=16)
+        for image_path, mask_path in zip(self.image_paths, self.mask_paths):
+            for path in [image_path, mask_path]:
+                h.update(f"{os.path.basename(path)}|{os.path.getsize(path)}\n".encode())
+        return h.hexdigest()
+    
+    def stratified_indices(self, n, seed=0):
+        """
+        Indices of n pairs, drawn from each group of masks with the same set
+        of label names proportionally to the group size (at least one per
+        group, as long as n allows it). Deterministic for a given seed.
+        """
+        rng = np.random.RandomState(seed)
+        groups = collections.defaultdict(list)
+        for idx, names in enumerate(self.label_list):
+            groups[tuple(sorted(v.lower() for v in names.values()))].append(idx)
+        groups = [rng.permutation(members).tolist() for _, members in sorted(groups.items())]
+        sizes = np.array([len(g) for g in groups])
+        quota = sizes * n / len(self)
+        # one element per group (the largest groups, if n is smaller than the
+        # number of groups), then one at a time to the group furthest below
+        # its proportional quota
+        counts = np.zeros(len(groups), dtype=int)
+        counts[np.argsort(-sizes, kind="stable")[:n]] = 1
+        while counts.sum() < n:
+            deficit = np.where(counts < sizes, quota - counts, -np.inf)
+            counts[np.argmax(deficit)] += 1
+        return sorted(sum([g[:c] for g, c in zip(groups, counts)], []))
+    
+    def image(self, idx):
+        """
+        idx-th image, as a numpy array (H, W, 3) with dtype uint8.
+        """
+        return self._get("image", idx)
+    
+    def mask(self, idx):
+        """
+        idx-th mask, as a numpy array (H, W) of label indices.
+        """
+        return self._get("mask", idx)
     
+    def _get(self, kind, idx):
+        with self._lock:
+            if (kind, idx) in self._cache:
+                self._cache.move_to_end((kind, idx))
+                return self._cache[(kind, idx)]
+        path = self.image_paths[idx] if kind == "image" else self.mask_paths[idx]
+        if self.mmap_folder is not None:
+            return self._get_mmap(kind, path)
+        arr = self._decode(kind, path)
+        arr.flags.writeable = False # shared by all callers
+        with self._lock:
+            if (kind, idx) not in self._cache and arr.nbytes <= self.cache_size * 2**20:
+                self._cache[(kind, idx)] = arr
+                self._cache_bytes += arr.nbytes
+                while self._cache_bytes > self.cache_size * 2**20:
+                    _, old = self._cache.popitem(last=False)
+                    self._cache_bytes -= old.nbytes
+        return arr
+    
+    @staticmethod
+    def _decode(kind, path):
+        with Image.open(path) as img:
+            return np.array(img.convert("RGB" if kind == "image" else "P"))
+    
+    def _get_mmap(self, kind, path):
+        """
+        Memory-mapped decoded array, decoding and saving it first if needed.
+        Files are named after path, size and modification time, so that they
+        are never stale.
+        """
+        stat = os.stat(path)
+        key = f"{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}|{kind}"
+        fname = os.path.join(self.mmap_folder, hashlib.blake2b(key.encode(), digest_size=16).hexdigest() + ".npy")
+        if not os.path.exists(fname):
+            os.makedirs(self.mmap_folder, exist_ok=True)
+            # write to a temporary file first: other processes may be reading
+            fd, tmp = tempfile.mkstemp(dir=self.mmap_folder, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, self._decode(kind, path))
+            os.replace(tmp, fname)
+        return np.load(fname, mmap_mode="r")
 
-    def sample(self, mask, n_points):
+#### Evaluation history
+
+class EvaluationLog():
+    """
+    Append-only log of the evaluations of BayesianOptimization, as a JSON
+    lines file: one record {"key", "x", "score", "fidelity"} per evaluated
+    parameter vector, written (and flushed) as soon as it is available.
+    
+    key identifies the search (dataset, model, label, search space, ...):
+    records with the same key are comparable, so an interrupted or completed
+    search can be resumed or extended from them. Several searches (and
+    several processes) can share the same file; truncated lines (e.g. after a
+    crash) are ignored.
+    """
+    def __init__(self, path):
+        self.path = os.path.abspath(os.path.expanduser(path))
+    
+    @staticmethod
+    def make_key(**kwargs):
+        return hashlib.blake2b(json.dumps(kwargs, sort_keys=True).encode(), digest_size=16).hexdigest()
+    
+    def load(self, key):
         """
-        Given a boolean numpy array mask, return n_points pairs (x,y)
-        chosen randomly among the ones with mask[y, x] == True
+        Lists of parameter vectors, scores and fidelities logged with key.
         """
-        ys, xs = np.where(mask)
-        if len(xs) == 0: # this should not happen given the checks in objective()
-            raise ValueError("Provided mask has only False values")
-        coords = np.stack([xs, ys], axis=1)
-        n_points = min(n_points, len(coords)) # in case there are too few points with label
-        idx = np.random.choice(len(coords), size=n_points, replace=False)
-        return coords[idx]
+        xs, scores, fidelity = [], [], []
+        if not os.path.exists(self.path):
+            return xs, scores, fidelity
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError: # truncated line
+                    continue
+                if record.get("key") == key:
+                    xs.append(record["x"])
+                    scores.append(record["score"])
+                    fidelity.append(record.get("fidelity", 1.0))
+        return xs, scores, fidelity
+    
+    def append(self, key, xs, scores, fidelity):
+        lines = "".join(json.dumps({"key": key, "x": [float(v) for v in x], "score": float(score),
+                                    "fidelity": float(f), "time": time.time()}) + "\n"
+                        for x, score, f in zip(xs, scores, fidelity))
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # a single write in append mode, so that concurrent writers do not interleave
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(lines)
+            f.flush()
+            os.fsync(f.fileno())
+
+#### Process pool workers
+# Each worker gets a copy of the dataset index and decodes the images it is
+# given; during the optimization decoded arrays are shared among the workers
+# through memory-mapped files (see ReferenceDataset).
+
+_worker_data = {}
+
+def _worker_init(dataset, model_inference, model_preprocessing, cache_size):
+    _worker_data["dataset"] = dataset
+    _worker_data["model_inference"] = model_inference
+    _worker_data["model_preprocessing"] = model_preprocessing
+    _worker_data["cache"] = PreprocessingCache(cache_size)
+    _worker_data["ground_truth"] = {}
+
+def _worker_evaluate(idx, mask_id, points, param_dict):
+    dataset = _worker_data["dataset"]
+    ground_truth = _worker_data["ground_truth"]
+    if (idx, mask_id) not in ground_truth:
+        ground_truth[(idx, mask_id)] = GroundTruth(dataset.mask(idx), mask_id)
+    return evaluate_image(dataset.image(idx), idx,
+                          ground_truth[(idx, mask_id)],
+                          points, param_dict,
+                          _worker_data["model_inference"],
+                          _worker_data["model_preprocessing"],
+                          cache=_worker_data["cache"])
+
+#### Main class - Bayesian optimizer
+class BayesianOptimization():
+    """
+    Optimize image adjustments and magic wand parameters on a folder of
+    reference images and masks.
+    
+    If n_workers > 1, images are evaluated in parallel by a pool of processes
+    (n_workers = 0 means one per CPU core), and batch_size parameter vectors
+    are proposed and evaluated together at each step. Parallel evaluation
+    requires picklable (i.e. module-level) model functions, such as the region
+    growing ones: otherwise (e.g. SAM, whose model lives in the main app) the
+    evaluation is serial.
+    
+    Adjusted images and their preprocessing are cached (cache_size MB, split
+    among the workers), see PreprocessingCache. Reference images are decoded
+    lazily, see ReferenceDataset (dataset_options are passed to it).
+    
+    If halving_eta > 1, after the initial points the candidates are selected
+    by successive halving (see optimize). If patience > 0, the optimization
+    stops when the best score has not improved by more than tol in the last
+    patience full evaluations.
+    
+    If evaluation_log (a file path) is given, every evaluation is appended to
+    it (see EvaluationLog), and optimize starts from the evaluations already
+    logged for the same dataset, model (model_name), label and search: an
+    interrupted search resumes where it stopped, and a completed one is not
+    computed again.
+    """
+    def __init__(self, image_folder, model_inference, model_preprocessing, mask_folder=None,
+                 progress_callback=None, n_workers=1, batch_size=1, cache_size=2048,
+                 dataset_options=None, halving_eta=0, halving_rungs=2, patience=0, tol=1e-3,
+                 evaluation_log=None, model_name=None, seed=0):
+        self.image_folder = image_folder
+        self.mask_folder = mask_folder if mask_folder is not None else image_folder
+        
+        self.model_inference = model_inference
+        self.model_preprocessing = model_preprocessing
+        
+        self.n_workers = n_workers if n_workers > 0 else os.cpu_count()
+        if self.n_workers > 1:
+            try:
+                pickle.dumps((model_inference, model_preprocessing))
+            except (pickle.PicklingError, AttributeError, TypeError):
+                self.n_workers = 1 # e.g. lambdas bound to the SAM model
+        self.batch_size = max(1, batch_size)
+        self._executor = None # process pool, alive only during optimize()
+        self.cache_size = cache_size
+        self.cache = PreprocessingCache(cache_size) # used by serial evaluation
+        self.halving_eta = halving_eta
+        self.halving_rungs = max(1, halving_rungs)
+        self.patience = patience
+        self.tol = tol
+        self.evaluation_log = EvaluationLog(evaluation_log) if evaluation_log else None
+        self.model_name = model_name
+        self.seed = seed # for the seed points of each image
+        
+        # progress_callback(current, total) is called after each evaluation,
+        # from the thread running optimize (a GUI must forward it to its own
+        # thread, e.g. with after)
+        self.progress_callback = progress_callback
+        self.progress = {"current": 0, "total": 0}
+        
+        # Index images and masks (decoded on demand)
+        self.dataset = ReferenceDataset(self.image_folder, self.mask_folder, **(dataset_options or {}))
+        self.label_list = self.dataset.label_list
+        self._ground_truth = {} # (idx, mask_id) -> GroundTruth
+
+    def seed_points(self, idx, mask_id, n_points):
+        """
+        n_points seed points (x, y) inside label mask_id of the idx-th mask.
+        
+        Seeds depend only on self.seed, on the image name and on the label
+        (see GroundTruth.seeds), so every candidate is scored on the same
+        points: the objective is not noisier than needed, and scores are
+        comparable across runs.
+        """
+        name = os.path.basename(self.dataset.image_paths[idx])
+        digest = hashlib.blake2b(f"{self.seed}|{name}|{mask_id}".encode(), digest_size=4).digest()
+        return self.ground_truth(idx, mask_id).seeds(n_points, seed=int.from_bytes(digest, "little"))
+
+    def ground_truth(self, idx, mask_id):
+        """
+        GroundTruth of label mask_id in the idx-th mask (computed once).
+        """
+        if (idx, mask_id) not in self._ground_truth:
+            self._ground_truth[(idx, mask_id)] = GroundTruth(self.dataset.mask(idx), mask_id)
+        return self._ground_truth[(idx, mask_id)]
+
+    def mask_id(self, idx, mask_label):
+        """
+        Index of mask_label (a name, or an int index) in the idx-th mask, or
+        None if the label is not present.
+        """
+        label_dict = self.label_list[idx]
+        if isinstance(mask_label, str):
+            try:
+                return min([k for k, v in label_dict.items() if v.lower() == mask_label.lower()])
+            except ValueError:
+                return None
+        else: # mask_label is int
+            return mask_label if mask_label in label_dict.keys() else None
+
+    def _progress(self, n=1):
+        self.progress["current"] += n
+        if self.progress_callback:
+            self.progress_callback(self.progress["current"], self.progress["total"])
 
     def objective(self, parameters, mask_label, n_points=10):
         """
@@ -117,424 +555,253 @@ class BayesianOptimization():
         chosen points inside the mask corresponding to mask_label, and the
         average IoU is returned.
         """
-        # apply adjustments given by parameters
+        return self.objective_batch([parameters], mask_label, n_points=n_points)[0]
+
+    def objective_batch(self, parameters_list, mask_label, n_points=10, indices=None):
+        """
+        Same as objective, for a list of parameter vectors: return the list of
+        average IoUs. With a process pool, all the (parameters, image) pairs
+        are evaluated concurrently.
+        
+        If indices is given, only those images are evaluated.
+        """
         # here we assume: parameters[0] = brightness, parameters[1] = contrast,
         # parameters[2] = gamma, all ranging from -100 to 100
         # parameters[3] = wand_threshold, parameters[4] = edge_grad, both from 0.0 to 1.0
-        param_dict = dict(zip(["brightness", "contrast", "gamma", "threshold", "grad_edge"], parameters))
-        image_list = [adjust_image(img,
-                                   brightness=param_dict["brightness"],
-                                   contrast=param_dict["contrast"],
-                                   shadows=param_dict["gamma"])
-                      for img in self.image_list
-                      ]
-        ious = [] # initialize empty list of IoUs
-        # evaluate all the images
-        for idx, img in enumerate(image_list):
-            
-            label_dict = self.label_list[idx]
-            if isinstance(mask_label, str):
-                try:
-                    mask_id = min([k for k, v in label_dict.items() if v.lower() == mask_label.lower()])
-                except ValueError:
-                    mask_id = None
-            else: # mask_label is int
-                mask_id = mask_label if mask_label in label_dict.keys() else None
-            
-            if mask_id is None: # skip image if label is not present in image
-                continue
-            
-            preprocess_info = self.model_preprocessing(img)
-            mask = (self.mask_list[idx] == mask_id)
-            points = self.sample(mask, n_points) # define a point list on mask
-            
-            for point in points:
-                # compute inference on each point
-                inference_mask = self.model_inference(img, point, param_dict, preprocessing=preprocess_info)
-                
-                if inference_mask is None: # just a safeguard
-                    iou = 0.0
-                else:
-                    gt = mask.astype(np.uint8)
-                    pred = inference_mask.astype(np.uint8)
-                    
-                    intersection = np.logical_and(gt, pred).sum()
-                    union = np.logical_or(gt, pred).sum()
-                    
-                    if union == 0:
-                        iou = 0.0
-                    else:
-                        iou = intersection / union
-                ious.append(iou)
-                
-        if self.parent is not None:
-            self.parent.opt_interface["current"] += 1
-            if self.progress_callback:
-                self.parent.after(0, self.progress_callback)
-        
-        return np.mean(ious)
+        # adjustments are rounded as in the main app, which also makes cached
+        # preprocessing reusable
+        param_dicts = []
+        for parameters in parameters_list:
+            param_dict = dict(zip(["brightness", "contrast", "gamma", "threshold", "grad_edge"], parameters))
+            for adj in ["brightness", "contrast", "gamma"]:
+                param_dict[adj] = int(round(param_dict[adj]))
+            param_dicts.append(param_dict)
+        # images with the label, and their seed points
+        tasks = []
+        for param_dict in param_dicts:
+            tasks.append([])
+            for idx in (range(len(self.dataset)) if indices is None else indices):
+                mask_id = self.mask_id(idx, mask_label)
+                if mask_id is None: # skip image if label is not present in image
+                    continue
+                points = self.seed_points(idx, mask_id, n_points) # define a point list on mask
+                tasks[-1].append((idx, mask_id, points, param_dict))
+        
+        scores = []
+        if self._executor is None:
+            for param_tasks in tasks:
+                ious = []
+                for idx, mask_id, points, param_dict in param_tasks:
+                    ious += evaluate_image(self.dataset.image(idx), idx, self.ground_truth(idx, mask_id),
+                                           points, param_dict,
+                                           self.model_inference, self.model_preprocessing,
+                                           cache=self.cache)
+                scores.append(np.mean(ious))
+        else:
+            futures = [[self._executor.submit(_worker_evaluate, *task) for task in param_tasks]
+                       for param_tasks in tasks]
+            for param_futures in futures:
+                scores.append(np.mean(sum([f.result() for f in param_futures], [])))
+        return scores
 
-    def optimize(self, mask_label, max_threshold=0.3, initial_points=10, maxiter=20, n_points=10):
+    def _successive_halving(self, xs, fixed, mask_label, n_points, subset):
+        """
+        Evaluate the candidates xs with successive halving: at each rung the
+        candidates are scored on a larger subset of images and seeds, and only
+        the best 1/eta of them are promoted to the next rung; the last rung is
+        the full evaluation.
+        
+        subset is a random permutation of the images with the label: rung
+        subsets are its prefixes, so each rung contains the previous ones.
+        Return the scores and the fraction of the data each one is based on.
+        """
+        eta = self.halving_eta
+        scores = [None] * len(xs)
+        fidelity = [None] * len(xs)
+        alive = list(range(len(xs)))
+        for rung in range(self.halving_rungs):
+            frac = float(eta) ** (rung - self.halving_rungs + 1)
+            if rung == self.halving_rungs - 1:
+                indices, rung_points = None, n_points # full evaluation
+            else:
+                indices = sorted(subset[:max(1, int(np.ceil(frac * len(subset))))])
+                rung_points = max(1, int(np.ceil(frac * n_points)))
+            rung_scores = self.objective_batch([fixed + list(xs[k]) for k in alive], mask_label,
+                                               n_points=rung_points, indices=indices)
+            for k, score in zip(alive, rung_scores):
+                scores[k], fidelity[k] = score, frac
+            # promote the best ones
+            keep = max(1, int(np.ceil(len(alive) / eta)))
+            alive = [alive[k] for k in np.argsort(rung_scores)[::-1][:keep]]
+        return scores, fidelity
+
+    def _plateau(self, best_so_far, fidelity):
+        """
+        True if the best score has not improved by more than tol in the last
+        patience full evaluations (partial rung evaluations are not counted).
+        """
+        best_so_far = [b for b, f in zip(best_so_far, fidelity) if f == 1.0]
+        if self.patience <= 0 or len(best_so_far) <= self.patience:
+            return False
+        return best_so_far[-1] - best_so_far[-1 - self.patience] <= self.tol
+
+    def _start_pool(self):
+        """
+        Start the process pool. Workers share decoded arrays through the
+        dataset memory-mapped cache; if the dataset has none, a temporary one
+        is used. Return its folder (or None), to be removed by _stop_pool.
+        """
+        dataset = copy.copy(self.dataset)
+        dataset.cache_size = self.dataset.cache_size // self.n_workers
+        tmp_folder = None
+        if dataset.mmap_folder is None:
+            tmp_folder = dataset.mmap_folder = tempfile.mkdtemp(prefix="slimtag_")
+        # spawn: never fork a process with Tk (and possibly torch) state
+        self._executor = ProcessPoolExecutor(max_workers=self.n_workers,
+                                             mp_context=mp.get_context("spawn"),
+                                             initializer=_worker_init,
+                                             initargs=(dataset,
+                                                       self.model_inference, self.model_preprocessing,
+                                                       self.cache_size // self.n_workers))
+        return tmp_folder
+
+    def _stop_pool(self, tmp_folder):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+        if tmp_folder is not None:
+            shutil.rmtree(tmp_folder, ignore_errors=True)
+
+    def optimize(self, mask_label, max_threshold=0.3, initial_points=10, maxiter=20, n_points=10,
+                 fixed_adjustments=None):
+        """
+        Search the parameters maximizing the average IoU for mask_label.
+        
+        If fixed_adjustments is a dict with keys "brightness", "contrast" and
+        "shadows", only the wand parameters (threshold, grad_edge) are searched
+        ("split" search): the preprocessing of each image is then computed once
+        and reused by all the iterations.
         
-        space = [
+        With successive halving, each step proposes batch_size * eta^(rungs-1)
+        candidates and only batch_size of them are evaluated on all the images
+        and seeds (see _successive_halving). All the candidates count in the
+        initial_points + maxiter budget.
+        """
+        adjustments_space = [
             Real(-100, 100, name="brightness"),
             Real(-80, 80, name="contrast"),
             Real(-100, 100, name="shadows"),
+        ]
+        wand_space = [
             Real(0.01, max_threshold, name="threshold"),
             Real(0.01, 0.9, name="grad_edge"),
         ]
-        
-        def objective_wrapper(parameters):
-            return -self.objective(parameters, mask_label=mask_label, n_points=n_points)
-        
-        if self.parent is not None:
-            self.parent.opt_interface["tot_calls"] = initial_points + maxiter
-            self.parent.opt_interface["current"] = 0
+        if fixed_adjustments is None:
+            space = adjustments_space + wand_space
+            fixed = []
+        else:
+            space = wand_space
+            fixed = [fixed_adjustments[dim.name] for dim in adjustments_space]
+        
+        n_calls = initial_points + maxiter
+        self.progress = {"current": 0, "total": n_calls}
+        
+        # previous evaluations of the same search
+        if self.evaluation_log is not None:
+            log_key = EvaluationLog.make_key(dataset=self.dataset.fingerprint(),
+                                             model=self.model_name,
+                                             label=mask_label.lower() if isinstance(mask_label, str) else mask_label,
+                                             n_points=n_points,
+                                             seed=self.seed,
+                                             space=[(dim.name, dim.low, dim.high) for dim in space],
+                                             fixed=fixed,
+                                             halving=[self.halving_eta, self.halving_rungs])
+            history = self.evaluation_log.load(log_key)
+        else:
+            history = ([], [], [])
 
-        results = gp_minimize(
-            func=objective_wrapper,
+        # same setup as gp_minimize, but with an ask/tell loop so that several
+        # parameter vectors can be proposed at once (constant liar strategy)
+        rng = np.random.RandomState(42)
+        optimizer = Optimizer(
             dimensions=space,
-            n_calls=initial_points+maxiter,
+            base_estimator=cook_estimator("GP", space=normalize_dimensions(space),
+                                          random_state=rng.randint(0, np.iinfo(np.int32).max),
+                                          noise="gaussian"),
             n_initial_points=initial_points,
             #acq_func="LCB", # more stable for noisy function
             initial_point_generator="lhs",
-            random_state=42
+            acq_optimizer="lbfgs",
+            random_state=rng
         )
-        
-        # Extract results
-        best_params = dict(zip([dim.name for dim in space], results.x))
-        best_score = -results.fun
-        scores_iter = [-v for v in results.func_vals]
-        best_so_far = np.maximum.accumulate(scores_iter)
+        batch_size = self.batch_size if self.n_workers > 1 else 1
+        halving = self.halving_eta > 1 and self.halving_rungs > 1
+        full_batch_size = batch_size
+        if halving:
+            # candidates per step, so that batch_size of them reach the full evaluation
+            batch_size *= self.halving_eta ** (self.halving_rungs - 1)
+            labelled = [idx for idx in range(len(self.dataset)) if self.mask_id(idx, mask_label) is not None]
+            subset = np.random.RandomState(0).permutation(labelled).tolist()
+        fidelity = [] # fraction of images/seeds each score is based on (1.0 = full evaluation)
+        best_so_far = [] # best full evaluation so far
+        stopped_early = False
+        
+        def record(xs, scores, fid):
+            optimizer.tell(xs, [-v for v in scores])
+            self._progress(len(xs))
+            for score, f in zip(scores, fid):
+                fidelity.append(f)
+                best = best_so_far[-1] if best_so_far else -np.inf
+                best_so_far.append(max(best, score) if f == 1.0 else best)
+        
+        if history[0]:
+            record(*history)
+        resumed = len(history[0])
+        
+        tmp_folder = self._start_pool() if self.n_workers > 1 and len(optimizer.yi) < n_calls else None
+        try:
+            while len(optimizer.yi) < n_calls:
+                halving_step = halving and len(optimizer.yi) >= initial_points
+                n = min(batch_size, n_calls - len(optimizer.yi))
+                if halving and not halving_step:
+                    n = min(n, full_batch_size, initial_points - len(optimizer.yi))
+                xs = optimizer.ask(n_points=n) if n > 1 else [optimizer.ask()]
+                if halving_step:
+                    scores, fid = self._successive_halving(xs, fixed, mask_label, n_points, subset)
+                else: # initial points are always fully evaluated
+                    scores = self.objective_batch([fixed + list(x) for x in xs], mask_label=mask_label, n_points=n_points)
+                    fid = [1.0] * len(xs)
+                # candidates dropped early are told their partial score: they
+                # are not promising, and the surrogate model still learns so
+                record(xs, scores, fid)
+                if self.evaluation_log is not None:
+                    self.evaluation_log.append(log_key, xs, scores, fid)
+                if self._plateau(best_so_far, fidelity):
+                    stopped_early = True
+                    break
+        finally:
+            self._stop_pool(tmp_folder)
+        
+        # Extract results (only full evaluations: partial scores are not comparable)
+        full = [k for k, f in enumerate(fidelity) if f == 1.0]
+        best = full[int(np.argmin([optimizer.yi[k] for k in full]))]
+        best_params = dict(zip([dim.name for dim in adjustments_space + wand_space], fixed + list(optimizer.Xi[best])))
+        best_score = -optimizer.yi[best]
+        scores_iter = [-v for v in optimizer.yi]
         
         output = {
             "best_params": best_params,
             "best_score": best_score,
             "scores_iter": scores_iter,
-            "best_so_far": best_so_far
+            "best_so_far": np.array(best_so_far),
+            "fidelity": fidelity,
+            "stopped_early": stopped_early,
+            "resumed": resumed
         }
         
         # print("Result", result)
         return output
 
-#### Dialog window for main SLImTAG window
-
-class OptimizerDialog(ctk.CTkToplevel):
-    """
-    Class for dialog window for BayesianOptimization interaction from main app
-    """
-    def __init__(self, parent):
-        super().__init__(parent)
-
-        self.parent = parent # assumed to be SegmentationApp()
-        
-        self.title("SLImTAG")
-        self.geometry("600x300")
-        self.resizable(False, False)
-        
-        self.protocol("WM_DELETE_WINDOW", self.close)
-        
-        self.grid_rowconfigure(0, weight=1)
-        self.grid_columnconfigure(0, weight=1)
-        
-        self.container = ctk.CTkFrame(self, fg_color="transparent")
-        self.container.grid(row=0, column=0, sticky="nsew", padx=0, pady=0)
-        self.container.grid_rowconfigure(0, weight=1)
-        self.container.grid_columnconfigure(0, weight=1)
-        
-        # attributes
-        self.folder_path = {k: os.path.abspath(os.getcwd()) for k in ["images", "masks"]}
-        self.folder_lbl = {}
-        self.same_folder = tk.IntVar(self, value=0)
-        self.ignore_mask_name = tk.IntVar(self, value=0)
-        
-        self.mask_label = None
-        
-        self.wheel_img = Image.open("images/waiting.png")
-        self.wheel_img_tk = ctk.CTkImage(light_image=self.wheel_img, size=(64, 64))
-        self.wheel_running = False
-        self.wheel_angle = 0
-        
-        self.computation_done = False # True if optimize has been called (in that case SAM lost the embedding of the original image)
-        
-        # create pages
-        self.initial_frame = self._build_initial_frame()
-        self.compute_frame = self._build_compute_frame()
-        self.results_frame = self._build_results_frame()
-        for frame in [self.initial_frame, self.compute_frame, self.results_frame]:
-            frame.grid(row=0, column=0, sticky="nsew")
-        
-        for fd in ["images", "masks"]:
-            self._set_anchor_label(fd)
-        self.show_frame(self.initial_frame)
-        
-        self.update_idletasks()
-        self.transient(parent)
-        self.grab_set()
-        self.after(100, self.focus_set)
-    
-    def show_frame(self, frame):
-        frame.tkraise()
-    
-    def _build_initial_frame(self):
-        frame = ctk.CTkFrame(self.container, fg_color="transparent")
-        
-        options_frame = ctk.CTkFrame(frame, fg_color="transparent")
-        options_frame.grid(row=0, column=0, sticky="nsew", padx=10, pady=(10, 0))
-        options_frame.grid_rowconfigure((0, 1, 2), weight=1)
-        options_frame.grid_columnconfigure(1, weight=1)
-        
-        ctk.CTkLabel(options_frame, text="Images folder").grid(row=0, column=0, padx=(10, 5), sticky="w")
-        self.folder_lbl["images"] = ctk.CTkLabel(options_frame, text=self.folder_path["images"])
-        self.folder_lbl["images"].grid(row=0, column=1, padx=5, sticky="ew")
-        self.images_folder_btn = ctk.CTkButton(options_frame, text="Change folder", command=lambda folder=["images"]: self._select_folder(folder))
-        self.images_folder_btn.grid(row=0, column=2, padx=5, pady=5, sticky="ew")
-        
-        ctk.CTkLabel(options_frame, text="Masks folder").grid(row=1, column=0, padx=(10, 5), sticky="w")
-        self.folder_lbl["masks"] = ctk.CTkLabel(options_frame, text=self.folder_path["masks"])
-        self.folder_lbl["masks"].grid(row=1, column=1, padx=5, sticky="ew")
-        self.masks_folder_btn = ctk.CTkButton(options_frame, text="Change folder", command=lambda folder=["masks"]: self._select_folder(folder))
-        self.masks_folder_btn.grid(row=1, column=2, padx=5, pady=5, sticky="ew")
-        same_folder_check = ctk.CTkCheckBox(options_frame, text="Same as images", variable=self.same_folder, command=self._toggle_same_folder)
-        same_folder_check.grid(row=1, column=3, padx=5, sticky="ew")
-        
-        ctk.CTkLabel(options_frame, text="Mask label").grid(row=2, column=0, padx=(10, 5), sticky="w")
-        self.mask_id_list = sorted(list(self.parent.mask_labels.keys())) # ASSUME this is not empty, check done in main app
-        self.mask_name_list = [f"{self.parent.mask_labels[mid]}" for mid in self.mask_id_list]
-        self.mask_menu_list = [f"{mid}: {name}" for mid, name in zip(self.mask_id_list, self.mask_name_list)]
-        if self.parent.active_mask_id is not None:
-            selected = self.mask_menu_list[self.mask_id_list.index(self.parent.active_mask_id)]
-        else:
-            selected = self.mask_menu_list[0]
-        self.masks_menu = ctk.CTkOptionMenu(options_frame, values=self.mask_menu_list)
-        self.masks_menu.set(selected)
-        self.masks_menu.grid(row=2, column=1, padx=5, sticky="ew")
-        ignore_check = ctk.CTkCheckBox(options_frame, text="Ignore mask name", variable=self.ignore_mask_name)
-        ignore_check.grid(row=2, column=2, padx=5, sticky="ew")
-        
-        buttons_frame = ctk.CTkFrame(frame, fg_color="transparent")
-        buttons_frame.grid(row=1, column=0, sticky="nsew", padx=10, pady=10)
-        buttons_frame.grid_rowconfigure(0, weight=1)
-        buttons_frame.grid_columnconfigure(0, weight=1)
-        
-        inner_btn_frame = ctk.CTkFrame(buttons_frame, fg_color="transparent")
-        inner_btn_frame.grid(row=0, column=0, padx=0, pady=0)
-        
-        btn_start = ctk.CTkButton(inner_btn_frame, text="Start", command=self.start_optimization)
-        btn_start.grid(row=0, column=0, padx=5)
-        btn_cancel = ctk.CTkButton(inner_btn_frame, text="Cancel", command=self.close)
-        btn_cancel.grid(row=0, column=1, padx=5)
-        
-        frame.grid_rowconfigure((0, 1), weight=1)
-        frame.grid_columnconfigure(0, weight=1)
-        
-        return frame
-    
-    def _build_compute_frame(self):
-        frame = ctk.CTkFrame(self.container, fg_color="transparent")
-        
-        self.wheel_lbl = ctk.CTkLabel(frame, text="Optimizing parameters...", image=self.wheel_img_tk, compound="top", pady=15)
-        self.wheel_lbl.grid(row=0, column=0, sticky="nsew")
-        
-        self.progress = ctk.CTkProgressBar(frame, progress_color="#15C2D2")
-        self.progress.set(0)
-        self.progress.grid(row=1, column=0, padx=15, pady=(0, 15), sticky="nsew")
-        
-        frame.grid_rowconfigure(0, weight=1)
-        frame.grid_columnconfigure(0, weight=1)
-        
-        return frame
-    
-    def _build_results_frame(self):
-        frame = ctk.CTkFrame(self.container, fg_color="transparent")
-        
-        results_frame = ctk.CTkFrame(frame, fg_color="transparent")
-        results_frame.grid(row=0, column=0, padx=10, pady=10, sticky="nsew")
-        results_frame.grid_rowconfigure(0, weight=1)
-        results_frame.grid_columnconfigure(0, weight=1)
-        
-        inner_res_frame = ctk.CTkFrame(results_frame, fg_color="transparent")
-        inner_res_frame.grid(row=0, column=0, padx=0, pady=0)
-        
-        ctk.CTkLabel(inner_res_frame, text="PARAMETER", anchor="w").grid(row=0, column=0, sticky="ew", padx=10)
-        ctk.CTkLabel(inner_res_frame, text="OLD").grid(row=0, column=1, sticky="ew", padx=10)
-        ctk.CTkLabel(inner_res_frame, text="NEW", font=ctk.CTkFont(weight="bold")).grid(row=0, column=2, sticky="ew", padx=10)
-        
-        self.results_lbl = {}
-        ctk.CTkLabel(inner_res_frame, text="Brightness", anchor="w").grid(row=1, column=0, sticky="ew", padx=10)
-        ctk.CTkLabel(inner_res_frame, text=f"{self.parent.wand_brightness}").grid(row=1, column=1, sticky="ew", padx=10)
-        self.results_lbl["brightness"] = ctk.CTkLabel(inner_res_frame, text="0", font=ctk.CTkFont(weight="bold"))
-        self.results_lbl["brightness"].grid(row=1, column=2, sticky="ew", padx=10)
-        ctk.CTkLabel(inner_res_frame, text="Contrast", anchor="w").grid(row=2, column=0, sticky="ew", padx=10)
-        ctk.CTkLabel(inner_res_frame, text=f"{self.parent.wand_contrast}").grid(row=2, column=1, sticky="ew", padx=10)
-        self.results_lbl["contrast"] = ctk.CTkLabel(inner_res_frame, text="0", font=ctk.CTkFont(weight="bold"))
-        self.results_lbl["contrast"].grid(row=2, column=2, sticky="ew", padx=10)
-        ctk.CTkLabel(inner_res_frame, text="Shadows", anchor="w").grid(row=3, column=0, sticky="ew", padx=10)
-        ctk.CTkLabel(inner_res_frame, text=f"{self.parent.wand_gamma}").grid(row=3, column=1, sticky="ew", padx=10)
-        self.results_lbl["shadows"] = ctk.CTkLabel(inner_res_frame, text="0", font=ctk.CTkFont(weight="bold"))
-        self.results_lbl["shadows"].grid(row=3, column=2, sticky="ew", padx=10)
-        ctk.CTkLabel(inner_res_frame, text="Wand threshold", anchor="w").grid(row=4, column=0, sticky="ew", padx=10)
-        ctk.CTkLabel(inner_res_frame, text=f"{self.parent.wand_threshold:.2f}").grid(row=4, column=1, sticky="ew", padx=10)
-        self.results_lbl["threshold"] = ctk.CTkLabel(inner_res_frame, text="0", font=ctk.CTkFont(weight="bold"))
-        self.results_lbl["threshold"].grid(row=4, column=2, sticky="ew", padx=10)
-        self.results_lbl["grad_edge"] = ctk.CTkLabel(inner_res_frame, text="0", font=ctk.CTkFont(weight="bold"))
-        if self.parent.wand_model_menu.get() == "Region growing":
-            ctk.CTkLabel(inner_res_frame, text="Edge tolerance", anchor="w").grid(row=5, column=0, sticky="ew", padx=10)
-            ctk.CTkLabel(inner_res_frame, text=f"{self.parent.wand_edge_tolerance:.2f}").grid(row=5, column=1, sticky="ew", padx=10)
-            self.results_lbl["grad_edge"].grid(row=5, column=2, sticky="ew", padx=10)
-        
-        buttons_frame = ctk.CTkFrame(frame, fg_color="transparent")
-        buttons_frame.grid(row=1, column=0, sticky="nsew", padx=10, pady=10)
-        buttons_frame.grid_rowconfigure(0, weight=1)
-        buttons_frame.grid_columnconfigure(0, weight=1)
-        
-        inner_btn_frame = ctk.CTkFrame(buttons_frame, fg_color="transparent")
-        inner_btn_frame.grid(row=0, column=0, padx=0, pady=0)
-        
-        btn_start = ctk.CTkButton(inner_btn_frame, text="Apply", command=self.apply)
-        btn_start.grid(row=0, column=0, padx=5)
-        btn_cancel = ctk.CTkButton(inner_btn_frame, text="Discard", command=self.close)
-        btn_cancel.grid(row=0, column=1, padx=5)
-        
-        frame.grid_rowconfigure((0, 1), weight=1)
-        frame.grid_columnconfigure(0, weight=1)
-        
-        return frame
-    
-    def _select_folder(self, folder): # folder = sublist of ["images", "masks"]
-        p = filedialog.askdirectory(parent=self)
-        if not p:
-            return
-        for fd in folder:
-            self.folder_path[fd] = p
-            self.folder_lbl[fd].configure(text=p)
-            self._set_anchor_label(fd)
-    
-    def _toggle_same_folder(self):
-        if self.same_folder.get():
-            self.masks_folder_btn.configure(state="disabled")
-            self.images_folder_btn.configure(command=lambda folder=["images", "masks"]: self._select_folder(folder))
-            self.folder_path["masks"] = self.folder_path["images"]
-            self.folder_lbl["masks"].configure(text=self.folder_path["images"])
-            self._set_anchor_label("masks")
-        else:
-            self.masks_folder_btn.configure(state="normal")
-            self.images_folder_btn.configure(command=lambda folder=["images"]: self._select_folder(folder))
-    
-    def _set_anchor_label(self, folder):
-        # set anchor depending on label length
-        self.update_idletasks()
-        ft = font.Font(font=self.folder_lbl[folder].cget("font"))
-        wt = ft.measure(self.folder_lbl[folder].cget("text"))
-        if wt <= self.folder_lbl[folder].winfo_width():
-            self.folder_lbl[folder].configure(anchor="w")
-        else:
-            self.folder_lbl[folder].configure(anchor="e")
-            
-    def _animate_wheel(self):
-        if not self.wheel_running:
-            return
-        rotated = self.wheel_img.rotate(-self.wheel_angle)
-        self.wheel_img_tk = ctk.CTkImage(light_image=rotated, size=(64, 64))
-        self.wheel_lbl.configure(image=self.wheel_img_tk)
-        self.wheel_angle = (self.wheel_angle + 30) % 360
-        self.after(25, self._animate_wheel)
-    
-    def progress_bar_update(self):
-        if hasattr(self, "opt_interface"):
-            self.progress.set(self.opt_interface["current"]/self.opt_interface["tot_calls"])
-            self.update()
-        
-    def start_optimization(self):
-        try:
-            if self.parent.wand_model_menu.get() == "Region growing":
-                model_inference = wand.region_growing_inference
-                model_preprocessing = wand.region_growing_preprocessing
-            elif self.parent.wand_model_menu.get() in self.parent.available_sam_models:
-                model_inference = lambda img, pt, parameters, preprocessing=None: wand.sam_inference(img, [pt], parameters, model=self.parent.sam, preprocessing=preprocessing)
-                model_preprocessing = lambda img: wand.sam_preprocessing(img, self.parent.sam)
-            else:
-                MultiButtonDialog(self, message="Unknown magic wand model", buttons=[("OK", None)])
-                return
-            self.optimizer = BayesianOptimization(image_folder=self.folder_path["images"],
-                                                  model_inference=model_inference,
-                                                  model_preprocessing=model_preprocessing,
-                                                  mask_folder=self.folder_path["masks"],
-                                                  parent=self,
-                                                  progress_callback=self.progress_bar_update)
-        except RuntimeError: # raised if path_directory does not contain valid images/masks pairs
-            MultiButtonDialog(self, message="Valid image/mask pairs not found in provided folders", buttons=[("OK", None)])
-            return
-        
-        all_masks_ids = sum([[int(k) for k in lbldict] for lbldict in self.optimizer.label_list], [])
-        all_masks_names = sum([[lbldict[k].lower() for k in lbldict] for lbldict in self.optimizer.label_list], [])
-        selected = self.mask_menu_list.index(self.masks_menu.get())
-        if self.ignore_mask_name.get():
-            mask_label = self.mask_id_list[selected]
-            if mask_label not in all_masks_ids:
-                MultiButtonDialog(self, message=f"Label {mask_label} not found in masks", buttons=[("OK", None)])
-                return
-        else:
-            mask_label = self.mask_name_list[selected]
-            if mask_label.lower() not in all_masks_names:
-                MultiButtonDialog(self, message=f"Label '{mask_label}' not found in masks", buttons=[("OK", None)])
-                return
-            
-        self.mask_label = mask_label
-        self.wheel_running = True
-        self._animate_wheel()
-        self.show_frame(self.compute_frame)
-
-        threading.Thread(
-            target=self._optimize,
-            daemon=True,
-        ).start()
-
-    def _optimize(self):
-        self.computation_done = True
-        self.results = self.optimizer.optimize(mask_label=self.mask_label,
-                                               initial_points=self.parent.slimtag_config["bayesian_optimization"]["initial_points"],
-                                               maxiter=self.parent.slimtag_config["bayesian_optimization"]["max_iterations"],
-                                               n_points=self.parent.slimtag_config["bayesian_optimization"]["n_points"]
-                                               )
-        self.new_params = {}
-        for res in ["brightness", "contrast", "shadows"]:
-            self.new_params[res] = min(max(round(self.results["best_params"][res]), -100), 100)
-        for res in ["threshold", "grad_edge"]:
-            self.new_params[res] = min(max(self.results["best_params"][res], 0.0), 1.0)
-        # switch back after computation
-        self.after(0, self.end_optimization)
-    
-    def end_optimization(self):
-        self.wheel_running = False
-        for res in ["brightness", "contrast", "shadows"]:
-            self.results_lbl[res].configure(text=f"{self.new_params[res]}")
-        for res in ["threshold", "grad_edge"]:
-            self.results_lbl[res].configure(text=f"{self.new_params[res]:.2f}")
-        self.show_frame(self.results_frame)
-
-    def apply(self):
-        self.parent.wand_brightness = self.new_params["brightness"]
-        self.parent.wand_contrast = self.new_params["contrast"]
-        self.parent.wand_gamma = self.new_params["shadows"]
-        self.parent.wand_threshold = self.new_params["threshold"]
-        self.parent.wand_edge_tolerance = self.new_params["grad_edge"]
-        
-        self.parent.wand_brightness_lbl.configure(text=str(self.parent.wand_brightness))
-        self.parent.wand_contrast_lbl.configure(text=str(self.parent.wand_contrast))
-        self.parent.wand_gamma_lbl.configure(text=str(self.parent.wand_gamma))
-        self.parent.wand_threshold_lbl.configure(text=f"{self.parent.wand_threshold:.2f}")
-        self.parent.wand_threshold_slider.set(self.parent.wand_threshold)
-        if self.parent.wand_model_menu.get() == "Region growing":
-            self.parent.wand_edge_tolerance_lbl.configure(text=f"{self.parent.wand_edge_tolerance:.2f}")
-            self.parent.wand_edge_tolerance_slider.set(self.parent.wand_edge_tolerance)
-        self.close()
-    
-    def close(self):
-        if self.computation_done:
-            self.parent.async_loader()
-        self.destroy()
-    
 #### Auxiliary functions
 
 def _aux_plot(image, mask, mask_label=None, points=None):
@@ -581,4 +848,149 @@ def _aux_plot(image, mask, mask_label=None, points=None):
                 fill=(255, 255, 0, 255) # yellow points
             )
 
-    out.show()
\ No newline at end of file
+    out.show()
+
+#### Command line interface
+# python -m slimtag_bayesian IMAGES LABEL [options]: runs the optimization
+# without any GUI (no tkinter import), e.g. on a compute node
+
+def _sam_functions(model_type, checkpoint, device=None):
+    """
+    Model functions for a SAM model (loaded in this process).
+    """
+    from slimtag_sam import SamModelPool
+    sam = SamModelPool(device=device, memory_budget=0, embedding_cache=4096) # a single model, never evicted while active
+    sam.select(model_type, checkpoint)
+    model_inference = lambda img, pt, parameters, preprocessing=None: wand.sam_inference(img, [pt], parameters, model=sam, preprocessing=preprocessing)
+    model_preprocessing = lambda img: wand.sam_preprocessing(img, sam)
+    return model_inference, model_preprocessing
+
+def _to_json(obj):
+    """
+    Convert numpy values in obj (possibly nested in dicts and lists) to the
+    corresponding Python types.
+    """
+    if isinstance(obj, dict):
+        return {k: _to_json(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple, np.ndarray)):
+        return [_to_json(v) for v in obj]
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return obj
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m slimtag_bayesian",
+                                     description="Optimize image adjustments and magic wand parameters "
+                                                 "on a folder of reference images and SLImTAG masks.")
+    parser.add_argument("images", help="folder with the reference images")
+    parser.add_argument("label", help="mask label to optimize for (a name, or an index with --label-index)")
+    parser.add_argument("--masks", default=None, help="folder with the masks (default: the images folder)")
+    parser.add_argument("--label-index", action="store_true", help="interpret label as a mask index, ignoring names")
+    parser.add_argument("--model", default="region_growing", choices=["region_growing", "vit_b", "vit_l", "vit_h"],
+                        help="magic wand model (SAM models require --checkpoint)")
+    parser.add_argument("--checkpoint", default=None, help="SAM checkpoint file")
+    parser.add_argument("--device", default=None, help="torch device for SAM (default: cuda if available)")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="processes evaluating the images (0 = one per CPU core; SAM always runs serially)")
+    parser.add_argument("--batch-size", type=int, default=4, help="parameter vectors evaluated together with workers")
+    parser.add_argument("--initial-points", type=int, default=10)
+    parser.add_argument("--max-iterations", type=int, default=50)
+    parser.add_argument("--n-points", type=int, default=20, help="seed points per image")
+    parser.add_argument("--cache-size", type=int, default=2048, help="MB of preprocessing cache")
+    parser.add_argument("--max-images", type=int, default=0, help="if > 0, stratified subset of the images")
+    parser.add_argument("--decoded-cache-folder", default=None, help="folder for memory-mapped decoded images")
+    parser.add_argument("--fixed-adjustments", type=int, nargs=3, default=None,
+                        metavar=("BRIGHTNESS", "CONTRAST", "SHADOWS"),
+                        help="keep these adjustments and optimize only the wand parameters "
+                             "(default with SAM: 0 0 0, so that each image is embedded once)")
+    parser.add_argument("--halving-eta", type=int, default=0)
+    parser.add_argument("--halving-rungs", type=int, default=2)
+    parser.add_argument("--patience", type=int, default=0, help="early stopping patience (0 = off)")
+    parser.add_argument("--tol", type=float, default=1e-3, help="early stopping tolerance")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the points chosen on the masks")
+    parser.add_argument("--history", default=None,
+                        help="evaluations log file: the search resumes from (and appends to) the evaluations "
+                             "of the same dataset, model, label and options")
+    parser.add_argument("-o", "--output", default=None, help="JSON results file (default: standard output)")
+    parser.add_argument("-q", "--quiet", action="store_true", help="do not print the progress")
+    args = parser.parse_args(argv)
+    
+    if args.model == "region_growing":
+        model_inference = wand.region_growing_inference
+        model_preprocessing = wand.region_growing_preprocessing
+    else:
+        if args.checkpoint is None:
+            parser.error(f"--checkpoint is required for model {args.model}")
+        model_inference, model_preprocessing = _sam_functions(args.model, args.checkpoint, args.device)
+    
+    mask_label = args.label
+    if args.label_index:
+        try:
+            mask_label = int(args.label)
+        except ValueError:
+            parser.error("label must be an integer with --label-index")
+    
+    def progress(current, total):
+        if not args.quiet:
+            print(f"\revaluations: {current}/{total}", end="", file=sys.stderr, flush=True)
+    
+    try:
+        optimizer = BayesianOptimization(image_folder=args.images,
+                                         model_inference=model_inference,
+                                         model_preprocessing=model_preprocessing,
+                                         mask_folder=args.masks,
+                                         progress_callback=progress,
+                                         n_workers=args.workers,
+                                         batch_size=args.batch_size,
+                                         cache_size=args.cache_size,
+                                         dataset_options={"mmap_folder": args.decoded_cache_folder,
+                                                          "max_images": args.max_images or None},
+                                         halving_eta=args.halving_eta,
+                                         halving_rungs=args.halving_rungs,
+                                         patience=args.patience,
+                                         tol=args.tol,
+                                         evaluation_log=args.history,
+                                         seed=args.seed,
+                                         model_name=args.model if args.checkpoint is None
+                                                    else f"{args.model}:{os.path.basename(args.checkpoint)}")
+    except RuntimeError: # raised if the folders do not contain valid images/masks pairs
+        parser.error("valid image/mask pairs not found in provided folders")
+    if all(optimizer.mask_id(idx, mask_label) is None for idx in range(len(optimizer.dataset))):
+        parser.error(f"label {mask_label!r} not found in masks")
+    
+    fixed_adjustments = None
+    if args.fixed_adjustments is None and args.model != "region_growing":
+        args.fixed_adjustments = [0, 0, 0]
+    if args.fixed_adjustments is not None:
+        fixed_adjustments = dict(zip(["brightness", "contrast", "shadows"], args.fixed_adjustments))
+    
+    start = time.time()
+    results = optimizer.optimize(mask_label=mask_label,
+                                 initial_points=args.initial_points,
+                                 maxiter=args.max_iterations,
+                                 n_points=args.n_points,
+                                 fixed_adjustments=fixed_adjustments)
+    if not args.quiet:
+        print(file=sys.stderr)
+    
+    # adjustments are evaluated rounded, as in the main app
+    for adj in ["brightness", "contrast", "shadows"]:
+        results["best_params"][adj] = int(round(results["best_params"][adj]))
+    output = {"images": os.path.abspath(args.images),
+              "masks": os.path.abspath(args.masks or args.images),
+              "label": mask_label,
+              "model": args.model,
+              "checkpoint": args.checkpoint,
+              "n_images": len(optimizer.dataset),
+              "elapsed": time.time() - start,
+              **results}
+    text = json.dumps(_to_json(output), indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+"""
+Dialog window to run BayesianOptimization from the main SLImTAG window.
+"""
+
+#### Libraries
+import os
+import threading
+from PIL import Image
+
+from slimtag_utils import MultiButtonDialog
+from slimtag_bayesian import BayesianOptimization
+import slimtag_wand as wand
+
+import tkinter as tk
+from tkinter import filedialog, font
+import customtkinter as ctk
+
+#### Dialog window for main SLImTAG window
+
+class OptimizerDialog(ctk.CTkToplevel):
+    """
+    Class for dialog window for BayesianOptimization interaction from main app
+    """
+    def __init__(self, parent):
+        super().__init__(parent)
+
+        self.parent = parent # assumed to be SegmentationApp()
+        
+        self.title("SLImTAG")
+        self.geometry("600x300")
+        self.resizable(False, False)
+        
+        self.protocol("WM_DELETE_WINDOW", self.close)
+        
+        self.grid_rowconfigure(0, weight=1)
+        self.grid_columnconfigure(0, weight=1)
+        
+        self.container = ctk.CTkFrame(self, fg_color="transparent")
+        self.container.grid(row=0, column=0, sticky="nsew", padx=0, pady=0)
+        self.container.grid_rowconfigure(0, weight=1)
+        self.container.grid_columnconfigure(0, weight=1)
+        
+        # attributes
+        self.folder_path = {k: os.path.abspath(os.getcwd()) for k in ["images", "masks"]}
+        self.folder_lbl = {}
+        self.same_folder = tk.IntVar(self, value=0)
+        self.ignore_mask_name = tk.IntVar(self, value=0)
+        
+        self.mask_label = None
+        
+        self.wheel_img = Image.open("images/waiting.png")
+        self.wheel_img_tk = ctk.CTkImage(light_image=self.wheel_img, size=(64, 64))
+        self.wheel_running = False
+        self.wheel_angle = 0
+        
+        self.sam_evaluator = None # SAM predictor of the optimization (the one of the main app is left untouched)
+        
+        # create pages
+        self.initial_frame = self._build_initial_frame()
+        self.compute_frame = self._build_compute_frame()
+        self.results_frame = self._build_results_frame()
+        for frame in [self.initial_frame, self.compute_frame, self.results_frame]:
+            frame.grid(row=0, column=0, sticky="nsew")
+        
+        for fd in ["images", "masks"]:
+            self._set_anchor_label(fd)
+        self.show_frame(self.initial_frame)
+        
+        self.update_idletasks()
+        self.transient(parent)
+        self.grab_set()
+        self.after(100, self.focus_set)
+    
+    def show_frame(self, frame):
+        frame.tkraise()
+    
+    def _build_initial_frame(self):
+        frame = ctk.CTkFrame(self.container, fg_color="transparent")
+        
+        options_frame = ctk.CTkFrame(frame, fg_color="transparent")
+        options_frame.grid(row=0, column=0, sticky="nsew", padx=10, pady=(10, 0))
+        options_frame.grid_rowconfigure((0, 1, 2), weight=1)
+        options_frame.grid_columnconfigure(1, weight=1)
+        
+        ctk.CTkLabel(options_frame, text="Images folder").grid(row=0, column=0, padx=(10, 5), sticky="w")
+        self.folder_lbl["images"] = ctk.CTkLabel(options_frame, text=self.folder_path["images"])
+        self.folder_lbl["images"].grid(row=0, column=1, padx=5, sticky="ew")
+        self.images_folder_btn = ctk.CTkButton(options_frame, text="Change folder", command=lambda folder=["images"]: self._select_folder(folder))
+        self.images_folder_btn.grid(row=0, column=2, padx=5, pady=5, sticky="ew")
+        
+        ctk.CTkLabel(options_frame, text="Masks folder").grid(row=1, column=0, padx=(10, 5), sticky="w")
+        self.folder_lbl["masks"] = ctk.CTkLabel(options_frame, text=self.folder_path["masks"])
+        self.folder_lbl["masks"].grid(row=1, column=1, padx=5, sticky="ew")
+        self.masks_folder_btn = ctk.CTkButton(options_frame, text="Change folder", command=lambda folder=["masks"]: self._select_folder(folder))
+        self.masks_folder_btn.grid(row=1, column=2, padx=5, pady=5, sticky="ew")
+        same_folder_check = ctk.CTkCheckBox(options_frame, text="Same as images", variable=self.same_folder, command=self._toggle_same_folder)
+        same_folder_check.grid(row=1, column=3, padx=5, sticky="ew")
+        
+        ctk.CTkLabel(options_frame, text="Mask label").grid(row=2, column=0, padx=(10, 5), sticky="w")
+        self.mask_id_list = sorted(list(self.parent.mask_labels.keys())) # ASSUME this is not empty, check done in main app
+        self.mask_name_list = [f"{self.parent.mask_labels[mid]}" for mid in self.mask_id_list]
+        self.mask_menu_list = [f"{mid}: {name}" for mid, name in zip(self.mask_id_list, self.mask_name_list)]
+        if self.parent.active_mask_id is not None:
+            selected = self.mask_menu_list[self.mask_id_list.index(self.parent.active_mask_id)]
+        else:
+            selected = self.mask_menu_list[0]
+        self.masks_menu = ctk.CTkOptionMenu(options_frame, values=self.mask_menu_list)
+        self.masks_menu.set(selected)
+        self.masks_menu.grid(row=2, column=1, padx=5, sticky="ew")
+        ignore_check = ctk.CTkCheckBox(options_frame, text="Ignore mask name", variable=self.ignore_mask_name)
+        ignore_check.grid(row=2, column=2, padx=5, sticky="ew")
+        
+        buttons_frame = ctk.CTkFrame(frame, fg_color="transparent")
+        buttons_frame.grid(row=1, column=0, sticky="nsew", padx=10, pady=10)
+        buttons_frame.grid_rowconfigure(0, weight=1)
+        buttons_frame.grid_columnconfigure(0, weight=1)
+        
+        inner_btn_frame = ctk.CTkFrame(buttons_frame, fg_color="transparent")
+        inner_btn_frame.grid(row=0, column=0, padx=0, pady=0)
+        
+        btn_start = ctk.CTkButton(inner_btn_frame, text="Start", command=self.start_optimization)
+        btn_start.grid(row=0, column=0, padx=5)
+        btn_cancel = ctk.CTkButton(inner_btn_frame, text="Cancel", command=self.close)
+        btn_cancel.grid(row=0, column=1, padx=5)
+        
+        frame.grid_rowconfigure((0, 1), weight=1)
+        frame.grid_columnconfigure(0, weight=1)
+        
+        return frame
+    
+    def _build_compute_frame(self):
+        frame = ctk.CTkFrame(self.container, fg_color="transparent")
+        
+        self.wheel_lbl = ctk.CTkLabel(frame, text="Optimizing parameters...", image=self.wheel_img_tk, compound="top", pady=15)
+        self.wheel_lbl.grid(row=0, column=0, sticky="nsew")
+        
+        self.progress = ctk.CTkProgressBar(frame, progress_color="#15C2D2")
+        self.progress.set(0)
+        self.progress.grid(row=1, column=0, padx=15, pady=(0, 15), sticky="nsew")
+        
+        frame.grid_rowconfigure(0, weight=1)
+        frame.grid_columnconfigure(0, weight=1)
+        
+        return frame
+    
+    def _build_results_frame(self):
+        frame = ctk.CTkFrame(self.container, fg_color="transparent")
+        
+        results_frame = ctk.CTkFrame(frame, fg_color="transparent")
+        results_frame.grid(row=0, column=0, padx=10, pady=10, sticky="nsew")
+        results_frame.grid_rowconfigure(0, weight=1)
+        results_frame.grid_columnconfigure(0, weight=1)
+        
+        inner_res_frame = ctk.CTkFrame(results_frame, fg_color="transparent")
+        inner_res_frame.grid(row=0, column=0, padx=0, pady=0)
+        
+        ctk.CTkLabel(inner_res_frame, text="PARAMETER", anchor="w").grid(row=0, column=0, sticky="ew", padx=10)
+        ctk.CTkLabel(inner_res_frame, text="OLD").grid(row=0, column=1, sticky="ew", padx=10)
+        ctk.CTkLabel(inner_res_frame, text="NEW", font=ctk.CTkFont(weight="bold")).grid(row=0, column=2, sticky="ew", padx=10)
+        
+        self.results_lbl = {}
+        ctk.CTkLabel(inner_res_frame, text="Brightness", anchor="w").grid(row=1, column=0, sticky="ew", padx=10)
+        ctk.CTkLabel(inner_res_frame, text=f"{self.parent.wand_brightness}").grid(row=1, column=1, sticky="ew", padx=10)
+        self.results_lbl["brightness"] = ctk.CTkLabel(inner_res_frame, text="0", font=ctk.CTkFont(weight="bold"))
+        self.results_lbl["brightness"].grid(row=1, column=2, sticky="ew", padx=10)
+        ctk.CTkLabel(inner_res_frame, text="Contrast", anchor="w").grid(row=2, column=0, sticky="ew", padx=10)
+        ctk.CTkLabel(inner_res_frame, text=f"{self.parent.wand_contrast}").grid(row=2, column=1, sticky="ew", padx=10)
+        self.results_lbl["contrast"] = ctk.CTkLabel(inner_res_frame, text="0", font=ctk.CTkFont(weight="bold"))
+        self.results_lbl["contrast"].grid(row=2, column=2, sticky="ew", padx=10)
+        ctk.CTkLabel(inner_res_frame, text="Shadows", anchor="w").grid(row=3, column=0, sticky="ew", padx=10)
+        ctk.CTkLabel(inner_res_frame, text=f"{self.parent.wand_gamma}").grid(row=3, column=1, sticky="ew", padx=10)
+        self.results_lbl["shadows"] = ctk.CTkLabel(inner_res_frame, text="0", font=ctk.CTkFont(weight="bold"))
+        self.results_lbl["shadows"].grid(row=3, column=2, sticky="ew", padx=10)
+        ctk.CTkLabel(inner_res_frame, text="Wand threshold", anchor="w").grid(row=4, column=0, sticky="ew", padx=10)
+        ctk.CTkLabel(inner_res_frame, text=f"{self.parent.wand_threshold:.2f}").grid(row=4, column=1, sticky="ew", padx=10)
+        self.results_lbl["threshold"] = ctk.CTkLabel(inner_res_frame, text="0", font=ctk.CTkFont(weight="bold"))
+        self.results_lbl["threshold"].grid(row=4, column=2, sticky="ew", padx=10)
+        self.results_lbl["grad_edge"] = ctk.CTkLabel(inner_res_frame, text="0", font=ctk.CTkFont(weight="bold"))
+        if self.parent.wand_model_menu.get() == "Region growing":
+            ctk.CTkLabel(inner_res_frame, text="Edge tolerance", anchor="w").grid(row=5, column=0, sticky="ew", padx=10)
+            ctk.CTkLabel(inner_res_frame, text=f"{self.parent.wand_edge_tolerance:.2f}").grid(row=5, column=1, sticky="ew", padx=10)
+            self.results_lbl["grad_edge"].grid(row=5, column=2, sticky="ew", padx=10)
+        
+        buttons_frame = ctk.CTkFrame(frame, fg_color="transparent")
+        buttons_frame.grid(row=1, column=0, sticky="nsew", padx=10, pady=10)
+        buttons_frame.grid_rowconfigure(0, weight=1)
+        buttons_frame.grid_columnconfigure(0, weight=1)
+        
+        inner_btn_frame = ctk.CTkFrame(buttons_frame, fg_color="transparent")
+        inner_btn_frame.grid(row=0, column=0, padx=0, pady=0)
+        
+        btn_start = ctk.CTkButton(inner_btn_frame, text="Apply", command=self.apply)
+        btn_start.grid(row=0, column=0, padx=5)
+        btn_cancel = ctk.CTkButton(inner_btn_frame, text="Discard", command=self.close)
+        btn_cancel.grid(row=0, column=1, padx=5)
+        
+        frame.grid_rowconfigure((0, 1), weight=1)
+        frame.grid_columnconfigure(0, weight=1)
+        
+        return frame
+    
+    def _select_folder(self, folder): # folder = sublist of ["images", "masks"]
+        p = filedialog.askdirectory(parent=self)
+        if not p:
+            return
+        for fd in folder:
+            self.folder_path[fd] = p
+            self.folder_lbl[fd].configure(text=p)
+            self._set_anchor_label(fd)
+    
+    def _toggle_same_folder(self):
+        if self.same_folder.get():
+            self.masks_folder_btn.configure(state="disabled")
+            self.images_folder_btn.configure(command=lambda folder=["images", "masks"]: self._select_folder(folder))
+            self.folder_path["masks"] = self.folder_path["images"]
+            self.folder_lbl["masks"].configure(text=self.folder_path["images"])
+            self._set_anchor_label("masks")
+        else:
+            self.masks_folder_btn.configure(state="normal")
+            self.images_folder_btn.configure(command=lambda folder=["images"]: self._select_folder(folder))
+    
+    def _set_anchor_label(self, folder):
+        # set anchor depending on label length
+        self.update_idletasks()
+        ft = font.Font(font=self.folder_lbl[folder].cget("font"))
+        wt = ft.measure(self.folder_lbl[folder].cget("text"))
+        if wt <= self.folder_lbl[folder].winfo_width():
+            self.folder_lbl[folder].configure(anchor="w")
+        else:
+            self.folder_lbl[folder].configure(anchor="e")
+            
+    def _animate_wheel(self):
+        if not self.wheel_running:
+            return
+        rotated = self.wheel_img.rotate(-self.wheel_angle)
+        self.wheel_img_tk = ctk.CTkImage(light_image=rotated, size=(64, 64))
+        self.wheel_lbl.configure(image=self.wheel_img_tk)
+        self.wheel_angle = (self.wheel_angle + 30) % 360
+        self.after(25, self._animate_wheel)
+    
+    def progress_bar_update(self, current, total):
+        if total > 0:
+            self.progress.set(current/total)
+            self.update()
+        
+    def start_optimization(self):
+        try:
+            if self.parent.wand_model_menu.get() == "Region growing":
+                model_inference = wand.region_growing_inference
+                model_preprocessing = wand.region_growing_preprocessing
+            elif self.parent.wand_model_menu.get() in self.parent.available_sam_models:
+                if self.sam_evaluator is None:
+                    try:
+                        self.sam_evaluator = self.parent.sam.evaluator(self.parent.slimtag_config["bayesian_optimization"]["sam_embedding_cache"])
+                    except (AttributeError, RuntimeError): # model not loaded (yet)
+                        MultiButtonDialog(self, message="SAM model is not loaded yet", buttons=[("OK", None)])
+                        return
+                model_inference = lambda img, pt, parameters, preprocessing=None: wand.sam_inference(img, [pt], parameters, model=self.sam_evaluator, preprocessing=preprocessing)
+                model_preprocessing = lambda img: wand.sam_preprocessing(img, self.sam_evaluator)
+            else:
+                MultiButtonDialog(self, message="Unknown magic wand model", buttons=[("OK", None)])
+                return
+            self.optimizer = BayesianOptimization(image_folder=self.folder_path["images"],
+                                                  model_inference=model_inference,
+                                                  model_preprocessing=model_preprocessing,
+                                                  mask_folder=self.folder_path["masks"],
+                                                  progress_callback=lambda current, total: self.after(0, self.progress_bar_update, current, total),
+                                                  n_workers=self.parent.slimtag_config["bayesian_optimization"]["n_workers"],
+                                                  batch_size=self.parent.slimtag_config["bayesian_optimization"]["batch_size"],
+                                                  cache_size=self.parent.slimtag_config["bayesian_optimization"]["cache_size"],
+                                                  dataset_options=self._dataset_options(),
+                                                  halving_eta=self.parent.slimtag_config["bayesian_optimization"]["halving_eta"],
+                                                  halving_rungs=self.parent.slimtag_config["bayesian_optimization"]["halving_rungs"],
+                                                  patience=self.parent.slimtag_config["bayesian_optimization"]["early_stop_patience"],
+                                                  tol=self.parent.slimtag_config["bayesian_optimization"]["early_stop_tol"],
+                                                  evaluation_log=self.parent.slimtag_config["bayesian_optimization"]["history_file"] or None,
+                                                  model_name=self.parent.wand_model_id())
+        except RuntimeError: # raised if path_directory does not contain valid images/masks pairs
+            MultiButtonDialog(self, message="Valid image/mask pairs not found in provided folders", buttons=[("OK", None)])
+            return
+        
+        all_masks_ids = sum([[int(k) for k in lbldict] for lbldict in self.optimizer.label_list], [])
+        all_masks_names = sum([[lbldict[k].lower() for k in lbldict] for lbldict in self.optimizer.label_list], [])
+        selected = self.mask_menu_list.index(self.masks_menu.get())
+        if self.ignore_mask_name.get():
+            mask_label = self.mask_id_list[selected]
+            if mask_label not in all_masks_ids:
+                MultiButtonDialog(self, message=f"Label {mask_label} not found in masks", buttons=[("OK", None)])
+                return
+        else:
+            mask_label = self.mask_name_list[selected]
+            if mask_label.lower() not in all_masks_names:
+                MultiButtonDialog(self, message=f"Label '{mask_label}' not found in masks", buttons=[("OK", None)])
+                return
+            
+        self.mask_label = mask_label
+        self.wheel_running = True
+        self._animate_wheel()
+        self.show_frame(self.compute_frame)
+
+        threading.Thread(
+            target=self._optimize,
+            daemon=True,
+        ).start()
+
+    def _dataset_options(self):
+        cfg = self.parent.slimtag_config["bayesian_optimization"]
+        return {"cache_size": cfg["dataset_cache"],
+                "mmap_folder": cfg["decoded_cache_folder"] or None,
+                "max_images": cfg["max_images"] or None}
+
+    def _optimize(self):
+        # with SAM, other adjustments would mean running the image encoder at
+        # each iteration: keep the current ones, so that each reference image
+        # is embedded once and the iterations run only the mask decoder
+        if self.parent.slimtag_config["bayesian_optimization"]["split_search"] or self.sam_evaluator is not None:
+            fixed_adjustments = {"brightness": self.parent.wand_brightness,
+                                 "contrast": self.parent.wand_contrast,
+                                 "shadows": self.parent.wand_gamma}
+        else:
+            fixed_adjustments = None
+        self.results = self.optimizer.optimize(mask_label=self.mask_label,
+                                               initial_points=self.parent.slimtag_config["bayesian_optimization"]["initial_points"],
+                                               maxiter=self.parent.slimtag_config["bayesian_optimization"]["max_iterations"],
+                                               n_points=self.parent.slimtag_config["bayesian_optimization"]["n_points"],
+                                               fixed_adjustments=fixed_adjustments
+                                               )
+        self.new_params = {}
+        for res in ["brightness", "contrast", "shadows"]:
+            self.new_params[res] = min(max(round(self.results["best_params"][res]), -100), 100)
+        for res in ["threshold", "grad_edge"]:
+            self.new_params[res] = min(max(self.results["best_params"][res], 0.0), 1.0)
+        # switch back after computation
+        self.after(0, self.end_optimization)
+    
+    def end_optimization(self):
+        self.wheel_running = False
+        for res in ["brightness", "contrast", "shadows"]:
+            self.results_lbl[res].configure(text=f"{self.new_params[res]}")
+        for res in ["threshold", "grad_edge"]:
+            self.results_lbl[res].configure(text=f"{self.new_params[res]:.2f}")
+        self.show_frame(self.results_frame)
+
+    def apply(self):
+        self.parent.wand_brightness = self.new_params["brightness"]
+        self.parent.wand_contrast = self.new_params["contrast"]
+        self.parent.wand_gamma = self.new_params["shadows"]
+        self.parent.wand_threshold = self.new_params["threshold"]
+        self.parent.wand_edge_tolerance = self.new_params["grad_edge"]
+        
+        self.parent.wand_brightness_lbl.configure(text=str(self.parent.wand_brightness))
+        self.parent.wand_contrast_lbl.configure(text=str(self.parent.wand_contrast))
+        self.parent.wand_gamma_lbl.configure(text=str(self.parent.wand_gamma))
+        self.parent.wand_threshold_lbl.configure(text=f"{self.parent.wand_threshold:.2f}")
+        self.parent.wand_threshold_slider.set(self.parent.wand_threshold)
+        if self.parent.wand_model_menu.get() == "Region growing":
+            self.parent.wand_edge_tolerance_lbl.configure(text=f"{self.parent.wand_edge_tolerance:.2f}")
+            self.parent.wand_edge_tolerance_slider.set(self.parent.wand_edge_tolerance)
+        self.parent.wand_adjustments_changed()
+        self.close()
+    
+    def close(self):
+        if self.sam_evaluator is not None:
+            self.sam_evaluator.close()
+        self.destroy()
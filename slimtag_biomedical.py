@@ -11,7 +11,20 @@ Supported:
 Returns:
     metadata (dict)
     spacing (dx, dy, dz)
-    volume (3D numpy array)
+    volume (3D numpy array, in the native dtype of the file)
+
+Uncompressed NRRD/NIfTI volumes are memory-mapped (or, for scaled NIfTI,
+wrapped in a LazyVolume): slices are read from disk only when accessed, so
+volumes larger than the available memory can be opened.
+
+metadata["affine"] is the 4x4 voxel -> world (RAS+, mm) matrix of the
+volume, as in nibabel; save_labelmap_NRRD and save_labelmap_NIFTI write a
+mask with the same geometry, so that it overlays the original volume in
+other tools.
+
+DICOM directories can hold several series (list_series_DICOM); the headers
+needed to sort and stack their slices can be kept in a persistent
+DicomIndex, so that a directory opened again is not scanned again.
 
 Author: Giulio Del Corso
 """
@@ -19,21 +32,74 @@ Author: Giulio Del Corso
 
 #%% Basic Libraries
 import os
+import io
+import json
+import sqlite3
+import zlib
+import struct
+import itertools
+import collections
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
 #%% Medical libraries
 import pydicom        # DICOM
+from pydicom.dataset import Dataset
 import nrrd           # NRRD
 import nibabel as nib # NIFTI
 
 
 
+#%% Lazy volumes
+class LazyVolume():
+    """
+    Read-only 3D volume backed by an array-like object supporting slicing
+    (e.g. a nibabel array proxy): indexing reads only the requested part,
+    np.asarray reads the whole volume.
+    """
+
+    def __init__(self, source):
+
+        self.source = source
+        self.shape = tuple(source.shape)
+        self.ndim = len(self.shape)
+        # dtype after scaling (e.g. NIfTI slope/intercept)
+        self.dtype = np.asarray(source[(slice(0, 1),) * self.ndim]).dtype
+
+    def __getitem__(self, key):
+        return np.asarray(self.source[key])
+
+    def __array__(self, dtype=None, copy=None):
+        arr = np.asarray(self.source[(slice(None),) * self.ndim])
+        return arr if dtype is None else arr.astype(dtype)
+
+
+
+#%% Orientation
+# flip between the RAS+ (NIfTI, nibabel) and LPS+ (DICOM, usual NRRD) world axes
+LPS_TO_RAS = np.diag([-1.0, -1.0, 1.0, 1.0])
+
+# world axes flips from NRRD spaces to RAS+
+SPACE_TO_RAS_NRRD = {
+    "right-anterior-superior": (1, 1, 1), "RAS": (1, 1, 1),
+    "left-anterior-superior": (-1, 1, 1), "LAS": (-1, 1, 1),
+    "left-posterior-superior": (-1, -1, 1), "LPS": (-1, -1, 1),
+}
+
+
+
 #%% Main auto-loader function (DICOM/NRRD/NIFTI)
-def load_medical_volume(path):
+def load_medical_volume(path, series_uid=None, dicom_index=None, headers=None):
+    """
+    Load the volume at path; for DICOM directories, series_uid selects the
+    series (see list_series_DICOM) and dicom_index is an optional
+    DicomIndex. headers (the headers of a series, as returned by
+    list_series_DICOM) skips listing the directory again.
+    """
 
     # If a DICOM directory is provided
     if os.path.isdir(path):
-        return load_DICOM(path)
+        return load_DICOM(path, series_uid, dicom_index, headers)
 
     
     lower = path.lower()
@@ -107,6 +173,40 @@ def get_orientation_DICOM(ds):
 
 
 
+def affine_DICOM(sorted_slices):
+    """
+    Voxel -> RAS+ affine of sorted slices stacked along axis 2: axis 0
+    runs down the rows of the image, axis 1 along the columns.
+    """
+
+    ds0 = sorted_slices[0]
+
+    dx, dy = get_spacing_DICOM(ds0)
+
+    row, col = get_orientation_DICOM(ds0)
+
+    if row is None or col is None:
+        row, col = np.array([1.0, 0.0, 0.0]), np.array([0.0, 1.0, 0.0])
+
+    origin = get_slice_position_DICOM(ds0)
+    last = get_slice_position_DICOM(sorted_slices[-1])
+
+    if origin is not None and last is not None and len(sorted_slices) > 1:
+        step = (last - origin) / (len(sorted_slices) - 1)
+    else:
+        step = np.cross(row, col) * compute_slice_spacing_DICOM(sorted_slices)
+
+    affine = np.eye(4)
+    affine[:3, 0] = col * dy # next row: along the column direction
+    affine[:3, 1] = row * dx # next column: along the row direction
+    affine[:3, 2] = step
+    if origin is not None:
+        affine[:3, 3] = origin
+
+    return LPS_TO_RAS @ affine
+
+
+
 def compute_slice_spacing_DICOM(sorted_slices):
 
     positions = []
@@ -166,39 +266,246 @@ def sort_slices_DICOM(slices):
     )
 
 
-#%% load_DICOM
-def load_DICOM(path):
+def read_header_DICOM(f):
+    """
+    Header of a DICOM image file, without reading the pixel data, or None
+    if f is not a DICOM image.
+    """
 
-    # -----------------------------------------------------
-    # DIRECTORY (DICOM SERIES)
-    # -----------------------------------------------------
+    try:
+        ds = pydicom.dcmread(f, stop_before_pixels=True)
 
-    if os.path.isdir(path):
+    except Exception:
+        return None
+
+    # PixelData is not read: check the image attributes instead
+    if "Rows" not in ds or "Columns" not in ds:
+        return None
+
+    return ds
 
+
+
+def pixel_format_DICOM(ds):
+    """
+    Attributes that determine shape and dtype of the pixel array of a slice.
+    """
+
+    return (
+        int(ds.Rows),
+        int(ds.Columns),
+        int(ds.get("SamplesPerPixel", 1)),
+        int(ds.get("BitsAllocated", 16)),
+        int(ds.get("PixelRepresentation", 0)),
+    )
+
+
+
+# attributes of the headers kept by DicomIndex (all that is needed to sort,
+# stack and describe the slices of a series)
+INDEX_KEYWORDS_DICOM = (
+    "SeriesInstanceUID", "SeriesDescription", "SeriesNumber", "Modality",
+    "PatientName", "StudyDate", "InstanceNumber",
+    "Rows", "Columns", "SamplesPerPixel", "BitsAllocated", "PixelRepresentation", "NumberOfFrames",
+    "PixelSpacing", "ImagerPixelSpacing", "PixelAspectRatio", "SliceThickness",
+    "ImagePositionPatient", "ImageOrientationPatient",
+    "RescaleSlope", "RescaleIntercept",
+)
+
+
+
+def index_header_DICOM(ds):
+    """
+    Copy of the INDEX_KEYWORDS_DICOM attributes of header ds (with its
+    filename).
+    """
+
+    header = Dataset()
+
+    for keyword in INDEX_KEYWORDS_DICOM:
+        if keyword in ds:
+            header.add(ds.data_element(keyword))
+
+    header.filename = ds.filename
+
+    return header
+
+
+
+class DicomIndex():
+    """
+    Persistent index (SQLite) of the files of the DICOM directories opened:
+    for each file, its size and modification time, and its series and
+    INDEX_KEYWORDS_DICOM attributes (or nothing, if it is not a DICOM
+    image). Files unchanged since they were indexed are not read again.
+
+    Parameters
+    ----------
+    path : str
+        Database file (created if needed).
+    """
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self._connect() as con:
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "path TEXT PRIMARY KEY, directory TEXT NOT NULL, "
+                "mtime_ns INTEGER NOT NULL, size INTEGER NOT NULL, "
+                "series_uid TEXT, header TEXT)" # both NULL for non-DICOM files
+            )
+            con.execute("CREATE INDEX IF NOT EXISTS files_directory ON files (directory)")
+
+    def _connect(self):
+        # a connection per call: the index may be used from any thread
+        return sqlite3.connect(self.path, timeout=30)
+
+    def headers(self, directory, max_workers=None):
+        """
+        Headers (see index_header_DICOM) of the DICOM images in directory:
+        only new or modified files are read, in a thread pool.
+        """
+
+        directory = os.path.abspath(directory)
+
+        files = {}
+        with os.scandir(directory) as it:
+            for entry in it:
+                if not entry.name.startswith(".") and entry.is_file():
+                    st = entry.stat()
+                    files[entry.path] = (st.st_mtime_ns, st.st_size)
+
+        with self._connect() as con:
+            rows = con.execute("SELECT path, mtime_ns, size, header FROM files WHERE directory = ?", (directory,)).fetchall()
+
+        indexed = {path: header for path, mtime_ns, size, header in rows if files.get(path) == (mtime_ns, size)}
+        removed = [(path,) for path, *_ in rows if path not in files]
+        changed = [path for path in files if path not in indexed]
+
+        headers = []
+        for path, header in indexed.items():
+            if header is not None:
+                ds = Dataset.from_json(header)
+                ds.filename = path
+                headers.append(ds)
+
+        new = [] # headers of the changed files (None: not a DICOM image)
+        if changed:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                new = [None if ds is None else index_header_DICOM(ds) for ds in executor.map(read_header_DICOM, changed)]
+            headers.extend(ds for ds in new if ds is not None)
+
+        if changed or removed:
+            with self._connect() as con:
+                con.executemany("DELETE FROM files WHERE path = ?", removed)
+                con.executemany(
+                    "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                    [(path, directory, *files[path],
+                      None if ds is None else str(ds.get("SeriesInstanceUID", "")),
+                      None if ds is None else ds.to_json())
+                     for path, ds in zip(changed, new)]
+                )
+
+        return headers
+
+
+
+def list_series_DICOM(path, index=None, max_workers=None):
+    """
+    Image series of the DICOM directory path: {SeriesInstanceUID: headers
+    of its files}, the largest series first. Headers are read from index
+    (a DicomIndex) if given.
+    """
+
+    if index is not None:
+        headers = index.headers(path, max_workers)
+
+    else:
         files = [
             os.path.join(path, f)
             for f in os.listdir(path)
             if not f.startswith(".")
         ]
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            headers = [ds for ds in executor.map(read_header_DICOM, files) if ds is not None]
 
-        slices = []
+    series = collections.defaultdict(list)
 
-        for f in files:
+    for ds in headers:
+        series[str(ds.get("SeriesInstanceUID", ""))].append(ds)
 
-            try:
+    return dict(sorted(series.items(), key=lambda item: -len(item[1])))
 
-                ds = pydicom.dcmread(f)
 
-                if hasattr(ds, "PixelData"):
-                    slices.append(ds)
 
-            except Exception:
-                continue
+def read_series_DICOM(headers, max_workers=None):
+    """
+    Read the slices of a DICOM series from the headers of its files (see
+    list_series_DICOM), in a thread pool (reading is mostly I/O and
+    decompression, which release the GIL): the headers are validated and
+    sorted, then the pixel data are decoded straight into a preallocated
+    volume, so that at most a few slices are alive besides the volume.
+
+    Slices whose size or pixel format differs from the most common one
+    are ignored. Return the sorted headers and the volume (the slices are
+    stacked along axis 2, as np.stack(..., axis=2) would do; the volume is
+    stored slice by slice, so that each volume[:, :, k] is contiguous).
+    """
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
 
-        if len(slices) == 0:
+        if len(headers) == 0:
             raise ValueError("No valid DICOM found")
 
-        slices = sort_slices_DICOM(slices)
+        # keep the slices with the most common size/pixel format
+        formats = collections.Counter(pixel_format_DICOM(ds) for ds in headers)
+        main_format = formats.most_common(1)[0][0]
+        headers = [ds for ds in headers if pixel_format_DICOM(ds) == main_format]
+
+        headers = sort_slices_DICOM(headers)
+
+        # the first slice gives shape and dtype of the volume
+        first = pydicom.dcmread(headers[0].filename).pixel_array
+        volume = np.moveaxis(np.empty((len(headers),) + first.shape, dtype=first.dtype), 0, 2)
+        volume[:, :, 0] = first
+        del first
+
+        def decode(k):
+            volume[:, :, k] = pydicom.dcmread(headers[k].filename).pixel_array
+
+        # list() to raise decoding errors here
+        list(executor.map(decode, range(1, len(headers))))
+
+    return headers, volume
+
+
+
+#%% load_DICOM
+def load_DICOM(path, series_uid=None, index=None, headers=None):
+
+    # -----------------------------------------------------
+    # DIRECTORY (DICOM SERIES)
+    # -----------------------------------------------------
+
+    if os.path.isdir(path):
+
+        # headers of the series already listed (e.g. to choose it)
+        if headers is None:
+
+            series = list_series_DICOM(path, index)
+
+            if len(series) == 0:
+                raise ValueError("No valid DICOM found")
+
+            # default: the largest series
+            if series_uid is None:
+                series_uid = next(iter(series))
+
+            headers = series[series_uid]
+
+        slices, volume = read_series_DICOM(headers)
 
         ds0 = slices[0]
 
@@ -214,12 +521,12 @@ def load_DICOM(path):
             "StudyDate": str(ds0.get("StudyDate", "")),
             "Rows": int(ds0.Rows),
             "Columns": int(ds0.Columns),
+            # stored values -> physical units (e.g. Hounsfield units for CT)
+            "RescaleSlope": float(ds0.get("RescaleSlope", 1.0)),
+            "RescaleIntercept": float(ds0.get("RescaleIntercept", 0.0)),
+            "affine": affine_DICOM(slices).tolist(),
         }
 
-        images = [s.pixel_array for s in slices]
-
-        volume = np.stack(images, axis=2)
-
         return metadata, spacing, volume
 
     # -----------------------------------------------------
@@ -237,12 +544,17 @@ def load_DICOM(path):
         "StudyDate": str(ds.get("StudyDate", "")),
         "Rows": int(ds.Rows),
         "Columns": int(ds.Columns),
+        "RescaleSlope": float(ds.get("RescaleSlope", 1.0)),
+        "RescaleIntercept": float(ds.get("RescaleIntercept", 0.0)),
+        "affine": affine_DICOM([ds]).tolist(),
     }
 
     # Multi-frame
     if hasattr(ds, "NumberOfFrames") and ds.NumberOfFrames > 1:
 
-        volume = ds.pixel_array
+        # frames come first in pixel_array: stack them along axis 2 as for
+        # a series (a view, so each frame stays contiguous)
+        volume = np.moveaxis(ds.pixel_array, 0, 2)
 
         dz = float(ds.get("SliceThickness", 1.0))
 
@@ -260,6 +572,32 @@ def load_DICOM(path):
 
 
 #%% NRRD Utilities
+def affine_NRRD(header):
+    """
+    Voxel -> RAS+ affine from space directions/origin (scaling by the
+    spacing if the orientation is not given).
+    """
+
+    affine = np.eye(4)
+
+    dirs = header.get("space directions")
+    flips = SPACE_TO_RAS_NRRD.get(header.get("space", ""))
+
+    if dirs is not None and flips is not None:
+        # one row per axis, NaN for non-spatial axes
+        dirs = [d for d in np.asarray(dirs, dtype=np.float64) if not np.isnan(d).any()]
+        if len(dirs) == 3 and len(dirs[0]) == 3:
+            affine[:3, :3] = np.array(dirs).T
+            affine[:3, 3] = np.asarray(header.get("space origin", np.zeros(3)), dtype=np.float64)
+            return np.diag(flips + (1,)) @ affine
+
+    affine[:3, :3] = np.diag(get_spacing_NRRD(header))
+
+    return affine
+
+
+
+
 def get_spacing_NRRD(header):
 
     if "space directions" in header:
@@ -288,10 +626,78 @@ def get_spacing_NRRD(header):
 
 
 
+# NRRD "type" field -> numpy type (all the spellings of the NRRD specification)
+NRRD_TYPES = {
+    **dict.fromkeys(["signed char", "int8", "int8_t"], "i1"),
+    **dict.fromkeys(["uchar", "unsigned char", "uint8", "uint8_t"], "u1"),
+    **dict.fromkeys(["short", "short int", "signed short", "signed short int", "int16", "int16_t"], "i2"),
+    **dict.fromkeys(["ushort", "unsigned short", "unsigned short int", "uint16", "uint16_t"], "u2"),
+    **dict.fromkeys(["int", "signed int", "int32", "int32_t"], "i4"),
+    **dict.fromkeys(["uint", "unsigned int", "uint32", "uint32_t"], "u4"),
+    **dict.fromkeys(["longlong", "long long", "long long int", "signed long long", "signed long long int",
+                     "int64", "int64_t"], "i8"),
+    **dict.fromkeys(["ulonglong", "unsigned long long", "unsigned long long int", "uint64", "uint64_t"], "u8"),
+    "float": "f4",
+    "double": "f8",
+}
+
+NRRD_ENDIAN = {"little": "<", "big": ">"}
+
+
+
+def memmap_NRRD(path, header, data_offset):
+    """
+    Memory-mapped data of a raw NRRD file, or None if the data is
+    compressed (or stored as text) and must be read as a whole.
+    """
+
+    if header["encoding"] != "raw" or header["type"] not in NRRD_TYPES:
+        return None
+
+    dtype = np.dtype(NRRD_TYPES[header["type"]])
+    if dtype.itemsize > 1:
+        if header.get("endian") not in NRRD_ENDIAN: # invalid header: let pynrrd report it
+            return None
+        dtype = dtype.newbyteorder(NRRD_ENDIAN[header["endian"]])
+    shape = tuple(int(x) for x in header["sizes"])
+    nbytes = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+
+    data_file = header.get("datafile", header.get("data file", None))
+    if data_file is not None: # detached header (.nhdr)
+        if not os.path.isabs(data_file):
+            data_file = os.path.join(os.path.dirname(path), data_file)
+        data_offset = 0
+    else:
+        data_file = path
+
+    with open(data_file, "rb") as fh:
+        fh.seek(data_offset)
+        for _ in range(header.get("lineskip", header.get("line skip", 0))):
+            fh.readline()
+        data_offset = fh.tell()
+
+    byte_skip = header.get("byteskip", header.get("byte skip", 0))
+    if byte_skip == -1: # data at the end of the file
+        data_offset = os.path.getsize(data_file) - nbytes
+    else:
+        data_offset += byte_skip
+
+    # NRRD lists the fastest axis first: same as pynrrd's default index_order="F"
+    return np.memmap(data_file, dtype=dtype, mode="r", offset=data_offset, shape=shape, order="F")
+
+
+
 #%% LOAD NRRD
 def load_NRRD(path):
 
-    volume, header = nrrd.read(path)
+    with open(path, "rb") as fh:
+        header = nrrd.read_header(fh)
+        data_offset = fh.tell()
+
+    volume = memmap_NRRD(path, header, data_offset)
+
+    if volume is None:
+        volume, header = nrrd.read(path)
 
     # Ensure 3D
     if volume.ndim == 2:
@@ -306,6 +712,7 @@ def load_NRRD(path):
         "sizes": tuple(header.get("sizes", volume.shape)),
         "encoding": str(header.get("encoding", "")),
         "space": str(header.get("space", "")),
+        "affine": affine_NRRD(header).tolist(),
     }
 
     return metadata, spacing, volume
@@ -315,13 +722,23 @@ def load_NRRD(path):
 #%% LOAD NIFTI
 def load_NIFTI(path):
 
-    nii = nib.load(path)
+    nii = nib.load(path, mmap="r")
 
-    volume = nii.get_fdata()
+    proxy = nii.dataobj
 
-    # Ensure 3D
-    if volume.ndim == 2:
-        volume = volume[:, :, np.newaxis]
+    if len(proxy.shape) == 2:
+        # Ensure 3D
+        volume = np.asanyarray(proxy)[:, :, np.newaxis]
+
+    elif path.lower().endswith(".gz"):
+        # gzip cannot be read at random offsets: decompress once, in the native dtype
+        volume = np.asanyarray(proxy)
+
+    elif proxy.slope == 1 and proxy.inter == 0:
+        volume = proxy.get_unscaled() # memory-mapped
+
+    else:
+        volume = LazyVolume(proxy)
 
     hdr = nii.header
 
@@ -331,6 +748,141 @@ def load_NIFTI(path):
         "format": "NIFTI",
         "datatype": str(hdr.get_data_dtype()),
         "shape": tuple(volume.shape),
+        "affine": nii.affine.tolist(),
     }
 
     return metadata, spacing, volume
+
+
+
+#%% Labelmap export
+def labelmap_chunks(mask, chunk_size=4 * 2**20):
+    """
+    Bytes of mask (X, Y, Z) in Fortran order (x fastest, as NRRD and NIfTI
+    store data), a block of slices at a time: the mask is never copied as
+    a whole.
+    """
+
+    step = max(1, chunk_size // max(1, mask.shape[0] * mask.shape[1] * mask.itemsize))
+
+    for z0 in range(0, mask.shape[2], step):
+        yield memoryview(np.ascontiguousarray(mask[:, :, z0:z0+step].transpose(2, 1, 0))).cast("B")
+
+
+
+def _deflate(chunk, level, last):
+    c = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return c.compress(chunk) + c.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+
+def write_gzip(fh, chunks, level=6, max_workers=None):
+    """
+    Write the concatenation of chunks (bytes-like) to fh as one gzip member,
+    compressing the chunks in parallel (as pigz does): each chunk is an
+    independent raw deflate stream ending on a byte boundary (sync flush),
+    the last one with the final block, so that together they form a single
+    deflate stream readable by any gzip decoder. max_workers defaults to the
+    number of CPUs.
+    """
+
+    # compression is CPU-bound: a thread per CPU
+    max_workers = max_workers or os.cpu_count() or 1
+
+    fh.write(b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff") # no name, no mtime, unknown OS
+
+    crc = 0
+    size = 0
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+
+        max_pending = 2 * max_workers
+        pending = collections.deque()
+
+        # look one chunk ahead, to know which one is the last
+        chunks = iter(chunks)
+        chunk = next(chunks, None)
+
+        if chunk is None:
+            pending.append(executor.submit(_deflate, b"", level, True))
+
+        while chunk is not None:
+            following = next(chunks, None)
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            pending.append(executor.submit(_deflate, chunk, level, following is None))
+            while len(pending) > max_pending:
+                fh.write(pending.popleft().result())
+            chunk = following
+
+        while pending:
+            fh.write(pending.popleft().result())
+
+    fh.write(struct.pack("<II", crc & 0xffffffff, size & 0xffffffff))
+
+
+
+def save_labelmap_NRRD(path, mask, affine, labels, level=6):
+    """
+    Save mask (uint8, X x Y x Z) as a gzip-compressed labelmap NRRD, with
+    the geometry of affine (voxel -> RAS+) and the labels ({value: (name,
+    (r, g, b))}) as 3D Slicer segment fields.
+    """
+
+    affine = np.linalg.inv(LPS_TO_RAS) @ np.asarray(affine, dtype=np.float64)
+    vector = lambda v: "(" + ",".join(repr(float(x)) for x in v) + ")"
+
+    # the header is a fixed set of fields, written here so that the data can
+    # be streamed after it (see the NRRD0004 specification)
+    lines = [
+        "NRRD0004",
+        "type: uint8",
+        "dimension: 3",
+        "space: left-posterior-superior",
+        "sizes: " + " ".join(str(s) for s in mask.shape[:3]),
+        "space directions: " + " ".join(vector(d) for d in affine[:3, :3].T),
+        "kinds: domain domain domain",
+        "encoding: gzip",
+        "space origin: " + vector(affine[:3, 3]),
+    ]
+
+    for n, (value, (name, color)) in enumerate(sorted(labels.items())):
+        lines.append(f"Segment{n}_ID:=Segment_{value}")
+        lines.append(f"Segment{n}_Name:={name}")
+        lines.append(f"Segment{n}_LabelValue:={value}")
+        lines.append(f"Segment{n}_Layer:=0")
+        lines.append(f"Segment{n}_Color:=" + " ".join(f"{c / 255:.6g}" for c in color))
+
+    with open(path, "wb") as fh:
+        fh.write(("\n".join(lines) + "\n\n").encode("utf-8"))
+        write_gzip(fh, labelmap_chunks(mask), level)
+
+
+
+def save_labelmap_NIFTI(path, mask, affine, labels, level=6):
+    """
+    Save mask (uint8, X x Y x Z) as a NIfTI-1 labelmap (gzip-compressed if
+    path ends with .gz) with the geometry of affine; the labels ({value:
+    (name, (r, g, b))}) are stored as JSON in a comment extension.
+    """
+
+    img = nib.Nifti1Image(mask, np.asarray(affine, dtype=np.float64), dtype=np.uint8)
+
+    hdr = img.header
+    hdr.set_intent("label")
+    hdr.set_xyzt_units("mm")
+    labels_json = {str(value): {"name": name, "color": list(color)} for value, (name, color) in labels.items()}
+    hdr.extensions.append(nib.nifti1.Nifti1Extension("comment", json.dumps({"labels": labels_json}).encode("utf-8")))
+
+    head = io.BytesIO()
+    hdr.write_to(head)
+    head.write(b"\x00" * (hdr.get_data_offset() - head.tell()))
+
+    chunks = itertools.chain([head.getvalue()], labelmap_chunks(mask))
+
+    with open(path, "wb") as fh:
+        if path.lower().endswith(".gz"):
+            write_gzip(fh, chunks, level)
+        else:
+            for chunk in chunks:
+                fh.write(chunk)
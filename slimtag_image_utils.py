@@ -0,0 +1,50 @@
+# image utility functions (no GUI dependencies: usable by headless tools too)
+
+import functools
+
+import numpy as np
+
+def adjust_image(image, brightness=0, contrast=0, shadows=0):
+    """
+    Apply brightness, contrast and gamma to an image.
+
+    Parameters
+    ----------
+    image : numpy.array with dtype=uint8
+        Array representing the image to be adjusted.
+    brightness : int or float in range [-100,100]
+        The amount of brightness to be applied. A value of 0 leaves the image
+        untouched.
+    contrast : int or float in range [-100,100]
+        The amount of contrast to be applied. A value of 0 leaves the image
+        untouched.
+    shadows : int or float in range [-100,100]
+        The gamma correction to be applied. A value of 0 leaves the image
+        untouched. Internally, -100 is mapped to gamma = 0.5 and 100 is mapped
+        to gamma = 2.
+
+    Returns
+    -------
+    A numpy.array with dtype=uint8 representing the adjusted image.
+
+    """
+    # the adjustment is the same 8-bit mapping for every pixel and channel:
+    # apply it as a lookup table, without float temporaries
+    return np.take(_adjust_lut(brightness, contrast, shadows), image)
+
+@functools.lru_cache(maxsize=256)
+def _adjust_lut(brightness, contrast, shadows):
+    """
+    256-entry lookup table for adjust_image, computed with the same float32
+    operations that would be applied to each pixel.
+    """
+    lut = np.arange(256, dtype=np.float32) / 255.0
+    alpha = 1 + contrast / 100.0
+    beta = brightness / 100.0
+    gamma = 2 ** (shadows / 100.0) # math.exp2(...) might be slightly better but requires python >= 3.11
+    lut = alpha * (lut - 0.5) + 0.5 + beta
+    lut = np.clip(lut, 0.0, 1.0)
+    lut = lut ** gamma
+    lut = (255 * lut).astype(np.uint8)
+    lut.flags.writeable = False # shared by all the calls with the same parameters
+    return lut
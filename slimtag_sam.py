@@ -0,0 +1,1028 @@
+"""
+Segment Anything (SAM) support for SLImTAG.
+
+SAM can run in a separate worker process, so that heavy torch computations do
+not contend with Tk for the GIL and a crash (or an out-of-memory error) of the
+model does not take down the whole annotation session.
+
+The GUI side talks to the worker through SamWorker, which exposes the same
+set_image/predict interface as segment_anything.SamPredictor: a SamWorker
+can therefore be passed as model= to the SAM functions in slimtag_wand.
+
+Images (and the masks computed by the worker) are transferred through
+multiprocessing.shared_memory, while requests and replies travel over a pipe.
+Every request gets an ID and can be cancelled while it is still queued.
+
+Loaded models are managed by SamModelPool (both in the worker and in-process),
+which keeps recently used models resident so that switching model is fast.
+
+SamEvaluator (and SamWorkerEvaluator, its counterpart in the worker) is a
+second predictor sharing the weights of a loaded model, with its own image
+embeddings: batch computations (e.g. the Bayesian optimization of the wand
+parameters) use it without touching the embedding of the interactive session.
+"""
+import collections
+import hashlib
+import itertools
+import pickle
+import threading
+import warnings
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+
+#### Shared memory helpers
+
+def _attach_shared_memory(name):
+    """
+    Attach to an existing shared memory block.
+
+    The worker is a child of the GUI process, so both share the same resource
+    tracker: whoever unlinks the block also unregisters it.
+    """
+    return shared_memory.SharedMemory(name=name)
+
+def _array_to_shared_memory(arr):
+    """
+    Copy arr into a new shared memory block.
+
+    Return the SharedMemory object and a picklable descriptor
+    (name, shape, dtype) that can be sent to another process.
+    """
+    arr = np.ascontiguousarray(arr)
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+    return shm, (shm.name, arr.shape, arr.dtype.str)
+
+def _release_shared_memory(shm):
+    try:
+        shm.close()
+        shm.unlink()
+    except FileNotFoundError:
+        pass
+
+#### Predictor state (embeddings)
+
+def get_predictor_state(predictor):
+    """
+    Return the embedding currently held by a SamPredictor, so that it can be
+    restored later with set_predictor_state without running the encoder again.
+    """
+    return (predictor.features, predictor.original_size, predictor.input_size)
+
+def set_predictor_state(predictor, state):
+    predictor.features, predictor.original_size, predictor.input_size = state
+    predictor.is_image_set = True
+
+#### Tiled predictor
+
+class TiledSamPredictor():
+    """
+    SamPredictor wrapper for images much larger than the 1024 px encoder input.
+
+    SamPredictor downsizes the whole image so that its long side is 1024 px;
+    on very large scans this means that the magic wand works on a heavily
+    downsampled image. Here the image is instead split into overlapping tiles
+    of tile_size px, which are embedded lazily (only when a prompt falls on
+    them) and whose embeddings are kept in a LRU cache of max_cached_tiles
+    elements.
+
+    Each prompt is routed to the tile containing it (the one with the center
+    closest to the prompt, if several do). Prompts that do not fit in a single
+    tile are split among the tiles they touch, and the per-tile masks are
+    stitched together.
+
+    Images whose long side is at most min_size are embedded as a whole and
+    predict() behaves exactly as SamPredictor.predict. Otherwise predict()
+    returns a single full-size mask (the best one for each tile), with logits
+    stored as float16 to limit memory usage.
+    """
+    def __init__(self, predictor, tile_size=1024, overlap=256, min_size=4096, max_cached_tiles=16):
+        assert 0 <= overlap < tile_size
+        self.predictor = predictor
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.min_size = max(min_size, tile_size)
+        self.max_cached_tiles = max_cached_tiles
+        self.image = None # kept only in tiled mode
+        self.image_format = "RGB"
+        self.tiled = False
+        self._image_set = False
+        self._cache = collections.OrderedDict() # tile origin (x, y) -> predictor state
+        self._current = None # origin of the tile whose embedding is in self.predictor
+    
+    @property
+    def model(self):
+        return self.predictor.model
+
+    @property
+    def is_image_set(self):
+        return self._image_set
+
+    def get_state(self):
+        """
+        Embedding of the whole image (see get_predictor_state), or None in
+        tiled mode, where embeddings are computed per tile.
+        """
+        if self.tiled or not self._image_set:
+            return None
+        return get_predictor_state(self.predictor)
+
+    def set_state(self, state):
+        self._cache.clear()
+        self._current = None
+        self.image = None
+        self.tiled = False
+        set_predictor_state(self.predictor, state)
+        self._image_set = True
+
+    def set_image(self, image, image_format="RGB"):
+        self._cache.clear()
+        self._current = None
+        self.image = None
+        self._image_set = False
+        h, w = image.shape[:2]
+        self.tiled = max(h, w) > self.min_size
+        if self.tiled:
+            self.image = np.array(image) # keep a copy, tiles are embedded later
+            self.image_format = image_format
+        else:
+            self.predictor.set_image(image, image_format=image_format)
+        self._image_set = True
+
+    def _tile_starts(self, length):
+        if length <= self.tile_size:
+            return [0]
+        stride = self.tile_size - self.overlap
+        starts = list(range(0, length - self.tile_size, stride))
+        return starts + [length - self.tile_size]
+
+    def _tiles(self):
+        h, w = self.image.shape[:2]
+        return [(x, y, min(self.tile_size, w), min(self.tile_size, h))
+                for y in self._tile_starts(h) for x in self._tile_starts(w)]
+
+    def _embed(self, tile):
+        """
+        Make self.predictor hold the embedding of tile (x, y, w, h).
+        """
+        x, y, w, h = tile
+        if self._current == (x, y):
+            return
+        if (x, y) in self._cache:
+            self._cache.move_to_end((x, y))
+            set_predictor_state(self.predictor, self._cache[(x, y)])
+        else:
+            self.predictor.set_image(self.image[y:y+h, x:x+w], image_format=self.image_format)
+            self._cache[(x, y)] = get_predictor_state(self.predictor)
+            while len(self._cache) > self.max_cached_tiles:
+                self._cache.popitem(last=False)
+        self._current = (x, y)
+
+    def _route(self, point_coords, box):
+        """
+        Return the list of tiles (x, y, w, h) needed for the given prompt.
+        """
+        extremes = []
+        if point_coords is not None:
+            extremes.append(np.asarray(point_coords, dtype=np.float64).reshape(-1, 2))
+        if box is not None:
+            extremes.append(np.asarray(box, dtype=np.float64).reshape(-1, 2))
+        pts = np.concatenate(extremes)
+        x0, y0 = pts.min(axis=0)
+        x1, y1 = pts.max(axis=0)
+        tiles = self._tiles()
+        # single tile containing the whole prompt: take the most centered one
+        containing = [t for t in tiles if t[0] <= x0 and x1 < t[0]+t[2] and t[1] <= y0 and y1 < t[1]+t[3]]
+        if containing:
+            cx, cy = (x0 + x1) / 2, (y0 + y1) / 2
+            return [min(containing, key=lambda t: (t[0]+t[2]/2-cx)**2 + (t[1]+t[3]/2-cy)**2)]
+        # otherwise, all the tiles intersecting the prompt bounding box
+        return [t for t in tiles if t[0] <= x1 and x0 < t[0]+t[2] and t[1] <= y1 and y0 < t[1]+t[3]]
+
+    def predict(self, point_coords=None, point_labels=None, box=None, mask_input=None,
+                multimask_output=True, return_logits=False):
+        if not self.tiled:
+            return self.predictor.predict(point_coords=point_coords, point_labels=point_labels,
+                                          box=box, mask_input=mask_input,
+                                          multimask_output=multimask_output,
+                                          return_logits=return_logits)
+        if point_coords is None and box is None:
+            raise ValueError("Tiled SAM needs point or box prompts")
+        h, w = self.image.shape[:2]
+        if return_logits:
+            stitched = np.full((1, h, w), -np.inf, dtype=np.float16)
+        else:
+            stitched = np.zeros((1, h, w), dtype=bool)
+        best_score = -np.inf
+        best_lowres = None
+        for tile in self._route(point_coords, box):
+            tx, ty, tw, th = tile
+            offset = np.array([tx, ty])
+            coords, labels, tile_box = None, None, None
+            if point_coords is not None:
+                coords = np.asarray(point_coords).reshape(-1, 2)
+                labels = np.asarray(point_labels)
+                inside = ((coords >= offset) & (coords < offset + [tw, th])).all(axis=1)
+                coords, labels = coords[inside] - offset, labels[inside]
+            if box is not None:
+                tile_box = np.asarray(box, dtype=np.float64).reshape(2, 2) - offset
+                tile_box = np.clip(tile_box, 0, [tw - 1, th - 1]).reshape(4)
+            if tile_box is None and not (labels == 1).any():
+                continue # no foreground prompt on this tile
+            if coords is not None and len(coords) == 0:
+                coords, labels = None, None
+            self._embed(tile)
+            masks, scores, lowres = self.predictor.predict(point_coords=coords, point_labels=labels,
+                                                           box=tile_box, mask_input=None,
+                                                           multimask_output=multimask_output,
+                                                           return_logits=return_logits)
+            i = np.argmax(scores)
+            region = stitched[0, ty:ty+th, tx:tx+tw]
+            np.maximum(region, masks[i], out=region)
+            if scores[i] > best_score:
+                best_score, best_lowres = scores[i], lowres[i:i+1]
+        return stitched, np.array([best_score]), best_lowres
+
+#### Model pool
+
+def _default_device():
+    import torch
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+def _build_sam(model_type, checkpoint, device, mmap=True):
+    """
+    Build a SAM model and load its checkpoint.
+
+    With mmap=True the checkpoint is memory-mapped instead of being read in
+    RAM as a whole before being copied into the model, which halves the peak
+    memory while loading. Older torch versions (or legacy checkpoint formats)
+    fall back to the standard segment_anything loader.
+    """
+    import torch
+    import segment_anything
+    build = segment_anything.sam_model_registry[model_type]
+    state_dict = None
+    if mmap:
+        try:
+            state_dict = torch.load(checkpoint, map_location="cpu", mmap=True, weights_only=True)
+        except (TypeError, RuntimeError, pickle.UnpicklingError):
+            state_dict = None
+    if state_dict is None:
+        sam = build(checkpoint=checkpoint)
+    else:
+        sam = build(checkpoint=None)
+        sam.load_state_dict(state_dict)
+        del state_dict
+    return sam.to(device).eval()
+
+def _get_state(predictor):
+    if isinstance(predictor, TiledSamPredictor):
+        return predictor.get_state()
+    return get_predictor_state(predictor)
+
+def _set_state(predictor, state):
+    if isinstance(predictor, TiledSamPredictor):
+        predictor.set_state(state)
+    else:
+        set_predictor_state(predictor, state)
+
+def _state_nbytes(state):
+    features = state[0]
+    return features.numel() * features.element_size()
+
+def _state_to(state, device):
+    """
+    Predictor state with its features moved to device (the same state if
+    already there).
+    """
+    features = state[0]
+    if str(features.device) == str(device):
+        return state
+    return (features.to(device),) + tuple(state[1:])
+
+def _new_predictor(sam, tiling=None):
+    from segment_anything import SamPredictor
+    predictor = SamPredictor(sam)
+    if tiling:
+        predictor = TiledSamPredictor(predictor, **tiling)
+    return predictor
+
+def _new_embeddings():
+    return {"image_key": None, # digest of the image embedded in the predictor
+            "embeddings": collections.OrderedDict(), # digest -> predictor state, LRU order
+            "embeddings_size": 0}
+
+def _cached_set_image(cache, predictor, image, image_format, max_bytes):
+    """
+    Embed image into predictor, unless its embedding is in cache (a dict
+    from _new_embeddings, holding at most max_bytes of embeddings).
+    """
+    key = _image_digest(image, image_format)
+    if _cached_restore(cache, predictor, key):
+        return # embedding already computed by this model
+    cache["image_key"] = None
+    predictor.set_image(image, image_format=image_format)
+    cache["image_key"] = key
+    _store_embedding(cache, key, _get_state(predictor), max_bytes)
+
+def _store_embedding(cache, key, state, max_bytes):
+    """
+    Add the predictor state of the image with digest key to cache (a dict
+    from _new_embeddings), dropping the least recently used ones beyond
+    max_bytes. Cached states are kept in RAM, not on the GPU: they are
+    moved back to the model device when restored (a few ms, against the
+    encoder run they save).
+    """
+    if state is None or _state_nbytes(state) > max_bytes or key in cache["embeddings"]:
+        return
+    state = _state_to(state, "cpu")
+    cache["embeddings"][key] = state
+    cache["embeddings_size"] += _state_nbytes(state)
+    while cache["embeddings_size"] > max_bytes:
+        _, old = cache["embeddings"].popitem(last=False)
+        cache["embeddings_size"] -= _state_nbytes(old)
+
+def _cached_restore(cache, predictor, key):
+    """
+    Make predictor hold the embedding with digest key, if it is in cache.
+    Return True on success.
+    """
+    if cache["image_key"] == key and predictor.is_image_set:
+        return True
+    if key not in cache["embeddings"]:
+        return False
+    cache["embeddings"].move_to_end(key)
+    _set_state(predictor, _state_to(cache["embeddings"][key], predictor.model.device))
+    cache["image_key"] = key
+    return True
+
+def _image_digest(image, image_format):
+    """
+    Fingerprint of an image, to recognize an image that has already been
+    embedded (hashing is much faster than running the SAM encoder).
+    """
+    image = np.ascontiguousarray(image)
+    digest = hashlib.blake2b(image.data, digest_size=16)
+    digest.update(repr((image.shape, image.dtype.str, image_format)).encode())
+    return digest.hexdigest()
+
+class SamModelPool():
+    """
+    Keep recently used SAM models resident, within a memory budget.
+
+    Models are identified by the pair (model_type, checkpoint). Checkpoints
+    are loaded in a background thread: prefetch() starts loading a model
+    without waiting for it, select() makes a model the active one (waiting for
+    it to be loaded if needed). When the models in memory exceed memory_budget
+    (in MB), the least recently used ones are dropped; the active model is
+    never dropped, so a single model larger than the budget can still be used.
+
+    Each resident model keeps the embeddings of the last images it has seen
+    (up to embedding_cache MB per model), identified by a digest of the image:
+    set_image() with one of those images skips the encoder, so going back to a
+    previously used model or image does not recompute the embedding.
+    image_key is the digest of the current image, and restore(image_key)
+    brings back a cached embedding without passing the image again.
+    precompute() fills the cache with the embedding of an image that is not
+    shown yet (e.g. the next slices of a volume), on a separate predictor.
+
+    The pool behaves like segment_anything.SamPredictor (set_image and predict
+    are forwarded to the predictor of the active model), so it can be used as
+    model= in slimtag_wand.sam_preprocessing and slimtag_wand.sam_inference.
+    """
+    def __init__(self, device=None, tiling=None, memory_budget=4096, mmap=True, embedding_cache=1024):
+        self.device = device # None means "cuda if available, else cpu"
+        self.tiling = tiling # None, or keyword arguments for TiledSamPredictor
+        self.memory_budget = memory_budget * 2**20
+        self.mmap = mmap
+        self.embedding_cache = embedding_cache * 2**20
+        # a single loader thread: loading is bound by disk and memory bandwidth
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict() # (model_type, checkpoint) -> entry dict, LRU order
+        self._active = None
+        self._embedding_lock = threading.Lock() # precompute() may run in another thread
+
+    def _load(self, key):
+        model_type, checkpoint = key
+        if self.device is None:
+            self.device = _default_device()
+        sam = _build_sam(model_type, checkpoint, self.device, mmap=self.mmap)
+        size = sum(t.numel() * t.element_size() for t in itertools.chain(sam.parameters(), sam.buffers()))
+        return _new_predictor(sam, self.tiling), size
+
+    def prefetch(self, model_type, checkpoint):
+        """
+        Start loading a model in background (if not already resident).
+
+        Return a Future, which is done when the model is loaded.
+        """
+        key = (model_type, checkpoint)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._new_entry(self._executor.submit(self._load, key))
+                self._entries[key] = entry
+        entry["future"].add_done_callback(lambda f: self._loaded(key, f))
+        return entry["future"]
+
+    @staticmethod
+    def _new_entry(future):
+        return {"future": future, **_new_embeddings()}
+
+    def _loaded(self, key, future):
+        with self._lock:
+            if future.exception() is not None:
+                # forget failed loads, so that they can be retried
+                if key in self._entries and self._entries[key]["future"] is future:
+                    del self._entries[key]
+                return
+            self._evict()
+
+    def _evict(self):
+        """
+        Drop least recently used models until the budget is met. Must be
+        called with self._lock held.
+        """
+        loaded = [(key, entry) for key, entry in self._entries.items()
+                  if entry["future"].done() and entry["future"].exception() is None]
+        total = sum(entry["future"].result()[1] for _, entry in loaded)
+        evicted = False
+        for key, entry in loaded: # LRU first
+            if total <= self.memory_budget:
+                break
+            if key == self._active:
+                continue
+            total -= entry["future"].result()[1]
+            del self._entries[key]
+            evicted = True
+        if evicted and self.device is not None and str(self.device).startswith("cuda"):
+            import torch
+            torch.cuda.empty_cache()
+
+    def select(self, model_type, checkpoint):
+        """
+        Make a model the active one, loading it if needed (blocking).
+        """
+        key = (model_type, checkpoint)
+        future = self.prefetch(model_type, checkpoint)
+        future.result() # raise if loading failed
+        with self._lock:
+            if key not in self._entries: # dropped meanwhile: should not happen, but be safe
+                self._entries[key] = self._new_entry(future)
+            self._entries.move_to_end(key)
+            self._active = key
+            self._evict()
+
+    def _active_entry(self):
+        with self._lock:
+            if self._active is None:
+                raise RuntimeError("No SAM model selected")
+            return self._entries[self._active]
+
+    @property
+    def predictor(self):
+        return self._active_entry()["future"].result()[0]
+
+    @property
+    def model(self):
+        return self.predictor.model
+
+    @property
+    def is_image_set(self):
+        entry = self._active_entry()
+        return entry["image_key"] is not None and entry["future"].result()[0].is_image_set
+
+    @property
+    def image_key(self):
+        return self._active_entry()["image_key"]
+
+    def resident_models(self):
+        """
+        List of (model_type, checkpoint) currently loaded, least recently used first.
+        """
+        with self._lock:
+            return [key for key, entry in self._entries.items() if entry["future"].done()]
+
+    def set_image(self, image, image_format="RGB"):
+        entry = self._active_entry()
+        with self._embedding_lock:
+            _cached_set_image(entry, entry["future"].result()[0], image, image_format, self.embedding_cache)
+
+    def restore(self, key):
+        """
+        Make the active model hold the embedding of the image with digest key
+        (see image_key), if it is still cached. Return True on success.
+        """
+        entry = self._active_entry()
+        with self._embedding_lock:
+            return _cached_restore(entry, entry["future"].result()[0], key)
+
+    def precompute(self, image, image_format="RGB"):
+        """
+        Add the embedding of image to the cache of the active model, without
+        changing its current image: a later set_image() of the same image
+        skips the encoder. Return the digest of image.
+        """
+        entry = self._active_entry()
+        key = _image_digest(image, image_format)
+        with self._embedding_lock:
+            if key == entry["image_key"] or key in entry["embeddings"]:
+                return key
+            scratch = entry.get("scratch")
+            if scratch is None: # shares the weights of the active predictor
+                scratch = entry["scratch"] = _new_predictor(entry["future"].result()[0].model, self.tiling)
+        scratch.set_image(image, image_format=image_format)
+        with self._embedding_lock:
+            _store_embedding(entry, key, _get_state(scratch), self.embedding_cache)
+        return key
+
+    def evaluator(self, embedding_cache=None):
+        """
+        SamEvaluator for the active model, caching up to embedding_cache MB
+        of embeddings (default: the same as the pool).
+        """
+        if embedding_cache is None:
+            embedding_cache = self.embedding_cache // 2**20
+        return SamEvaluator(self.predictor.model, tiling=self.tiling, embedding_cache=embedding_cache)
+
+    def predict(self, point_coords=None, point_labels=None, box=None, mask_input=None,
+                multimask_output=True, return_logits=False):
+        return self.predictor.predict(point_coords=point_coords, point_labels=point_labels,
+                                      box=box, mask_input=mask_input,
+                                      multimask_output=multimask_output,
+                                      return_logits=return_logits)
+
+class SamEvaluator():
+    """
+    Predictor sharing the weights of a loaded model (sam), with its own
+    embedding and its own cache of embeddings (up to embedding_cache MB,
+    kept in RAM: only the current embedding is on the model device).
+
+    Images are embedded once (as long as the cache has room), and restore()
+    brings an embedding back for the mask decoder; the predictor of the
+    interactive session (e.g. SamModelPool) is never touched. It can be used
+    as model= in slimtag_wand.sam_preprocessing and slimtag_wand.sam_inference.
+    """
+    def __init__(self, sam, tiling=None, embedding_cache=1024):
+        self.predictor = _new_predictor(sam, tiling)
+        self.embedding_cache = embedding_cache * 2**20
+        self._cache = _new_embeddings()
+
+    @property
+    def is_image_set(self):
+        return self._cache["image_key"] is not None and self.predictor.is_image_set
+
+    @property
+    def image_key(self):
+        return self._cache["image_key"]
+
+    def set_image(self, image, image_format="RGB"):
+        _cached_set_image(self._cache, self.predictor, image, image_format, self.embedding_cache)
+
+    def restore(self, key):
+        return _cached_restore(self._cache, self.predictor, key)
+
+    def predict(self, point_coords=None, point_labels=None, box=None, mask_input=None,
+                multimask_output=True, return_logits=False):
+        return self.predictor.predict(point_coords=point_coords, point_labels=point_labels,
+                                      box=box, mask_input=mask_input,
+                                      multimask_output=multimask_output,
+                                      return_logits=return_logits)
+
+    def close(self):
+        self._cache = _new_embeddings()
+
+#### Worker process
+
+def _sam_worker_main(conn, device=None, tiling=None, pool_options=None):
+    """
+    Main loop of the SAM worker process.
+
+    Messages are triples (command, request_id, payload). Replies are triples
+    (status, request_id, result) with status among "ok", "error", "cancelled".
+    Queued requests are served in order; a ("cancel", _, request_id) message
+    drops the corresponding request if it has not started yet.
+
+    If tiling is not None, it is a dict of keyword arguments for
+    TiledSamPredictor, which then wraps the SamPredictor. pool_options are
+    further keyword arguments for SamModelPool (memory_budget, mmap,
+    embedding_cache).
+    """
+    import torch
+    warnings.filterwarnings(
+        "ignore",
+        message="You are using `torch.load` with `weights_only=False`"
+    )
+    if device is None:
+        device = _default_device()
+
+    pool = SamModelPool(device=device, tiling=tiling, **(pool_options or {}))
+    evaluators = {} # request_id of the creation -> SamEvaluator
+
+    def load_model(payload):
+        pool.select(*payload)
+        return device
+
+    def prefetch_model(payload):
+        pool.prefetch(*payload) # do not wait: the model is loaded in background
+        return None
+
+    # commands for an evaluator have payload (evaluator_id, payload), see SamWorkerEvaluator
+    def set_image(payload, target=pool):
+        (name, shape, dtype), image_format = payload
+        shm = _attach_shared_memory(name)
+        try:
+            # set_image resizes the image, so it never keeps a reference to the buffer
+            target.set_image(np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf),
+                             image_format=image_format)
+        finally:
+            shm.close()
+        return target.image_key
+
+    def restore(payload, target=pool):
+        return target.restore(payload)
+
+    def precompute(payload):
+        (name, shape, dtype), image_format = payload
+        shm = _attach_shared_memory(name)
+        try:
+            return pool.precompute(np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf),
+                                   image_format=image_format)
+        finally:
+            shm.close()
+
+    def predict(payload, target=pool):
+        with torch.no_grad():
+            masks, scores, logits = target.predict(**payload)
+        # masks can be large (full image size): send them back through shared memory
+        shm, descriptor = _array_to_shared_memory(masks)
+        shm.close() # the GUI process copies and unlinks it
+        return descriptor, scores, logits
+
+    def new_evaluator(payload):
+        evaluator_id, embedding_cache = payload
+        evaluators[evaluator_id] = pool.evaluator(embedding_cache)
+
+    def close_evaluator(payload):
+        evaluators.pop(payload, None)
+
+    def on_evaluator(handler):
+        return lambda payload: handler(payload[1], target=evaluators[payload[0]])
+
+    handlers = {"load": load_model, "prefetch": prefetch_model,
+                "set_image": set_image, "restore": restore, "predict": predict, "precompute": precompute,
+                "evaluator": new_evaluator, "close_evaluator": close_evaluator,
+                "eval_set_image": on_evaluator(set_image), "eval_restore": on_evaluator(restore),
+                "eval_predict": on_evaluator(predict)}
+
+    queue = collections.deque()
+    cancelled = set()
+
+    def enqueue(msg):
+        if msg[0] == "cancel":
+            cancelled.add(msg[2])
+        else:
+            queue.append(msg)
+
+    while True:
+        try:
+            if not queue:
+                enqueue(conn.recv()) # block until there is something to do
+            while conn.poll(): # collect everything already sent, cancellations included
+                enqueue(conn.recv())
+        except EOFError: # GUI process is gone
+            break
+        if not queue:
+            continue
+        cmd, request_id, payload = queue.popleft()
+        if cmd == "shutdown":
+            break
+        if request_id in cancelled:
+            cancelled.discard(request_id)
+            conn.send(("cancelled", request_id, None))
+            continue
+        try:
+            result = handlers[cmd](payload)
+        except Exception as exc:
+            conn.send(("error", request_id, f"{type(exc).__name__}: {exc}"))
+        else:
+            conn.send(("ok", request_id, result))
+
+#### GUI side
+
+class SamWorker():
+    """
+    Handle to a SAM model living in a separate process.
+
+    The object behaves like segment_anything.SamPredictor (set_image and
+    predict have the same signature), so it can be used as model= in
+    slimtag_wand.sam_preprocessing and slimtag_wand.sam_inference.
+
+    Usage:
+        worker = SamWorker()
+        worker.load_model("vit_b", "models/sam_vit_b_01ec64.pth")
+        worker.set_image(image) # numpy array (H, W, 3) with dtype uint8
+        masks, scores, logits = worker.predict(point_coords=np.array([[x, y]]),
+                                               point_labels=np.array([1]))
+
+    Models are kept in a SamModelPool inside the worker: load_model on a
+    model used recently is almost instant, and prefetch_model loads a model in
+    background. pool_options are keyword arguments for SamModelPool.
+
+    If the worker dies, pending and subsequent requests raise RuntimeError
+    until restart() is called; restart() reloads the last model, but the image
+    has to be set again.
+    """
+    def __init__(self, device=None, tiling=None, pool_options=None):
+        self.device = device # None means "let the worker choose"
+        self.tiling = tiling # None, or keyword arguments for TiledSamPredictor
+        self.pool_options = pool_options # None, or keyword arguments for SamModelPool
+        self._ctx = mp.get_context("spawn") # never fork a process with Tk and torch state
+        self._process = None
+        self._conn = None
+        self._listener = None
+        self._send_lock = threading.Lock()
+        self._futures = {}
+        self._futures_lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._image_requests = set() # pending set_image requests, superseded by newer ones
+        self._precompute_requests = set() # pending precompute requests, which yield to set_image
+        self.model = None # (model_type, checkpoint) of the last loaded model
+        self.is_image_set = False
+        self.image_key = None # digest of the current image (see SamModelPool)
+
+    def start(self):
+        if self.is_alive():
+            return
+        parent_conn, child_conn = self._ctx.Pipe()
+        self._process = self._ctx.Process(target=_sam_worker_main,
+                                          args=(child_conn, self.device, self.tiling, self.pool_options),
+                                          daemon=True)
+        self._process.start()
+        child_conn.close()
+        self._conn = parent_conn
+        self.is_image_set = False
+        self._listener = threading.Thread(target=self._listen, args=(parent_conn,), daemon=True)
+        self._listener.start()
+
+    def is_alive(self):
+        return self._process is not None and self._process.is_alive()
+
+    def shutdown(self, timeout=2.0):
+        if self._process is None:
+            return
+        try:
+            self._send("shutdown", next(self._ids), None)
+        except RuntimeError:
+            pass
+        self._process.join(timeout)
+        if self._process.is_alive():
+            self._process.kill()
+            self._process.join()
+        self._conn.close()
+        self._process = None
+        self._fail_pending("SAM worker has been shut down")
+
+    def restart(self):
+        """
+        Kill the worker (if still running), start a new one and reload the
+        last model. The image has to be set again by the caller.
+        """
+        if self._process is not None:
+            self._process.kill()
+            self._process.join()
+            self._conn.close()
+            self._process = None
+            self._fail_pending("SAM worker has been restarted")
+        self.start()
+        if self.model is not None:
+            self.load_model(*self.model)
+
+    # low-level requests
+    def submit(self, cmd, payload=None):
+        """
+        Send a request to the worker without waiting for it.
+
+        Return the pair (request_id, future); request_id can be passed to
+        cancel().
+        """
+        if not self.is_alive():
+            raise RuntimeError("SAM worker is not running")
+        request_id = next(self._ids)
+        future = Future()
+        with self._futures_lock:
+            self._futures[request_id] = future
+        self._send(cmd, request_id, payload)
+        return request_id, future
+
+    def cancel(self, request_id):
+        """
+        Cancel a request, if the worker has not started serving it yet.
+        """
+        with self._futures_lock:
+            if request_id not in self._futures:
+                return
+        self._send("cancel", next(self._ids), request_id)
+
+    def _send(self, cmd, request_id, payload):
+        with self._send_lock:
+            try:
+                self._conn.send((cmd, request_id, payload))
+            except (OSError, ValueError, AttributeError) as exc:
+                raise RuntimeError("SAM worker is not running") from exc
+
+    def _listen(self, conn):
+        while True:
+            try:
+                status, request_id, result = conn.recv()
+            except (EOFError, OSError): # worker crashed or connection closed
+                break
+            with self._futures_lock:
+                future = self._futures.pop(request_id, None)
+            if future is None:
+                continue
+            if status == "ok":
+                future.set_result(result)
+            elif status == "cancelled":
+                future.cancel()
+                future.set_running_or_notify_cancel()
+            else:
+                future.set_exception(RuntimeError(f"SAM worker error: {result}"))
+        if conn is self._conn:
+            self._fail_pending("SAM worker terminated unexpectedly")
+
+    def _fail_pending(self, message):
+        with self._futures_lock:
+            futures = list(self._futures.values())
+            self._futures.clear()
+        for future in futures:
+            if not future.done():
+                future.set_exception(RuntimeError(message))
+        self._image_requests.clear()
+        self._precompute_requests.clear()
+        self.is_image_set = False
+        self.image_key = None
+
+    # SamPredictor-like interface
+    def load_model(self, model_type, checkpoint):
+        """
+        Make a model the active one in the worker, starting the worker if
+        needed. Blocks until the checkpoint is loaded (if not already resident).
+        """
+        self.start()
+        self.model = (model_type, checkpoint)
+        self.is_image_set = False
+        self.image_key = None
+        _, future = self.submit("load", (model_type, checkpoint))
+        self.device = future.result()
+
+    def prefetch_model(self, model_type, checkpoint):
+        """
+        Start loading a model in the worker, without waiting for it and
+        without changing the active model.
+        """
+        self.start()
+        self.submit("prefetch", (model_type, checkpoint))
+
+    def set_image(self, image, image_format="RGB"):
+        """
+        Embed image into the model. Previous set_image requests that are still
+        queued are cancelled, since their result would be overwritten anyway.
+
+        Raise CancelledError if this request is in turn superseded by a newer one.
+        """
+        for request_id in list(self._image_requests) + list(self._precompute_requests):
+            self.cancel(request_id)
+        self.is_image_set = False
+        self.image_key = None
+        shm, descriptor = _array_to_shared_memory(image)
+        try:
+            request_id, future = self.submit("set_image", (descriptor, image_format))
+        except RuntimeError:
+            _release_shared_memory(shm)
+            raise
+        self._image_requests.add(request_id)
+        future.add_done_callback(lambda f: _release_shared_memory(shm))
+        try:
+            image_key = future.result()
+        finally:
+            self._image_requests.discard(request_id)
+        self.image_key = image_key
+        self.is_image_set = True
+
+    def precompute(self, image, image_format="RGB"):
+        """
+        Embed image in the worker without changing the current image (see
+        SamModelPool.precompute). Return the digest of image.
+
+        Raise CancelledError if a set_image request is sent while this one is
+        still queued: the image shown comes first.
+        """
+        shm, descriptor = _array_to_shared_memory(image)
+        try:
+            request_id, future = self.submit("precompute", (descriptor, image_format))
+        except RuntimeError:
+            _release_shared_memory(shm)
+            raise
+        self._precompute_requests.add(request_id)
+        future.add_done_callback(lambda f: _release_shared_memory(shm))
+        try:
+            return future.result()
+        finally:
+            self._precompute_requests.discard(request_id)
+
+    def restore(self, key):
+        """
+        Bring back the embedding of a previous image, if still cached in the
+        worker (see SamModelPool.restore). Return True on success.
+        """
+        if self.is_image_set and key == self.image_key:
+            return True
+        _, future = self.submit("restore", key)
+        if not future.result():
+            return False
+        self.image_key = key
+        self.is_image_set = True
+        return True
+
+    def predict(self, point_coords=None, point_labels=None, box=None, mask_input=None,
+                multimask_output=True, return_logits=False):
+        payload = {"point_coords": point_coords, "point_labels": point_labels,
+                   "box": box, "mask_input": mask_input,
+                   "multimask_output": multimask_output, "return_logits": return_logits}
+        _, future = self.submit("predict", payload)
+        return self._masks_result(future)
+
+    @staticmethod
+    def _masks_result(future):
+        (name, shape, dtype), scores, logits = future.result()
+        shm = _attach_shared_memory(name)
+        try:
+            masks = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf).copy()
+        finally:
+            _release_shared_memory(shm)
+        return masks, scores, logits
+
+    def evaluator(self, embedding_cache=None):
+        """
+        SamWorkerEvaluator for the active model of the worker (see SamEvaluator).
+        """
+        if self.model is None:
+            raise RuntimeError("No SAM model selected")
+        return SamWorkerEvaluator(self, embedding_cache)
+
+class SamWorkerEvaluator():
+    """
+    Handle to a SamEvaluator living in the SAM worker: same interface as
+    SamEvaluator, and the same requests as SamWorker, which are served by
+    the worker in order with the interactive ones.
+    """
+    def __init__(self, worker, embedding_cache=None):
+        self._worker = worker
+        _, future = worker.submit("evaluator", (id(self), embedding_cache))
+        future.result()
+        self.is_image_set = False
+        self.image_key = None
+
+    def _request(self, cmd, payload):
+        _, future = self._worker.submit(cmd, (id(self), payload))
+        return future
+
+    def set_image(self, image, image_format="RGB"):
+        self.is_image_set = False
+        self.image_key = None
+        shm, descriptor = _array_to_shared_memory(image)
+        try:
+            future = self._request("eval_set_image", (descriptor, image_format))
+        except RuntimeError:
+            _release_shared_memory(shm)
+            raise
+        future.add_done_callback(lambda f: _release_shared_memory(shm))
+        self.image_key = future.result()
+        self.is_image_set = True
+
+    def restore(self, key):
+        if self.is_image_set and key == self.image_key:
+            return True
+        if not self._request("eval_restore", key).result():
+            return False
+        self.image_key = key
+        self.is_image_set = True
+        return True
+
+    def predict(self, point_coords=None, point_labels=None, box=None, mask_input=None,
+                multimask_output=True, return_logits=False):
+        payload = {"point_coords": point_coords, "point_labels": point_labels,
+                   "box": box, "mask_input": mask_input,
+                   "multimask_output": multimask_output, "return_logits": return_logits}
+        return SamWorker._masks_result(self._request("eval_predict", payload))
+
+    def close(self):
+        try:
+            self._worker.submit("close_evaluator", id(self))
+        except RuntimeError: # worker not running: nothing to free
+            pass
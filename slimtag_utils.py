@@ -10,6 +10,7 @@ import re
 import numpy as np
 
 from slimtag_color_utils import rgb_to_hex, hex_to_rgb, rgb_to_hsv, hsv_to_rgb
+from slimtag_image_utils import adjust_image, _adjust_lut # re-exported (used by the GUI)
 
 class MultiButtonDialog(ctk.CTkToplevel):
     """
@@ -615,7 +616,9 @@ class PreprocessingAdjustments(ctk.CTkToplevel):
         
     def update_display(self):
         self.preview_canvas.delete("all")
-        image = Image.fromarray(adjust_image(np.array(self.image), self.brightness, self.contrast, self.shadows))
+        # same lookup table as adjust_image, applied by PIL to each band (no numpy round trip)
+        lut = _adjust_lut(self.brightness, self.contrast, self.shadows).tolist()
+        image = self.image.point(lut * len(self.image.getbands()))
         self.tk_img = ImageTk.PhotoImage(image)
         self.preview_canvas.create_image(self.canvas_size/2, self.canvas_size/2, anchor="center", image=self.tk_img, tag="background_image")
     
@@ -642,40 +645,6 @@ class PreprocessingAdjustments(ctk.CTkToplevel):
         y = py + (ph - h) // 2
         self.geometry(f"+{x}+{y}")
 
-def adjust_image(image, brightness=0, contrast=0, shadows=0):
-    """
-    Apply brightness, contrast and gamma to an image.
-
-    Parameters
-    ----------
-    image : numpy.array with dtype=uint8
-        Array representing the image to be adjusted.
-    brightness : int or float in range [-100,100]
-        The amount of brightness to be applied. A value of 0 leaves the image
-        untouched.
-    contrast : int or float in range [-100,100]
-        The amount of contrast to be applied. A value of 0 leaves the image
-        untouched.
-    shadows : int or float in range [-100,100]
-        The gamma correction to be applied. A value of 0 leaves the image
-        untouched. Internally, -100 is mapped to gamma = 0.5 and 100 is mapped
-        to gamma = 2.
-
-    Returns
-    -------
-    A numpy.array with dtype=uint8 representing the adjusted image.
-
-    """
-    img = image.astype(np.float32) / 255.0
-    alpha = 1 + contrast / 100.0
-    beta = brightness / 100.0
-    gamma = 2 ** (shadows / 100.0) # math.exp2(...) might be slightly better but requires python >= 3.11
-    img = alpha * (img - 0.5) + 0.5 + beta
-    img = np.clip(img, 0.0, 1.0)
-    img = img ** gamma
-    return (255 * img).astype(np.uint8)
-
-
 class Tooltip():
     '''
     Create a tooltip for a given widget as the mouse hovers over it.
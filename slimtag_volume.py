@@ -0,0 +1,650 @@
+# -*- coding: utf-8 -*-
+"""
+Display of biomedical volumes.
+
+VolumeDisplay maps the slices of a volume (numpy array, memory-mapped array
+or slimtag_biomedical.LazyVolume, in its native dtype) to uint8 through an
+intensity window, one block of slices at a time: the volume is never
+converted as a whole. Converted blocks are kept in a LRU cache, and
+changing the window only drops the cache, so that just the slices actually
+shown are converted again. Slices can be taken along any axis (axial,
+coronal, sagittal, see VOLUME_PLANES and plane_view): coronal and sagittal
+reslices are gathered from the cached blocks.
+
+The default ("Auto") window spans the 1st-99th percentiles of the
+intensities, computed from a histogram streamed over the volume chunk by
+chunk (exact for 8/16-bit integer volumes, estimated on a subsample
+otherwise); the same pass builds the downsampled volume for the slider
+preview.
+
+Volumes keep the (X, Y, Z) orientation of the files, with slices
+volume[..., z]; arrays created here (masks, previews) are stored Z-major,
+i.e. as (Z, X, Y) seen through a transposed view, so that every slice is a
+contiguous block of memory (see empty_z_major).
+
+SlicePrefetcher keeps what is needed to show a slice (e.g. the RGB image and
+the magic wand preprocessing) for the slices around the current one, and
+fills it in background in the direction of navigation, so that stepping
+through the volume does not wait for any computation.
+
+Volume masks are kept in a SparseVolumeMask, which stores only the
+non-empty slices, cropped to their labelled voxels; the slice being edited
+is a dense copy, written back when leaving it.
+
+Volume masks are saved as TAR archives of indexed PNGs, one per non-empty
+slice, plus a meta.json (see write_mask_tar and read_mask_tar); the PNGs
+are encoded and decoded in a thread pool.
+"""
+import io
+import os
+import json
+import tarfile
+import collections
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+# (level, width) in Hounsfield units
+WINDOW_PRESETS = {
+    "CT lung": (-600, 1500),
+    "CT bone": (400, 1800),
+    "CT brain": (40, 80),
+    "CT soft tissue": (40, 400),
+    }
+
+# plane name -> axis of the volume orthogonal to it
+VOLUME_PLANES = {"Axial": 2, "Coronal": 0, "Sagittal": 1}
+
+BLOCK_SIZE = 4 * 2**20 # bytes of converted slices read and cached together
+
+def plane_view(volume, axis, index):
+    """
+    Slice index of volume along axis, as a view oriented for display: axial
+    slices (axis 2) are volume[:, :, index]; coronal and sagittal slices
+    (axis 0 and 1) have z along the rows, increasing upwards. Writing to
+    the view writes to volume.
+    """
+    if axis == 2:
+        return volume[:, :, index]
+    plane = volume[index] if axis == 0 else volume[:, index]
+    return np.swapaxes(plane, 0, 1)[::-1]
+
+def plane_shape(shape, axis):
+    """
+    (rows, columns) of plane_view(volume, axis, ...), with shape the shape of volume.
+    """
+    if axis == 2:
+        return shape[0], shape[1]
+    return shape[2], (shape[1] if axis == 0 else shape[0])
+
+def plane_position(shape, axis, point):
+    """
+    (row, column) of the voxel point = (x, y, z) in plane_view(volume, axis, ...),
+    with shape the shape of volume.
+    """
+    x, y, z = point
+    if axis == 2:
+        return x, y
+    return shape[2] - 1 - z, (y if axis == 0 else x)
+
+def plane_point(shape, axis, index, row, col):
+    """
+    Voxel (x, y, z) at (row, col) of plane_view(volume, axis, index), with
+    shape the shape of volume (inverse of plane_position).
+    """
+    if axis == 2:
+        return row, col, index
+    z = shape[2] - 1 - row
+    return (index, col, z) if axis == 0 else (col, index, z)
+
+def empty_z_major(shape, dtype=np.uint8):
+    """
+    Uninitialized array with shape (X, Y, Z, ...), stored as (Z, X, Y, ...):
+    each slice [..., z] (i.e. [:, :, z]) is C-contiguous.
+    """
+    return np.moveaxis(np.empty((shape[2],) + tuple(shape[:2]) + tuple(shape[3:]), dtype=dtype), 0, 2)
+
+def zeros_z_major(shape, dtype=np.uint8):
+    """
+    Same as empty_z_major, filled with zeros.
+    """
+    return np.moveaxis(np.zeros((shape[2],) + tuple(shape[:2]) + tuple(shape[3:]), dtype=dtype), 0, 2)
+
+class VolumeDisplay():
+    """
+    uint8 slices of a volume, for display.
+
+    Parameters
+    ----------
+    volume : array-like with shape (X, Y, Z)
+        The volume; slices are volume[..., z].
+    cache_size : int
+        MB of converted slices to keep. A coronal or sagittal reslice needs
+        all the slices: while those planes are shown (see set_axis), the
+        cache grows to hold the whole converted volume (X*Y*Z bytes).
+    preview_dim : int or None
+        Maximum size of the slices of the downsampled preview volume (None:
+        no preview).
+    rescale : (slope, intercept)
+        Map from stored values to physical units (e.g. DICOM Rescale
+        Slope/Intercept), used by the window presets.
+    chunk_size : int
+        MB of the volume read at once when computing the histogram.
+    """
+    def __init__(self, volume, cache_size=256, preview_dim=None, rescale=(1.0, 0.0), chunk_size=64):
+        self.volume = volume
+        self.shape = tuple(volume.shape)
+        self.rescale = rescale
+        self.cache_size = self.axial_cache_size = cache_size * 2**20
+        self._cache = collections.OrderedDict() # block index -> uint8 slices (Z-major), LRU order
+        self._cache_bytes = 0
+        self._lock = threading.Lock() # slices may be requested by a prefetch thread too
+        voxel_bytes = int(np.prod(self.shape[:2] + self.shape[3:]))
+        self.block_slices = max(1, BLOCK_SIZE // voxel_bytes)
+        self.volume_bytes = voxel_bytes * self.shape[2] # the whole volume as uint8
+        self.preview = None # downsampled volume, in the native dtype
+        self.preview_scale = 1.0
+        self.auto_window = self._scan(preview_dim, chunk_size * 2**20)
+        self.window = self.auto_window
+        self.preset = "Auto"
+
+    def _scan(self, preview_dim, chunk_bytes):
+        """
+        Read the volume once, chunk by chunk: build the preview and return the
+        1st-99th percentile window.
+        """
+        nx, ny, nz = self.shape[:3]
+        dtype = np.dtype(self.volume.dtype)
+        if preview_dim is not None:
+            scale = self.preview_scale = max(nx, ny) / preview_dim
+            new_x = np.linspace(0, nx-1, int(nx / scale)).astype(np.int32)
+            new_y = np.linspace(0, ny-1, int(ny / scale)).astype(np.int32)
+            self.preview = empty_z_major((len(new_x), len(new_y), nz), dtype=dtype)
+        exact = dtype.kind in "ui" and dtype.itemsize <= 2
+        if exact:
+            offset = -np.iinfo(dtype).min # histogram bin 0 is the minimum of the dtype
+            counts = np.zeros(np.iinfo(dtype).max + offset + 1, dtype=np.int64)
+        else:
+            sample = []
+            step = max(1, int(np.ceil(np.sqrt(nx * ny * nz / 2**22)))) # about 4M samples
+        slices_per_chunk = max(1, chunk_bytes // max(1, nx * ny * dtype.itemsize))
+        for z0 in range(0, nz, slices_per_chunk):
+            chunk = np.asarray(self.volume[:, :, z0:z0+slices_per_chunk])
+            if self.preview is not None:
+                self.preview[..., z0:z0+chunk.shape[2]] = chunk[new_x][:, new_y]
+            if exact:
+                values = chunk.ravel()
+                if offset:
+                    values = values.astype(np.int32) + offset
+                counts += np.bincount(values, minlength=len(counts))
+            else:
+                sample.append(np.asarray(chunk[::step, ::step], dtype=np.float32).ravel())
+        if exact:
+            cdf = np.cumsum(counts)
+            v_min, v_max = (np.searchsorted(cdf, q * cdf[-1]) - offset for q in (0.01, 0.99))
+        else:
+            v_min, v_max = np.percentile(np.concatenate(sample), (1, 99))
+        # small check if there are not enough different values (e.g. volumes already representing masks)
+        # to avoid division by zero
+        # done with np.isclose just for additional safety (v_min==v_max should be sufficient)
+        if np.isclose(v_min, v_max):
+            v_min, v_max = 0, 1 # do not change array
+        return float(v_min), float(v_max)
+
+    def set_window(self, v_min, v_max):
+        """
+        Map stored values v_min..v_max to 0..255 (converted slices are dropped).
+        """
+        with self._lock:
+            if (v_min, v_max) == self.window:
+                return
+            self.window = (v_min, v_max)
+            self._cache.clear()
+            self._cache_bytes = 0
+
+    def set_preset(self, name):
+        """
+        Use one of WINDOW_PRESETS (in physical units), or "Auto" for the
+        percentile window.
+        """
+        self.preset = name
+        if name == "Auto":
+            self.set_window(*self.auto_window)
+            return
+        level, width = WINDOW_PRESETS[name]
+        slope, intercept = self.rescale
+        slope = slope or 1.0 # a zero slope (broken header) would map everything to one value
+        low, high = sorted(((level - width / 2 - intercept) / slope, (level + width / 2 - intercept) / slope))
+        self.set_window(low, high)
+
+    def to_uint8(self, arr, window=None):
+        """
+        Map (a part of) the volume to uint8, through window (default: the
+        current one).
+        """
+        v_min, v_max = self.window if window is None else window
+        return (255 * np.clip((arr.astype(np.float32) - v_min) / (v_max - v_min), 0, 1)).astype(np.uint8)
+
+    def set_axis(self, axis):
+        """
+        Size the cache for the slices shown along axis: reslices (axis 0 or
+        1) read every block, so they are all kept, otherwise each reslice
+        would convert the whole volume again; back to axial slices, the
+        cache shrinks to cache_size.
+        """
+        with self._lock:
+            self.cache_size = self.axial_cache_size if axis == 2 else max(self.axial_cache_size, self.volume_bytes)
+            while self._cache_bytes > self.cache_size:
+                _, old = self._cache.popitem(last=False)
+                self._cache_bytes -= old.nbytes
+
+    def _block(self, b):
+        """
+        Slices b*block_slices... as uint8, with shape (slices, X, Y)
+        (converted on first access, then cached).
+        """
+        with self._lock:
+            if b in self._cache:
+                self._cache.move_to_end(b)
+                return self._cache[b]
+            window = self.window
+        z0 = b * self.block_slices
+        block = np.asarray(self.volume[:, :, z0:z0+self.block_slices])
+        block = np.ascontiguousarray(np.moveaxis(self.to_uint8(block, window), 2, 0))
+        block.flags.writeable = False # shared by the callers
+        with self._lock:
+            if window != self.window or b in self._cache or block.nbytes > self.cache_size:
+                return block
+            self._cache[b] = block
+            self._cache_bytes += block.nbytes
+            while self._cache_bytes > self.cache_size:
+                _, old = self._cache.popitem(last=False)
+                self._cache_bytes -= old.nbytes
+        return block
+
+    def slice(self, index, axis=2):
+        """
+        Slice index along axis as uint8, oriented as plane_view (read-only).
+        """
+        if axis == 2:
+            b, k = divmod(index, self.block_slices)
+            return self._block(b)[k]
+        n_blocks = -(-self.shape[2] // self.block_slices)
+        # block[:, index] is row index of each slice, block[:, :, index] column index
+        rows = [self._block(b)[:, index] if axis == 0 else self._block(b)[:, :, index] for b in range(n_blocks)]
+        arr = np.concatenate(rows)[::-1]
+        arr.flags.writeable = False
+        return arr
+
+    def preview_slice(self, index, axis=2):
+        """
+        Slice index along axis (in the coordinates of the volume) of the
+        downsampled preview, as uint8 oriented as plane_view.
+        """
+        if axis == 2:
+            return self.to_uint8(self.preview[..., index])
+        # nearest slice of the preview, then z downsampled as x and y
+        i = round(index * (self.preview.shape[axis] - 1) / max(1, self.shape[axis] - 1))
+        plane = plane_view(self.preview, axis, i)
+        rows = np.linspace(0, plane.shape[0]-1, max(1, int(plane.shape[0] / self.preview_scale))).astype(np.int32)
+        return self.to_uint8(plane[rows])
+
+def _nbytes(value):
+    """
+    Approximate memory size of the data of a slice (arrays, PIL images, and
+    dicts of them).
+    """
+    if isinstance(value, dict):
+        return sum(_nbytes(v) for v in value.values())
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if hasattr(value, "size") and hasattr(value, "getbands"): # PIL image
+        return value.size[0] * value.size[1] * len(value.getbands())
+    return 0
+
+class SlicePrefetcher():
+    """
+    Cache of per-slice data, filled ahead of the navigation by a background
+    thread.
+
+    get(z) returns the data of slice z (computing it if not cached yet) and
+    tells the prefetcher the current position: the next depth slices in the
+    direction of the last move are then prepared in background, together
+    with the previous slice. Those are always kept; other slices are kept,
+    nearest to the current one first, up to cache_size MB.
+
+    Parameters
+    ----------
+    load : callable
+        load(z) returns the data of slice z (e.g. a dict of arrays); it is
+        called from the prefetch thread too.
+    n_slices : int
+        Number of slices of the volume.
+    depth : int
+        Slices prepared ahead of the current one (0: no prefetch).
+    cache_size : int
+        MB of slice data to keep.
+    """
+    def __init__(self, load, n_slices, depth=4, cache_size=512):
+        self.load = load
+        self.n_slices = n_slices
+        self.depth = depth
+        self.cache_size = cache_size * 2**20
+        self._cache = {} # z -> (data, nbytes)
+        self._cache_bytes = 0
+        self._cond = threading.Condition()
+        self._generation = 0 # incremented by invalidate(): older results are dropped
+        self._current = None
+        self._direction = 1
+        self._loading = None # slice being prepared by the prefetch thread
+        self._closed = False
+        self._thread = None
+        if depth > 0:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _wanted(self):
+        """
+        Slices to keep around the current one, most urgent first.
+        """
+        if self._current is None:
+            return []
+        z, d = self._current, self._direction
+        candidates = [z] + [z + d*k for k in range(1, self.depth+1)] + [z - d]
+        return [c for c in candidates if 0 <= c < self.n_slices]
+
+    def _store(self, z, data, generation):
+        """
+        Add slice data to the cache, dropping the slices farthest from the
+        current one if needed. Must be called with self._cond held.
+        """
+        if generation != self._generation or z in self._cache:
+            return
+        nbytes = _nbytes(data)
+        self._cache[z] = (data, nbytes)
+        self._cache_bytes += nbytes
+        wanted = set(self._wanted())
+        current = z if self._current is None else self._current
+        for old in sorted(self._cache, key=lambda c: abs(c - current), reverse=True):
+            if self._cache_bytes <= self.cache_size:
+                break
+            if old in wanted: # e.g. the last slice ahead: nearer ones may still go
+                continue
+            self._cache_bytes -= self._cache.pop(old)[1]
+
+    def get(self, z):
+        """
+        Data of slice z; z becomes the current slice.
+        """
+        with self._cond:
+            if self._current is not None and z != self._current:
+                self._direction = 1 if z > self._current else -1
+            self._current = z
+            self._cond.notify_all()
+            # the prefetch thread may be preparing z right now: wait for it
+            while self._loading == z and z not in self._cache:
+                self._cond.wait()
+            cached = self._cache.get(z)
+            generation = self._generation
+        if cached is not None:
+            return cached[0]
+        data = self.load(z)
+        with self._cond:
+            self._store(z, data, generation)
+        return data
+
+    def invalidate(self):
+        """
+        Drop all cached data (e.g. after a change of the display window or of
+        the preprocessing parameters); slices are prepared again in background.
+        """
+        with self._cond:
+            self._generation += 1
+            self._cache.clear()
+            self._cache_bytes = 0
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cache.clear()
+            self._cache_bytes = 0
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._closed:
+                        return
+                    # z is skipped: get() is computing it already
+                    missing = [c for c in self._wanted()[1:] if c not in self._cache]
+                    if missing:
+                        break
+                    self._cond.wait()
+                z, generation = missing[0], self._generation
+                self._loading = z
+            try:
+                data = self.load(z)
+            except Exception: # e.g. a read error: get() will report it for the slice actually shown
+                with self._cond:
+                    self._loading = None
+                    self._cond.notify_all()
+                    self._cond.wait() # do not retry until something changes
+                continue
+            with self._cond:
+                self._store(z, data, generation)
+                self._loading = None
+                self._cond.notify_all()
+
+
+
+class SparseVolumeMask():
+    """
+    Volume mask (uint8, X x Y x Z) storing only its non-empty slices, each
+    cropped to the bounding box of its labelled voxels: segmentations
+    usually cover a small part of a few slices, so that the mask takes a
+    fraction of the memory of the dense array.
+
+    Slices are edited as dense copies: plane(axis, index) returns the slice
+    oriented as plane_view, set_plane(axis, index, values) stores it back
+    (coronal and sagittal planes are gathered from/scattered to the axial
+    slices). mask[..., z] and mask[:, :, z0:z1] return dense copies too, so
+    that the mask can be read as a dense volume (e.g. by labelmap_chunks
+    in slimtag_biomedical).
+
+    Parameters
+    ----------
+    shape : tuple
+        (X, Y, Z).
+    """
+
+    ndim = 3
+    dtype = np.dtype(np.uint8)
+    itemsize = 1
+
+    def __init__(self, shape):
+        self.shape = tuple(shape)
+        self._slices = {} # z -> (first row, first column, crop)
+
+    @property
+    def nbytes(self):
+        return sum(crop.nbytes for _, _, crop in list(self._slices.values()))
+
+    def nonempty(self):
+        """
+        Indices of the non-empty slices, in order.
+        """
+        return sorted(self._slices)
+
+    def get_slice(self, z):
+        """
+        Dense copy of slice z.
+        """
+        out = np.zeros(self.shape[:2], self.dtype)
+        self._paste(out, z)
+        return out
+
+    def _paste(self, out, z):
+        entry = self._slices.get(z)
+        if entry is not None:
+            r0, c0, crop = entry
+            out[r0:r0+crop.shape[0], c0:c0+crop.shape[1]] = crop
+
+    def set_slice(self, z, values):
+        """
+        Store values (X x Y) as slice z (dropping it if empty). Slices can
+        be stored from different threads.
+        """
+        rows = np.flatnonzero(values.any(axis=1))
+        if len(rows) == 0:
+            self._slices.pop(z, None)
+            return
+        cols = np.flatnonzero(values.any(axis=0))
+        self._slices[z] = (rows[0], cols[0], np.array(values[rows[0]:rows[-1]+1, cols[0]:cols[-1]+1], dtype=self.dtype))
+
+    def _line(self, z, axis, index):
+        # row (axis 0) or column (axis 1) index of slice z, or None if empty
+        entry = self._slices.get(z)
+        if entry is None:
+            return None
+        r0, c0, crop = entry
+        line = np.zeros(self.shape[1] if axis == 0 else self.shape[0], self.dtype)
+        if axis == 0 and r0 <= index < r0 + crop.shape[0]:
+            line[c0:c0+crop.shape[1]] = crop[index-r0]
+        elif axis == 1 and c0 <= index < c0 + crop.shape[1]:
+            line[r0:r0+crop.shape[0]] = crop[:, index-c0]
+        return line
+
+    def plane(self, axis, index):
+        """
+        Dense copy of plane_view(mask, axis, index).
+        """
+        if axis == 2:
+            return self.get_slice(index)
+        out = np.zeros(plane_shape(self.shape, axis), self.dtype)
+        for z in list(self._slices):
+            line = self._line(z, axis, index)
+            if line is not None:
+                out[self.shape[2]-1-z] = line
+        return out
+
+    def set_plane(self, axis, index, values):
+        """
+        Store values as plane_view(mask, axis, index): only the slices that
+        actually change are updated.
+        """
+        if axis == 2:
+            self.set_slice(index, values)
+            return
+        for z in range(self.shape[2]):
+            line = values[self.shape[2]-1-z]
+            old = self._line(z, axis, index)
+            if (old is None and not line.any()) or (old is not None and np.array_equal(old, line)):
+                continue
+            values_z = self.get_slice(z)
+            if axis == 0:
+                values_z[index] = line
+            else:
+                values_z[:, index] = line
+            self.set_slice(z, values_z)
+
+    def __getitem__(self, key):
+        """
+        Dense copy of mask[..., z] or mask[:, :, z0:z1] (Z-major).
+        """
+        *lead, last = key if isinstance(key, tuple) else (key,)
+        if not lead or any(k is not Ellipsis and k != slice(None) for k in lead):
+            raise IndexError("only whole slices, mask[..., z] or mask[:, :, z0:z1], can be read")
+        if isinstance(last, slice):
+            zs = range(*last.indices(self.shape[2]))
+            out = zeros_z_major(self.shape[:2] + (len(zs),), self.dtype)
+            for i, z in enumerate(zs):
+                self._paste(out[..., i], z)
+            return out
+        return self.get_slice(int(last))
+
+    def __array__(self, dtype=None, copy=None):
+        out = self[:, :, :]
+        return out if dtype is None else out.astype(dtype)
+
+def _encode_mask_slice(mask, z, palette, pnginfo):
+    values = mask[..., z]
+    if not values.any():
+        return None
+    buffer = io.BytesIO()
+    png_file = Image.fromarray(values, mode="P")
+    png_file.putpalette(palette)
+    png_file.save(buffer, format="PNG", pnginfo=pnginfo)
+    return buffer
+
+def _add_tar_member(tf, name, buffer):
+    tinfo = tarfile.TarInfo(name=name)
+    tinfo.size = len(buffer.getbuffer())
+    buffer.seek(0)
+    tf.addfile(tarinfo=tinfo, fileobj=buffer)
+
+def write_mask_tar(path, mask, meta, palette, pnginfo=None, max_workers=None):
+    """
+    Save mask (uint8, X x Y x Z, or a SparseVolumeMask) as a TAR archive
+    with meta (a json-able dict) as meta.json and a PNG for each non-empty
+    slice, with palette and pnginfo. Slices are encoded in parallel (zlib
+    releases the GIL, max_workers threads, default one per CPU) and added
+    to the archive in order as they are ready.
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    nd = len(str(mask.shape[2])) # max number of digits, for zero padding in namefiles
+
+    with tarfile.open(path, mode="w") as tf, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        _add_tar_member(tf, "meta.json", io.BytesIO(json.dumps(meta, indent=2).encode("utf-8")))
+
+        max_pending = 4 * max_workers
+        pending = collections.deque()
+
+        def write_next():
+            z, future = pending.popleft()
+            buffer = future.result()
+            if buffer is not None:
+                _add_tar_member(tf, f"{z:0{nd}d}.png", buffer)
+
+        slices = mask.nonempty() if isinstance(mask, SparseVolumeMask) else range(mask.shape[2])
+        for z in slices:
+            pending.append((z, executor.submit(_encode_mask_slice, mask, z, palette, pnginfo)))
+            if len(pending) > max_pending:
+                write_next()
+        while pending:
+            write_next()
+
+def _decode_mask_slice(data, mask, z):
+    mask.set_slice(z, np.asarray(Image.open(io.BytesIO(data)), dtype=np.uint8))
+
+def read_mask_tar(path, max_workers=None):
+    """
+    Load a TAR archive written by write_mask_tar: return the content of
+    meta.json and the mask (a SparseVolumeMask), into which the PNGs are
+    decoded in parallel (max_workers threads, default one per CPU) as they
+    are read from the archive.
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    with tarfile.open(path, mode="r") as tf, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        meta = json.load(tf.extractfile(tf.getmember("meta.json")))
+        mask = SparseVolumeMask(meta["shape"])
+
+        max_pending = 4 * max_workers
+        pending = collections.deque()
+
+        for member in tf:
+            if member.isfile() and member.name.endswith(".png"):
+                f = tf.extractfile(member)
+                if f is None:
+                    continue
+                z = int(member.name.split(".")[0])
+                pending.append(executor.submit(_decode_mask_slice, f.read(), mask, z))
+                if len(pending) > max_pending:
+                    pending.popleft().result()
+        while pending:
+            pending.popleft().result()
+
+    return meta, mask
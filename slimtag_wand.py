@@ -8,7 +8,8 @@ For each method, two functions are required:
 
 apply potential preprocessing computation to a single image. For example:
 - for region growing, compute the RGB, grayscale, and edge matrices, and return them
-- for SAM, embed image into the model (passed as one of the args) and return None
+- for SAM, embed image into the model (passed as one of the args) and return a
+  key to restore the embedding later (or None if the model cannot do that)
 
 (2) <method>_inference(img: np.array with dtype=uint8,
                        pt: pair (x,y),
@@ -22,7 +23,7 @@ preprocessing is the result of <method>_preprocessing
 """
 import numpy as np
 from scipy import ndimage
-from scipy.special import expit # sigmoid
+from scipy.special import logit # inverse of sigmoid
 
 def region_growing_preprocessing(image):
     # REGION GROWING (need 0-255 matrices BUT with float dtype)
@@ -168,19 +169,30 @@ def region_growing_inference(image, point, parameters, # model_inference mandato
 
 def sam_preprocessing(image, model):
     model.set_image(image)
-    return None
+    # SamModelPool and SamWorker identify embeddings by image digest
+    return getattr(model, "image_key", None)
 
 def sam_inference(image, point, parameters, # model_inference mandatory args
                   model, # sam_inference arg
-                  preprocessing=None, # model_inference mandatory kwarg (not used for SAM)
-                  pt_labels=np.array([1]), multipoint=False): # sam_inference kwargs
+                  preprocessing=None, # model_inference mandatory kwarg (key from sam_preprocessing)
+                  pt_labels=np.array([1]), multipoint=False, box=None): # sam_inference kwargs
     # default values if parameters does not contain those
     thres = parameters.get("threshold", 0.5)
-    masks, scores, _ = model.predict(np.array(point),
-                                     pt_labels,
-                                     multimask_output=not multipoint,
+    if preprocessing is not None:
+        # the model may hold the embedding of another image meanwhile (e.g.
+        # in the Bayesian optimization): restore it, or embed image again
+        if not model.restore(preprocessing):
+            model.set_image(image)
+    # box is (x0, y0, x1, y1): it can be used alone (point=None) or together
+    # with points; a box prompt is unambiguous, so a single mask is enough
+    masks, scores, _ = model.predict(point_coords=None if point is None else np.array(point),
+                                     point_labels=None if point is None else pt_labels,
+                                     box=None if box is None else np.array(box),
+                                     multimask_output=not multipoint and box is None,
                                      return_logits=True)
 
-    masks = expit(masks) > thres
+    # sigmoid(masks) > thres, computed without float temporaries
+    # (logits of tiled predictions can be as large as the whole image)
+    masks = masks > logit(thres)
     i = np.argmax(scores)
     return masks[i]
\ No newline at end of file
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+Regression tests for the DICOM folder index (slimtag_biomedical.DicomIndex).
+"""
+import os
+import sys
+
+import pytest
+
+pydicom = pytest.importorskip("pydicom")
+pytest.importorskip("nrrd")
+pytest.importorskip("nibabel")
+
+from pydicom.data import get_testdata_file
+from pydicom.uid import generate_uid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import slimtag_biomedical as biomedical
+
+
+def make_series(folder, n_slices=5):
+    base = pydicom.dcmread(get_testdata_file("CT_small.dcm"))
+    uid = generate_uid()
+    for k in range(n_slices):
+        ds = base.copy()
+        ds.SeriesInstanceUID = uid
+        ds.SOPInstanceUID = generate_uid()
+        ds.InstanceNumber = k
+        ds.ImagePositionPatient = [0.0, 0.0, 2.0 * k]
+        ds.save_as(os.path.join(folder, f"{k:03d}.dcm"))
+    with open(os.path.join(folder, "notes.txt"), "w") as f:
+        f.write("not a DICOM file")
+    return uid
+
+
+def test_deleted_file_only(tmp_path):
+    folder = tmp_path / "series"
+    folder.mkdir()
+    uid = make_series(str(folder))
+    index = biomedical.DicomIndex(str(tmp_path / "index.sqlite"))
+
+    assert len(index.headers(str(folder))) == 5
+
+    # a file removed, nothing else changed
+    os.remove(folder / "002.dcm")
+    headers = index.headers(str(folder))
+    assert sorted(os.path.basename(ds.filename) for ds in headers) == ["000.dcm", "001.dcm", "003.dcm", "004.dcm"]
+
+    series = biomedical.list_series_DICOM(str(folder), index)
+    assert list(series) == [uid]
+    _, _, volume = biomedical.load_DICOM(str(folder), index=index)
+    assert volume.shape[2] == 4
+
+
+def test_unchanged_files_not_read(tmp_path, monkeypatch):
+    folder = tmp_path / "series"
+    folder.mkdir()
+    make_series(str(folder))
+    index = biomedical.DicomIndex(str(tmp_path / "index.sqlite"))
+    index.headers(str(folder))
+
+    read = []
+    read_header = biomedical.read_header_DICOM
+    monkeypatch.setattr(biomedical, "read_header_DICOM", lambda f: read.append(f) or read_header(f))
+    assert len(index.headers(str(folder))) == 5
+    assert read == []
+
+
+def test_listed_series_not_read_again(tmp_path, monkeypatch):
+    folder = tmp_path / "series"
+    folder.mkdir()
+    uid = make_series(str(folder))
+    series = biomedical.list_series_DICOM(str(folder)) # no index
+
+    read = []
+    read_header = biomedical.read_header_DICOM
+    monkeypatch.setattr(biomedical, "read_header_DICOM", lambda f: read.append(f) or read_header(f))
+    _, _, volume = biomedical.load_medical_volume(str(folder), headers=series[uid])
+    assert volume.shape[2] == 5
+    assert read == []
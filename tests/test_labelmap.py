@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Round-trip tests for the labelmap export (slimtag_biomedical.save_labelmap_*)
+and its parallel gzip stream.
+"""
+import gzip
+import io
+import os
+import sys
+
+import numpy as np
+import pytest
+
+nrrd = pytest.importorskip("nrrd")
+nib = pytest.importorskip("nibabel")
+pytest.importorskip("pydicom")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import slimtag_biomedical as biomedical
+
+LABELS = {1: ("liver", (255, 0, 0)), 3: ("right kidney", (0, 128, 255))}
+
+
+def make_mask(shape=(17, 11, 9)):
+    rng = np.random.RandomState(0)
+    mask = np.zeros(shape, np.uint8)
+    mask[2:9, 3:7, 1:5] = 1
+    mask[10:15, 1:4, 4:8] = 3
+    mask[rng.rand(*shape) < 0.05] = 3
+    return mask
+
+
+def make_affine():
+    # oblique voxel -> RAS+ geometry, anisotropic spacing
+    c, s = np.cos(0.3), np.sin(0.3)
+    affine = np.eye(4)
+    affine[:3, :3] = np.array([[c, -s, 0], [s, c, 0], [0, 0, 1]]) @ np.diag([0.7, 0.8, 2.5])
+    affine[:3, 3] = [-12.5, 40.0, 3.25]
+    return affine
+
+
+def test_nrrd_labelmap(tmp_path):
+    mask, affine = make_mask(), make_affine()
+    path = str(tmp_path / "labels.nrrd")
+    biomedical.save_labelmap_NRRD(path, mask, affine, LABELS)
+
+    data, header = nrrd.read(path)
+    assert data.dtype == np.uint8
+    np.testing.assert_array_equal(data, mask)
+
+    read_affine = np.eye(4)
+    read_affine[:3, :3] = np.asarray(header["space directions"]).T
+    read_affine[:3, 3] = header["space origin"]
+    assert header["space"] == "left-posterior-superior"
+    np.testing.assert_allclose(biomedical.LPS_TO_RAS @ read_affine, affine)
+
+    assert header["Segment1_Name"] == "right kidney"
+    assert header["Segment1_LabelValue"] == "3"
+
+
+@pytest.mark.parametrize("name", ["labels.nii", "labels.nii.gz"])
+def test_nifti_labelmap(tmp_path, name):
+    mask, affine = make_mask(), make_affine()
+    path = str(tmp_path / name)
+    biomedical.save_labelmap_NIFTI(path, mask, affine, LABELS)
+
+    img = nib.load(path)
+    data = np.asarray(img.dataobj)
+    assert data.dtype == np.uint8
+    np.testing.assert_array_equal(data, mask)
+    np.testing.assert_allclose(img.affine, affine, atol=1e-6)
+
+
+@pytest.mark.parametrize("chunks", [
+    [],
+    [b""],
+    [b"abc"],
+    [b"first chunk ", b"", b"x" * 100000, bytes(range(256)) * 1000],
+])
+def test_gzip_stream(chunks):
+    fh = io.BytesIO()
+    biomedical.write_gzip(fh, iter(chunks), max_workers=3)
+    assert gzip.decompress(fh.getvalue()) == b"".join(chunks)
+
+
+def test_gzip_labelmap_chunks():
+    mask = make_mask((64, 48, 40))
+    fh = io.BytesIO()
+    biomedical.write_gzip(fh, biomedical.labelmap_chunks(mask, chunk_size=10000), level=1)
+    assert gzip.decompress(fh.getvalue()) == mask.tobytes(order="F")
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+Round-trip tests for the volume mask archives (slimtag_volume.write_mask_tar
+and read_mask_tar).
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip("PIL")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import slimtag_volume as volume
+
+PALETTE = [0, 0, 0, 255, 0, 0, 0, 255, 0] + [0] * (256 * 3 - 9)
+
+
+def make_mask(shape=(23, 19, 12)):
+    mask = volume.zeros_z_major(shape)
+    mask[3:10, 4:15, 2] = 1
+    mask[0, 0, 5] = 2
+    mask[-1, -1, 5] = 1
+    mask[5:20, 1:3, 11] = 2 # last slice: checks the zero padding of the names
+    return mask
+
+
+@pytest.mark.parametrize("max_workers", [None, 1, 3])
+def test_dense_mask_tar(tmp_path, max_workers):
+    mask = make_mask()
+    path = str(tmp_path / "mask.tar")
+    meta = {"shape": list(mask.shape), "labels": {"1": "liver"}}
+    volume.write_mask_tar(path, mask, meta, PALETTE, max_workers=max_workers)
+
+    read_meta, read_mask = volume.read_mask_tar(path, max_workers=max_workers)
+    assert read_meta == meta
+    assert read_mask.shape == mask.shape
+    np.testing.assert_array_equal(np.asarray(read_mask), mask)
+
+
+def test_empty_mask_tar(tmp_path):
+    mask = volume.zeros_z_major((8, 8, 4))
+    path = str(tmp_path / "mask.tar")
+    volume.write_mask_tar(path, mask, {"shape": [8, 8, 4]}, PALETTE)
+
+    _, read_mask = volume.read_mask_tar(path)
+    assert not np.asarray(read_mask).any()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the sparse volume mask (slimtag_volume.SparseVolumeMask), checked
+against a dense reference volume.
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip("PIL")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import slimtag_volume as volume
+
+SHAPE = (13, 10, 7)
+
+
+def test_set_get_clear():
+    mask = volume.SparseVolumeMask(SHAPE)
+    values = np.zeros(SHAPE[:2], np.uint8)
+    values[4:6, 2:8] = 3
+
+    mask.set_slice(2, values)
+    assert mask.nonempty() == [2]
+    np.testing.assert_array_equal(mask.get_slice(2), values)
+    assert not mask.get_slice(3).any()
+    assert mask.nbytes == 2 * 6 # only the bounding box is stored
+
+    mask.set_slice(2, np.zeros(SHAPE[:2], np.uint8))
+    assert mask.nonempty() == []
+    assert mask.nbytes == 0
+    assert not mask.get_slice(2).any()
+
+
+def test_bounding_box_grows():
+    mask = volume.SparseVolumeMask(SHAPE)
+    values = np.zeros(SHAPE[:2], np.uint8)
+    values[5, 5] = 1
+    mask.set_slice(0, values)
+
+    # edit the dense copy outside of the stored crop, in every direction
+    values = mask.get_slice(0)
+    values[0, 9] = 2
+    values[12, 0] = 1
+    mask.set_slice(0, values)
+    np.testing.assert_array_equal(mask.get_slice(0), values)
+    assert mask.nbytes == SHAPE[0] * SHAPE[1]
+
+    # and shrink it again
+    values[0, 9] = values[12, 0] = 0
+    mask.set_slice(0, values)
+    np.testing.assert_array_equal(mask.get_slice(0), values)
+    assert mask.nbytes == 1
+
+
+@pytest.mark.parametrize("axis", [0, 1, 2])
+def test_planes_match_dense(axis):
+    rng = np.random.RandomState(axis)
+    dense = np.zeros(SHAPE, np.uint8)
+    mask = volume.SparseVolumeMask(SHAPE)
+
+    for index in range(SHAPE[axis]):
+        values = volume.plane_view(dense, axis, index).copy()
+        values[rng.rand(*values.shape) < 0.1] = rng.randint(1, 4)
+        volume.plane_view(dense, axis, index)[...] = values
+        mask.set_plane(axis, index, values)
+
+    for other in range(3):
+        for index in range(SHAPE[other]):
+            np.testing.assert_array_equal(mask.plane(other, index), volume.plane_view(dense, other, index))
+    np.testing.assert_array_equal(np.asarray(mask), dense)
+    np.testing.assert_array_equal(mask[:, :, 2:5], dense[:, :, 2:5])
+    np.testing.assert_array_equal(mask[..., 4], dense[..., 4])
+
+
+def test_sparse_mask_tar(tmp_path):
+    mask = volume.SparseVolumeMask(SHAPE)
+    values = np.zeros(SHAPE[:2], np.uint8)
+    values[1:4, 6:9] = 2
+    mask.set_slice(1, values)
+    mask.set_slice(6, values[::-1])
+
+    path = str(tmp_path / "mask.tar")
+    palette = [0, 0, 0] + [255] * (256 * 3 - 3)
+    volume.write_mask_tar(path, mask, {"shape": list(SHAPE)}, palette)
+
+    _, read_mask = volume.read_mask_tar(path)
+    assert isinstance(read_mask, volume.SparseVolumeMask)
+    assert read_mask.nonempty() == [1, 6]
+    np.testing.assert_array_equal(np.asarray(read_mask), np.asarray(mask))